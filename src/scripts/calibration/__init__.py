@@ -1 +1,2 @@
 from .calibrator import Calibrator, CalibrationException
+from .exposuremodel import ExposureLinearityModel
@@ -1,89 +1,372 @@
+import os
+import json
+import hashlib
 import numpy as np
 import cv2
+from scipy.stats import chi2
 
 from ..constants import DmdConstants
 from ..utilities.coordtransformations import best_fit_affine_transform
+from ..utilities.runningstats import RunningPixelStats
+from ..utilities.fastblur import pyramid_gaussian_blur, gaussian_sigma_for_kernel_size
+from .exposuremodel import ExposureLinearityModel, tile_means
+from ..raspidisplay import PatternDescription
 
 class CalibrationException(Exception):
     pass
 
 
 class Calibrator:
-    def __init__(self, pycroInterface, raspiInterface, cameraExposureMs):
+    def __init__(self, pycroInterface, raspiInterface, cameraExposureMs, brightness_calibration_cache_dirpath=None):
         self.pycroInterface = pycroInterface
         self.raspiInterface = raspiInterface
         self.cameraExposureMs = cameraExposureMs
+        # Directory brightness results are saved in, keyed by the settings they were taken with, see calibrate_brightness.
+        # None to not cache them.
+        self.brightness_calibration_cache_dirpath = brightness_calibration_cache_dirpath
         # self.usingStandins = usingStandins
         
         self.dmd_dims = ( DmdConstants.DMD_H, DmdConstants.DMD_W )
         
         # Brightness calibration configuration
+        # Pics of each solid field, or with adaptive_solid_field_exposures the most that are taken
         self.number_of_solid_field_calibration_exposures = 10
+        # Take solid field pics in batches, alternating between the fields, and stop as soon as the variance check in
+        # calculate_bright_and_dark_levels is decided either way with solid_field_decision_confidence. With n pics it
+        # can only pass once the measured variance is under about chi2.ppf(0.005, n - 1) / (n - 1) of the limit: 0.5%
+        # at 3 pics, 5% at 5 and 19% at 10, so it starts at 5 to have a real chance of stopping early.
+        self.adaptive_solid_field_exposures = True
+        self.min_solid_field_calibration_exposures = 5
+        self.solid_field_calibration_exposure_batch_size = 2
+        self.solid_field_decision_confidence = 0.99
+        # Keep the solid field pics, for showing them, instead of only their running per-pixel statistics
+        self.keep_solid_field_pics = False
         self.solid_field_calculation_gaussian_blur_sigma = 201
+        # Blur for the illuminated section mask at reduced resolution, see pyramid_gaussian_blur
+        self.fast_illuminated_section_mask = True
 
         self.max_relative_variance_rel_to_b_w_diff = 0.1
         
+        # Cached brightness results are used while one bright and one dark pic are within this fraction of the bright to
+        # dark difference of their cached averages, and the illuminated section mask from the bright pic differs from
+        # the cached one in at most this fraction of pixels
+        self.max_cached_brightness_level_drift = 0.05
+        self.max_cached_brightness_mask_disagreement = 0.01
+        
+        # Exposure sweep, see take_exposure_sweep_data. Levels are fitted per tile_size x tile_size tile.
+        self.exposure_sweep_pics_per_exposure = 3
+        self.exposure_sweep_tile_size = 16
+        # Sweeps whose fit is off by more than this fraction of the bright to dark difference anywhere are rejected
+        self.max_exposure_sweep_relative_residual = 0.02
+        
+        # Auto exposure, see find_auto_exposure. Searches for the exposure that puts this percentile of a solid bright
+        # field pic at target fraction of the camera's saturation level, to within the tolerance fraction, with single
+        # full resolution frames. Pics with more than the max saturated fraction of pixels at saturation count as
+        # overexposed.
+        self.auto_exposure_percentile = 99.5
+        self.auto_exposure_target_fraction = 0.7
+        self.auto_exposure_tolerance_fraction = 0.1
+        self.max_auto_exposure_saturated_fraction = 0.0005
+        self.min_auto_exposure_ms = 0.1
+        self.max_auto_exposure_ms = 2000
+        self.max_auto_exposure_frames = 8
+        
         # Brightness calibration results
+        self._solid_bright_field_stats = None
+        self._solid_dark_field_stats = None
+        # Only kept with keep_solid_field_pics
         self._solid_bright_field_cam_pics = None
         self._solid_dark_field_cam_pics = None
+        # PooledFrames handles the solid field pics are views of, released when new solid field data is taken
+        self._solid_field_pooled_frames = []
         self._dark_level = None
         self._bright_level = None
+        self._illuminated_section_mask = None
+        # Per-pixel averages of the solid field pics
+        self._solid_bright_field_mean = None
+        self._solid_dark_field_mean = None
+        self._brightness_calibration_cache_key = None
+        
+        # Exposure sweep results
+        self._exposure_sweep_exposures_ms = None
+        self._exposure_sweep_bright_tile_levels = None
+        self._exposure_sweep_dark_tile_levels = None
+        self._exposure_sweep_frame_shape = None
+        self._exposure_sweep_illuminated_section_mask = None
+        self._exposure_sweep_camera_roi = None
+        self._exposure_linearity_model = None
+        # Camera ROI, as (x, y, width, height), the solid field pics and so the illuminated section mask were taken with
+        self._solid_field_camera_roi = None
         
         # Coordinate calibration configuration
         self.circle_diameter = 31
         self.circle_spacing = 100
         self.circle_identification_gaussian_blur_sigma = 100
+        # Upload every circle pattern in one go before acquisition, so each point only needs a "show pattern k" command
+        self.preload_coord_calibration_patterns = True
+        # Read out only the part of the sensor the DMD lights up, plus a margin, while taking coordinate calibration data
+        self.crop_camera_to_illuminated_section = True
+        # More than min_blob_distance_to_edge, so circles at the edge of the illuminated section aren't thrown out
+        self.illuminated_section_camera_roi_margin = 100
+        # Without preloading, send the next circle pattern in the background while the camera exposes the current one
+        self.pipeline_coord_calibration_uploads = True
         
         # Throw out identified circle candidates that too close enough to edge
         self.min_blob_distance_to_edge = 50
         self.blob_min_circularity = 0.75
         
+        # Coarse pass of coordinate calibration: binning to find the circles with quickly, None for full resolution
+        self.coord_calibration_coarse_binning = 4
+        # Refinement pass: snap each circle the coarse pass found again at full resolution, for sub-pixel positions
+        self.refine_coord_calibration = True
+        # Extra room around each circle in the refinement pass's pics, in full resolution pixels
+        self.coord_calibration_refine_window_margin = 20
+        # Show many circles per pattern, far enough apart on the sensor that each one's window holds only it. Falls back
+        # to one circle per pattern when the grid is too small or the circles used to find their spacing aren't found.
+        self.multiplex_coord_calibration = True
+        
         # Coordinate calibration results
         self._dmd_coords_and_acquired_images = None
     
-    def turn_on_laser_and_setup_pycromanager(self):
-        self.pycroInterface.set_imaging_settings_for_acquisition(
-            multishutterPreset="NoMembers",
-            sapphireOnOverride="on",
-            exposureMs=self.cameraExposureMs,
-            sapphireSetpoint="110",
-            )    
+    def brightness_calibration_imaging_settings(self, binning=1, exposure_ms=None):
+        if exposure_ms is None:
+            exposure_ms = self.cameraExposureMs
+        
+        # Binning sums binning * binning pixels, so the exposure is cut by as much to keep the bright and dark levels
+        return {
+            "multishutterPreset": "NoMembers",
+            "sapphireOnOverride": "on",
+            "exposureMs": exposure_ms / binning ** 2,
+            "sapphireSetpoint": "110",
+            "binning": "{}x{}".format(binning, binning),
+        }
+    
+    def turn_on_laser_and_setup_pycromanager(self, binning=1, exposure_ms=None):
+        self.pycroInterface.set_imaging_settings_for_acquisition(**self.brightness_calibration_imaging_settings(binning, exposure_ms))
+    
+    def find_auto_exposure(self):
+        # Exposure for the brightness calibration, searched for with one pic of the solid bright field per step, read
+        # out from only the illuminated section when it's known. Pics aren't binned: a binned pixel sums the offset of
+        # every pixel in it and only reaches the saturation level after single pixels have clipped, so neither the
+        # level nor saturation would say how the unbinned calibration pics come out. Bisects the range of exposures
+        # that aren't yet ruled out, but steps straight to where the levels seen so far say the target is when that's
+        # in the range, since they are close to linear in exposure. Sets cameraExposureMs to the exposure found and
+        # returns it.
+        saturation_level = self.pycroInterface.get_camera_saturation_level()
+        target_level = self.auto_exposure_target_fraction * saturation_level
+        
+        # Longest exposure known to be too dim and shortest known to be too bright, None until there is one
+        low_ms = None
+        high_ms = None
+        exposure_ms = min(max(self.cameraExposureMs, self.min_auto_exposure_ms), self.max_auto_exposure_ms)
+        # Unsaturated (exposure, level) samples, and the one closest to the target
+        samples = []
+        best_sample = None
+        found_exposure_ms = None
+        
+        previous_camera_roi = None
+        try:
+            self.turn_on_laser_and_setup_pycromanager(exposure_ms=exposure_ms)
+            previous_camera_roi = self.pycroInterface.get_camera_roi()
+            
+            if self.crop_camera_to_illuminated_section and self._illuminated_section_mask is not None:
+                sensor_roi = self.illuminated_section_camera_roi()
+                if sensor_roi is not None:
+                    self.pycroInterface.set_camera_roi(*sensor_roi)
+            
+            with self.raspiInterface.image_sender() as raspiImageSender:
+                raspiImageSender.send_image(PatternDescription(fill=1.0))
+                
+                for i in range(self.max_auto_exposure_frames):
+                    # Only the exposure changes between steps, so it's the only setting sent
+                    self.turn_on_laser_and_setup_pycromanager(exposure_ms=exposure_ms)
+                    cam_pic = self.pycroInterface.snap_pic()
+                    
+                    saturated_fraction = np.count_nonzero(cam_pic >= saturation_level) / cam_pic.size
+                    level = np.percentile(cam_pic, self.auto_exposure_percentile)
+                    print("Auto exposure: {} ms gives level {}, {} of pixels saturated".format(exposure_ms, level, saturated_fraction))
+                    
+                    if saturated_fraction > self.max_auto_exposure_saturated_fraction:
+                        if exposure_ms <= self.min_auto_exposure_ms:
+                            raise CalibrationException("Camera saturates even at the shortest auto exposure of {} ms".format(exposure_ms))
+                        high_ms = exposure_ms
+                    else:
+                        samples.append((exposure_ms, level))
+                        if best_sample is None or abs(level - target_level) < abs(best_sample[1] - target_level):
+                            best_sample = (exposure_ms, level)
+                        
+                        if abs(level - target_level) <= self.auto_exposure_tolerance_fraction * target_level:
+                            found_exposure_ms = exposure_ms
+                            break
+                        if level < target_level:
+                            if exposure_ms >= self.max_auto_exposure_ms:
+                                print("Auto exposure: bright field is still dim at the longest auto exposure of {} ms".format(exposure_ms))
+                                found_exposure_ms = exposure_ms
+                                break
+                            low_ms = exposure_ms
+                        else:
+                            if exposure_ms <= self.min_auto_exposure_ms:
+                                print("Auto exposure: bright field is still bright at the shortest auto exposure of {} ms".format(exposure_ms))
+                                found_exposure_ms = exposure_ms
+                                break
+                            high_ms = exposure_ms
+                    
+                    exposure_ms = self.next_auto_exposure_ms(samples, target_level, low_ms, high_ms)
+        except CalibrationException:
+            raise
+        except Exception as e:
+            raise CalibrationException(str(e))
+        finally:
+            self.turn_off_laser_and_turn_off_shutter()
+            if previous_camera_roi is not None:
+                self.pycroInterface.set_camera_roi(*previous_camera_roi)
+        
+        if found_exposure_ms is None:
+            if best_sample is None:
+                raise CalibrationException("Auto exposure didn't find an exposure that doesn't saturate the camera in {} frames".format(
+                    self.max_auto_exposure_frames))
+            found_exposure_ms = best_sample[0]
+            print("Auto exposure: didn't converge in {} frames, using the closest exposure found".format(self.max_auto_exposure_frames))
+        
+        self.cameraExposureMs = found_exposure_ms
+        return found_exposure_ms
+    
+    def next_auto_exposure_ms(self, samples, target_level, low_ms, high_ms):
+        # Fits level = offset + slope * exposure through the last two unsaturated samples, or a line through zero with
+        # only one, and uses its prediction, kept within the auto exposure limits, if it's strictly between low_ms and
+        # high_ms. Otherwise bisects what's left of the limits in log space.
+        predicted_ms = None
+        if len(samples) >= 2 and samples[-1][0] != samples[-2][0]:
+            (exposure_a, level_a), (exposure_b, level_b) = samples[-2], samples[-1]
+            slope = (level_b - level_a) / (exposure_b - exposure_a)
+            if slope > 0:
+                predicted_ms = exposure_b + (target_level - level_b) / slope
+        elif len(samples) >= 1 and samples[-1][1] > 0:
+            predicted_ms = samples[-1][0] * target_level / samples[-1][1]
+        
+        if predicted_ms is not None:
+            predicted_ms = min(max(predicted_ms, self.min_auto_exposure_ms), self.max_auto_exposure_ms)
+            if (low_ms is None or predicted_ms > low_ms) and (high_ms is None or predicted_ms < high_ms):
+                return predicted_ms
+        
+        low_limit_ms = low_ms if low_ms is not None else self.min_auto_exposure_ms
+        high_limit_ms = high_ms if high_ms is not None else self.max_auto_exposure_ms
+        return float(np.sqrt(low_limit_ms * high_limit_ms))
     
     def take_solid_bright_and_dark_field_data(self):
         try:
             self.turn_on_laser_and_setup_pycromanager()
+            
+            self.release_solid_field_pics()
+            self._solid_bright_field_stats = None
+            self._solid_dark_field_stats = None
+            self._solid_field_camera_roi = self.pycroInterface.get_camera_roi()
+            self._brightness_calibration_cache_key = self.brightness_calibration_cache_key()
+            
+            # Room for every pic if they're kept, otherwise just the slot they're streamed through
+            n_pool_frames = 2 * self.number_of_solid_field_calibration_exposures if self.keep_solid_field_pics else 1
+            self.pycroInterface.ensure_frame_pool(n_pool_frames)
+            
+            bright_field_stats = RunningPixelStats()
+            dark_field_stats = RunningPixelStats()
+            bright_pic_blocks = []
+            dark_pic_blocks = []
+            
+            if self.adaptive_solid_field_exposures:
+                n_pics_per_field = min(self.min_solid_field_calibration_exposures, self.number_of_solid_field_calibration_exposures)
+            else:
+                n_pics_per_field = self.number_of_solid_field_calibration_exposures
 
             with self.raspiInterface.image_sender() as raspiImageSender:
-                solid_bright_field_dmd_pattern = np.ones(self.dmd_dims, dtype=float)
-                raspiImageSender.send_image(solid_bright_field_dmd_pattern)
-                
-                # if self.usingStandins:
-                #     self.pycroInterface.standin_pretend_solid_white()
+                while True:
+                    solid_bright_field_dmd_pattern = PatternDescription(fill=1.0)
+                    raspiImageSender.send_image(solid_bright_field_dmd_pattern)
+                    
+                    # if self.usingStandins:
+                    #     self.pycroInterface.standin_pretend_solid_white()
 
-                snapped_bright_pics = []
-                for i in range(self.number_of_solid_field_calibration_exposures):
-                    cam_pic = self.pycroInterface.snap_pic()
-                    snapped_bright_pics.append(cam_pic)
-                
-                
-                solid_dark_field_dmd_pattern = np.zeros(self.dmd_dims, dtype=float)
-                raspiImageSender.send_image(solid_dark_field_dmd_pattern)
-                
-                # if self.usingStandins:
-                #     self.pycroInterface.standin_pretend_solid_black()
+                    # One camera burst per field, written straight into the camera interface's frame pool
+                    bright_pic_blocks.append(self.snap_solid_field_pics(bright_field_stats, n_pics_per_field - bright_field_stats.n_frames))
+                    
+                    
+                    solid_dark_field_dmd_pattern = PatternDescription(fill=0.0)
+                    raspiImageSender.send_image(solid_dark_field_dmd_pattern)
+                    
+                    # if self.usingStandins:
+                    #     self.pycroInterface.standin_pretend_solid_black()
 
-                snapped_dark_pics = []
-                for i in range(self.number_of_solid_field_calibration_exposures):
-                    cam_pic = self.pycroInterface.snap_pic()
-                    snapped_dark_pics.append(cam_pic)
+                    dark_pic_blocks.append(self.snap_solid_field_pics(dark_field_stats, n_pics_per_field - dark_field_stats.n_frames))
+                    
+                    if not self.adaptive_solid_field_exposures or n_pics_per_field >= self.number_of_solid_field_calibration_exposures:
+                        break
+                    
+                    decision = self.solid_field_variance_check_decision(bright_field_stats, dark_field_stats)
+                    if decision is not None:
+                        print("Solid field variance check decided ({}) after {} pics per field".format(decision, n_pics_per_field))
+                        break
+                    
+                    n_pics_per_field = min(n_pics_per_field + self.solid_field_calibration_exposure_batch_size, self.number_of_solid_field_calibration_exposures)
             
-            self._solid_bright_field_cam_pics = snapped_bright_pics
-            self._solid_dark_field_cam_pics = snapped_dark_pics
+            self._solid_bright_field_stats = bright_field_stats
+            self._solid_dark_field_stats = dark_field_stats
+            if self.keep_solid_field_pics:
+                # Only copied when it took more than one burst
+                self._solid_bright_field_cam_pics = bright_pic_blocks[0] if len(bright_pic_blocks) == 1 else np.concatenate(bright_pic_blocks)
+                self._solid_dark_field_cam_pics = dark_pic_blocks[0] if len(dark_pic_blocks) == 1 else np.concatenate(dark_pic_blocks)
         except Exception as e:
             raise CalibrationException(str(e))
         finally:
             self.turn_off_laser_and_turn_off_shutter()
 
+    def release_solid_field_pics(self):
+        for pooled_frames in self._solid_field_pooled_frames:
+            pooled_frames.release()
+        self._solid_field_pooled_frames = []
+        self._solid_bright_field_cam_pics = None
+        self._solid_dark_field_cam_pics = None
+    
+    def snap_solid_field_pics(self, field_stats, n_pics):
+        # Adds n_pics pics to the field's per-pixel statistics. With keep_solid_field_pics returns an (n, h, w) view of
+        # the frame pool holding them, otherwise None.
+        if not self.keep_solid_field_pics:
+            for cam_pic in self.pycroInterface.stream_pics(n_pics):
+                field_stats.add(cam_pic)
+            return None
+        
+        pooled_frames = self.pycroInterface.snap_pics_into_pool(n_pics)
+        self._solid_field_pooled_frames.append(pooled_frames)
+        for cam_pic in pooled_frames.frames:
+            field_stats.add(cam_pic)
+        return pooled_frames.frames
+    
+    def solid_field_variance_check_decision(self, bright_field_stats, dark_field_stats):
+        # Whether the variance check in calculate_bright_and_dark_levels will pass ("pass") or fail ("fail") with
+        # solid_field_decision_confidence, or None if more pics are needed to tell. The average variance within a
+        # field is treated as having n - 1 degrees of freedom, as if every pixel's noise came from one source, like
+        # laser flicker, which makes for a wide chi-squared confidence interval but one that holds either way.
+        n_pics = bright_field_stats.n_frames
+        if n_pics < 2:
+            return None
+        
+        var_between_avg_dark_and_bright = np.average(((bright_field_stats.mean - dark_field_stats.mean) / 2) ** 2)
+        max_var_within = self.max_relative_variance_rel_to_b_w_diff * var_between_avg_dark_and_bright
+        
+        tail_probability = (1 - self.solid_field_decision_confidence) / 2
+        degrees_of_freedom = n_pics - 1
+        
+        all_below = True
+        for field_stats in [bright_field_stats, dark_field_stats]:
+            # Sum of squared differences from the mean over chi-squared quantiles bounds the variance
+            sum_of_squares = np.average(field_stats.m2)
+            var_within_lower = sum_of_squares / chi2.ppf(1 - tail_probability, degrees_of_freedom)
+            var_within_upper = sum_of_squares / chi2.ppf(tail_probability, degrees_of_freedom)
+            if var_within_lower > max_var_within:
+                return "fail"
+            if var_within_upper >= max_var_within:
+                all_below = False
+        
+        return "pass" if all_below else None
+    
     def get_solid_bright_and_dark_cam_pics(self):
         return self._solid_bright_field_cam_pics, self._solid_dark_field_cam_pics
     
@@ -91,32 +374,36 @@ class Calibrator:
         return self._bright_level, self._dark_level
     
     def calculate_bright_and_dark_levels(self):
-        if self._solid_dark_field_cam_pics == None or self._solid_bright_field_cam_pics == None:
+        if self._solid_dark_field_stats is None or self._solid_bright_field_stats is None:
             raise CalibrationException("Cannot calculate bright and dark levels until solid dark field and solid bright field calibration images have been exposed")
         
+        if self.adaptive_solid_field_exposures:
+            min_n_pics = min(self.min_solid_field_calibration_exposures, self.number_of_solid_field_calibration_exposures)
+        else:
+            min_n_pics = self.number_of_solid_field_calibration_exposures
+        
         if (
-            len(self._solid_bright_field_cam_pics) != self.number_of_solid_field_calibration_exposures or
-            len(self._solid_dark_field_cam_pics) != self.number_of_solid_field_calibration_exposures
+            self._solid_bright_field_stats.n_frames != self._solid_dark_field_stats.n_frames or
+            not min_n_pics <= self._solid_bright_field_stats.n_frames <= self.number_of_solid_field_calibration_exposures
             ):
             raise CalibrationException("Number of bright and dark solid field calibration pics " +
-                "should both be {}, instead # of bright is {} and # of dark is {}".format(
+                "should both be between {} and {}, instead # of bright is {} and # of dark is {}".format(
+                    min_n_pics,
                     self.number_of_solid_field_calibration_exposures,
-                    len(self._solid_bright_field_cam_pics),
-                    len(self._solid_dark_field_cam_pics),
+                    self._solid_bright_field_stats.n_frames,
+                    self._solid_dark_field_stats.n_frames,
                 ))
 
-        all_dark_samples = np.array(self._solid_dark_field_cam_pics)
-        all_bright_samples = np.array(self._solid_bright_field_cam_pics)
-
-        var_within_dark = np.average(np.var(all_dark_samples, axis=0))
-        var_within_bright = np.average(np.var(all_bright_samples, axis=0))
+        var_within_dark = np.average(self._solid_dark_field_stats.variance())
+        var_within_bright = np.average(self._solid_bright_field_stats.variance())
 
 
-        avg_dark = np.average(all_dark_samples, axis=0)
-        avg_bright = np.average(all_bright_samples, axis=0)
+        avg_dark = self._solid_dark_field_stats.mean
+        avg_bright = self._solid_bright_field_stats.mean
 
 
-        var_between_avg_dark_and_bright = np.average(np.var(np.array([avg_dark, avg_bright]), axis=0))
+        # Variance of the two averages at each pixel, which is half their difference squared
+        var_between_avg_dark_and_bright = np.average(((avg_bright - avg_dark) / 2) ** 2)
 
         # If the dmd lit-up area only covers part of the image, we need to find the bright level based on the area that is bright.
         # averaged_dark_img_field = np.mean(all_dark_samples)
@@ -124,13 +411,7 @@ class Calibrator:
         mean_dark_brightness = np.average(avg_dark)
         mean_bright_brightness = np.average(avg_bright)
         
-        gaussian_blur_xy = (self.solid_field_calculation_gaussian_blur_sigma, self.solid_field_calculation_gaussian_blur_sigma)
-        blurred_dark_avg = cv2.GaussianBlur(avg_dark, gaussian_blur_xy, 0)
-        blurred_bright_avg = cv2.GaussianBlur(avg_bright, gaussian_blur_xy, 0)
-
-        # The pixels that are on average more bright in bright than dark images give us the mask for the part of the image
-        # We use to find the bright level. We use the blurred images to find this region so that speckles don't affect it too much
-        illuminated_section_mask = blurred_bright_avg > mean_dark_brightness + (mean_bright_brightness - mean_dark_brightness) * 0.3
+        illuminated_section_mask = self.illuminated_section_mask_of(avg_bright, mean_dark_brightness, mean_bright_brightness)
 
         
         # show_dark_bright_calibration_images(bright_photos, dark_photos, bright_level, dark_level)
@@ -155,7 +436,234 @@ class Calibrator:
         self._dark_level = mean_dark_brightness
         self._bright_level = np.average(avg_bright[illuminated_section_mask])
         self._illuminated_section_mask = illuminated_section_mask
+        self._solid_bright_field_mean = avg_bright
+        self._solid_dark_field_mean = avg_dark
+    
+    def illuminated_section_mask_of(self, bright_pic, mean_dark_brightness, mean_bright_brightness):
+        # Only the bright field is blurred, the dark field doesn't go into the mask
+        if self.fast_illuminated_section_mask:
+            blurred_bright_avg = pyramid_gaussian_blur(bright_pic, gaussian_sigma_for_kernel_size(self.solid_field_calculation_gaussian_blur_sigma))
+        else:
+            gaussian_blur_xy = (self.solid_field_calculation_gaussian_blur_sigma, self.solid_field_calculation_gaussian_blur_sigma)
+            blurred_bright_avg = cv2.GaussianBlur(bright_pic, gaussian_blur_xy, 0)
+
+        # The pixels that are on average more bright in bright than dark images give us the mask for the part of the image
+        # We use to find the bright level. We use the blurred images to find this region so that speckles don't affect it too much
+        return blurred_bright_avg > mean_dark_brightness + (mean_bright_brightness - mean_dark_brightness) * 0.3
+    
+    def brightness_calibration_cache_key(self):
+        # Brightness results only carry over between sessions with the same imaging settings and camera geometry, and
+        # the same settings for calculating them. Should be called after turn_on_laser_and_setup_pycromanager.
+        fingerprint = {
+            "imaging_settings": self.brightness_calibration_imaging_settings(),
+            "camera_roi": [int(v) for v in self.pycroInterface.get_camera_roi()],
+            "blur_kernel_size": self.solid_field_calculation_gaussian_blur_sigma,
+            "fast_illuminated_section_mask": self.fast_illuminated_section_mask,
+        }
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+    
+    def brightness_calibration_cache_path(self, cache_key):
+        return os.path.join(self.brightness_calibration_cache_dirpath, "brightness_{}.npz".format(cache_key[:16]))
+    
+    def save_brightness_calibration(self):
+        # Saves the brightness results to the cache, under the key of the current settings
+        if self.brightness_calibration_cache_dirpath is None:
+            return
+        if self._bright_level is None or self._dark_level is None:
+            raise CalibrationException("Cannot save brightness calibration before bright and dark levels have been calculated")
+        
+        os.makedirs(self.brightness_calibration_cache_dirpath, exist_ok=True)
+        
+        cache_path = self.brightness_calibration_cache_path(self._brightness_calibration_cache_key)
+        # np.savez adds the extension if the path lacks it, so the temporary file keeps it
+        tmp_path = cache_path[:-len(".npz")] + ".tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            cache_key=np.array(self._brightness_calibration_cache_key),
+            bright_level=np.array(self._bright_level),
+            dark_level=np.array(self._dark_level),
+            illuminated_section_mask=self._illuminated_section_mask,
+            solid_field_camera_roi=np.array(self._solid_field_camera_roi),
+            # float32 is plenty for comparing pics against, and halves the file
+            bright_field_mean=self._solid_bright_field_mean.astype(np.float32),
+            dark_field_mean=self._solid_dark_field_mean.astype(np.float32),
+        )
+        os.replace(tmp_path, cache_path)
+    
+    def load_brightness_calibration(self, cache_key):
+        # Returns the cached brightness results for cache_key as a dict, or None if there aren't any
+        if self.brightness_calibration_cache_dirpath is None:
+            return None
+        
+        cache_path = self.brightness_calibration_cache_path(cache_key)
+        if not os.path.exists(cache_path):
+            return None
+        
+        try:
+            with np.load(cache_path) as cached:
+                if str(cached["cache_key"]) != cache_key:
+                    return None
+                return {name: cached[name] for name in cached.files}
+        except (OSError, ValueError, KeyError):
+            # Unreadable, calibrate again and overwrite it
+            return None
+    
+    def verify_cached_brightness_calibration(self):
+        # Fast check of cached brightness results against one bright and one dark pic. If they still match, the results
+        # are used and True is returned. Otherwise nothing changes and False is returned.
+        try:
+            self.turn_on_laser_and_setup_pycromanager()
+            
+            cache_key = self.brightness_calibration_cache_key()
+            cached = self.load_brightness_calibration(cache_key)
+            if cached is None:
+                return False
+            
+            with self.raspiInterface.image_sender() as raspiImageSender:
+                raspiImageSender.send_image(PatternDescription(fill=1.0))
+                bright_pic = self.pycroInterface.snap_pic().astype(float)
+                raspiImageSender.send_image(PatternDescription(fill=0.0))
+                dark_pic = self.pycroInterface.snap_pic().astype(float)
+        except Exception as e:
+            raise CalibrationException(str(e))
+        finally:
+            self.turn_off_laser_and_turn_off_shutter()
+        
+        if bright_pic.shape != cached["bright_field_mean"].shape or dark_pic.shape != cached["dark_field_mean"].shape:
+            return False
+        
+        cached_mask = cached["illuminated_section_mask"]
+        max_level_drift = self.max_cached_brightness_level_drift * (float(cached["bright_level"]) - float(cached["dark_level"]))
+        bright_drift = np.average(bright_pic[cached_mask] - cached["bright_field_mean"][cached_mask])
+        dark_drift = np.average(dark_pic - cached["dark_field_mean"])
+        
+        mask = self.illuminated_section_mask_of(bright_pic, np.average(dark_pic), np.average(bright_pic))
+        mask_disagreement = np.mean(mask != cached_mask)
+        
+        print("Cached brightness calibration: bright drift {}, dark drift {}, max drift {}, mask disagreement {}".format(
+            bright_drift, dark_drift, max_level_drift, mask_disagreement))
+        if abs(bright_drift) > max_level_drift or abs(dark_drift) > max_level_drift or mask_disagreement > self.max_cached_brightness_mask_disagreement:
+            return False
+        
+        # Pics from an earlier calibration don't go with the cached results
+        self.release_solid_field_pics()
+        self._bright_level = float(cached["bright_level"])
+        self._dark_level = float(cached["dark_level"])
+        self._illuminated_section_mask = cached_mask
+        self._solid_field_camera_roi = tuple(int(v) for v in cached["solid_field_camera_roi"])
+        self._solid_bright_field_mean = cached["bright_field_mean"]
+        self._solid_dark_field_mean = cached["dark_field_mean"]
+        self._brightness_calibration_cache_key = cache_key
+        return True
+    
+    def calibrate_brightness(self):
+        # Reuses cached brightness results when a quick check says they still hold, otherwise takes solid field data,
+        # calculates the levels and caches them. Returns whether the cached results were used.
+        if self.verify_cached_brightness_calibration():
+            return True
+        
+        self.take_solid_bright_and_dark_field_data()
+        self.calculate_bright_and_dark_levels()
+        self.save_brightness_calibration()
+        return False
 
+    def take_exposure_sweep_data(self, exposures_ms):
+        # Bright and dark field pics at each of exposures_ms. Each field is shown once while only the camera exposure
+        # is switched, and the pics are averaged over tiles as they come in, so memory doesn't grow with the sweep.
+        try:
+            self.turn_on_laser_and_setup_pycromanager()
+            camera_roi = self.pycroInterface.get_camera_roi()
+            
+            self.pycroInterface.ensure_frame_pool(1)
+            
+            tile_levels = {}
+            longest_exposure_means = {}
+            with self.raspiInterface.image_sender() as raspiImageSender:
+                for fill in [1.0, 0.0]:
+                    raspiImageSender.send_image(PatternDescription(fill=fill))
+                    
+                    tile_levels[fill] = []
+                    for exposure_ms in exposures_ms:
+                        # Only the exposure changes, so it's the only setting sent
+                        self.turn_on_laser_and_setup_pycromanager(exposure_ms=exposure_ms)
+                        field_stats = RunningPixelStats()
+                        for cam_pic in self.pycroInterface.stream_pics(self.exposure_sweep_pics_per_exposure):
+                            field_stats.add(cam_pic)
+                        
+                        tile_levels[fill].append(tile_means(field_stats.mean, self.exposure_sweep_tile_size))
+                        if exposure_ms == max(exposures_ms):
+                            longest_exposure_means[fill] = field_stats.mean
+            
+            # The mask is found where the bright field stands out most
+            self._exposure_sweep_illuminated_section_mask = self.illuminated_section_mask_of(
+                longest_exposure_means[1.0], np.average(longest_exposure_means[0.0]), np.average(longest_exposure_means[1.0]))
+            self._exposure_sweep_exposures_ms = list(exposures_ms)
+            self._exposure_sweep_bright_tile_levels = tile_levels[1.0]
+            self._exposure_sweep_dark_tile_levels = tile_levels[0.0]
+            self._exposure_sweep_frame_shape = longest_exposure_means[1.0].shape
+            self._exposure_sweep_camera_roi = camera_roi
+        except Exception as e:
+            raise CalibrationException(str(e))
+        finally:
+            self.turn_off_laser_and_turn_off_shutter()
+    
+    def calculate_exposure_linearity_model(self):
+        if self._exposure_sweep_exposures_ms is None:
+            raise CalibrationException("Cannot fit exposure linearity model until exposure sweep data has been taken")
+        
+        try:
+            model = ExposureLinearityModel(
+                self._exposure_sweep_exposures_ms,
+                self._exposure_sweep_bright_tile_levels,
+                self._exposure_sweep_dark_tile_levels,
+                self.exposure_sweep_tile_size,
+                self._exposure_sweep_frame_shape,
+                )
+        except Exception as e:
+            raise CalibrationException(str(e))
+        
+        if model.max_relative_residual > self.max_exposure_sweep_relative_residual:
+            raise CalibrationException(
+                "Camera levels aren't linear in exposure: a fitted level is off by {} of the bright to dark difference, more than {}. ".format(
+                    model.max_relative_residual, self.max_exposure_sweep_relative_residual) +
+                "Is the camera saturating at the longest exposure?")
+        
+        self._exposure_linearity_model = model
+    
+    def get_exposure_linearity_model(self):
+        return self._exposure_linearity_model
+    
+    def use_exposure_from_linearity_model(self, exposure_ms):
+        # Switches to exposure_ms, with bright and dark levels from the model instead of a new acquisition
+        if self._exposure_linearity_model is None:
+            raise CalibrationException("Cannot use an exposure from the linearity model before it has been fitted")
+        
+        model = self._exposure_linearity_model
+        self.cameraExposureMs = exposure_ms
+        self.release_solid_field_pics()
+        self._bright_level, self._dark_level = model.levels_at(exposure_ms, self._exposure_sweep_illuminated_section_mask)
+        self._illuminated_section_mask = self._exposure_sweep_illuminated_section_mask
+        self._solid_field_camera_roi = self._exposure_sweep_camera_roi
+        self._solid_bright_field_mean = model.bright_field_at(exposure_ms)
+        self._solid_dark_field_mean = model.dark_field_at(exposure_ms)
+    
+    def illuminated_section_camera_roi(self):
+        # Bounding box of the illuminated section mask plus a margin, as a camera ROI in sensor pixels
+        mask_rows = np.flatnonzero(np.any(self._illuminated_section_mask, axis=1))
+        mask_cols = np.flatnonzero(np.any(self._illuminated_section_mask, axis=0))
+        if len(mask_rows) == 0:
+            return None
+        
+        margin = self.illuminated_section_camera_roi_margin
+        top = max(mask_rows[0] - margin, 0)
+        left = max(mask_cols[0] - margin, 0)
+        bottom = min(mask_rows[-1] + 1 + margin, self._illuminated_section_mask.shape[0])
+        right = min(mask_cols[-1] + 1 + margin, self._illuminated_section_mask.shape[1])
+        
+        # The mask is relative to the ROI the solid field pics were taken with
+        solid_field_x, solid_field_y, _, _ = self._solid_field_camera_roi
+        return (solid_field_x + int(left), solid_field_y + int(top), int(right - left), int(bottom - top))
+    
     def create_calibration_positions(self):
         assert int(self.circle_diameter) == self.circle_diameter, "Circle diameter should be integer number of pixels"
         assert self.circle_diameter % 2 == 1, "Calibration circle diameter should be odd"
@@ -183,56 +691,274 @@ class Calibrator:
         
         return x_positions, y_positions
     
-    def create_circle_pattern_at_position(self, x_pos, y_pos):
-        yy,xx = np.meshgrid(np.arange(self.dmd_dims[0]), np.arange(self.dmd_dims[1]))
-        
-        radius = self.circle_diameter / 2 # float - if diameter = 5, radius = 2.5
-        # Mask is true within radius from y_pos, x_pos
-        circle_mask = (yy - y_pos) ** 2 + (xx - x_pos) ** 2 <= radius ** 2
-        
-        pattern = np.zeros(self.dmd_dims, dtype=float)
-        pattern[circle_mask] = 1.0
-        
-        return pattern
+    def create_circles_pattern_description(self, positions):
+        # One circle at each of positions, as (x, y), in the same pattern. The image sender sends this as a
+        # description, so with the display daemon the circles are drawn on the Pi.
+        description = PatternDescription(fill=0.0)
+        for x_pos, y_pos in positions:
+            description.add_circle(x_pos, y_pos, self.circle_diameter)
+        return description
     
     def take_coord_calibration_data(self):
         if self._bright_level is None or self._dark_level is None:
             raise CalibrationException("Must calibrate bright and dark levels before calibrating coordinates")
         
+        coarse_binning = self.coord_calibration_coarse_binning if self.coord_calibration_coarse_binning is not None else 1
+        
+        previous_camera_roi = None
         try:
             self.turn_on_laser_and_setup_pycromanager()
+            previous_camera_roi = self.pycroInterface.get_camera_roi()
+            
+            sensor_roi = None
+            if self.crop_camera_to_illuminated_section and self._illuminated_section_mask is not None:
+                sensor_roi = self.illuminated_section_camera_roi()
             
             with self.raspiInterface.image_sender() as raspiImageSender:
                 # Take calibration data
                 x_positions, y_positions = self.create_calibration_positions()
                 
-                data_taken = []
+                circle_groups = None
+                if self.multiplex_coord_calibration:
+                    circle_groups = self.multiplexed_coord_calibration_circle_groups(
+                        raspiImageSender, x_positions, y_positions, coarse_binning, sensor_roi)
+                
+                if circle_groups is not None:
+                    data_taken = self.snap_coord_calibration_pics(raspiImageSender, circle_groups, coarse_binning, sensor_roi)
+                    data_taken = self.retake_lost_multiplexed_circles(raspiImageSender, circle_groups, data_taken, coarse_binning, sensor_roi)
+                else:
+                    circle_groups = [[(x_pos, y_pos, None)] for y_pos in y_positions for x_pos in x_positions]
+                    data_taken = self.snap_coord_calibration_pics(raspiImageSender, circle_groups, coarse_binning, sensor_roi)
+                
+                if coarse_binning != 1 and self.refine_coord_calibration:
+                    data_taken = self.refine_coord_calibration_pics(raspiImageSender, data_taken, sensor_roi)
                 
-                for y_pos in y_positions:
-                    for x_pos in x_positions:
-                        pattern = self.create_circle_pattern_at_position(x_pos, y_pos)
-                        raspiImageSender.send_image(pattern)
-                        
-                        cam_pic = self.pycroInterface.snap_pic()
-                        data_taken.append({
-                            "dmd_x_pos": x_pos,
-                            "dmd_y_pos": y_pos,
-                            "cam_pic": cam_pic,
-                        })
                 self._dmd_coords_and_acquired_images = data_taken
                 
         except Exception as e:
             raise CalibrationException(str(e))
         finally:
+            # Changing the binning back may reset the ROI, so the ROI is restored last
             self.turn_off_laser_and_turn_off_shutter()
+            if previous_camera_roi is not None:
+                self.pycroInterface.set_camera_roi(*previous_camera_roi)
+    
+    def camera_roi_for_binning(self, sensor_roi, binning):
+        # Camera ROIs are in pixels of the current binning
+        x, y, width, height = sensor_roi
+        binned_x = x // binning
+        binned_y = y // binning
+        return (binned_x, binned_y, -(-(x + width) // binning) - binned_x, -(-(y + height) // binning) - binned_y)
+    
+    def snap_coord_calibration_pics(self, raspiImageSender, circle_groups, binning, sensor_roi):
+        # Shows each group of circles in one pattern and snaps one pic of it. Circles are given as (x_pos, y_pos,
+        # sensor_window), and each gets its own data point, with the pic cropped to its window, as (top, left, bottom,
+        # right) in sensor pixels, or the whole pic if the window is None.
+        self.turn_on_laser_and_setup_pycromanager(binning)
+        if sensor_roi is not None:
+            self.pycroInterface.set_camera_roi(*self.camera_roi_for_binning(sensor_roi, binning))
+        # Read back, since the camera may have adjusted it
+        roi_x, roi_y, _, _ = self.pycroInterface.get_camera_roi()
+        
+        def pattern_of_group(group):
+            return self.create_circles_pattern_description([(x_pos, y_pos) for x_pos, y_pos, _ in group])
+        
+        if self.preload_coord_calibration_patterns:
+            # Generator, so patterns are made one at a time as they're packed for upload
+            raspiImageSender.preload_images(pattern_of_group(group) for group in circle_groups)
+        
+        pipeline_uploads = not self.preload_coord_calibration_patterns and self.pipeline_coord_calibration_uploads
+        if pipeline_uploads and len(circle_groups) > 0:
+            raspiImageSender.stage_image(pattern_of_group(circle_groups[0]))
+        
+        data_taken = []
+        
+        for pattern_idx, group in enumerate(circle_groups):
+            if self.preload_coord_calibration_patterns:
+                raspiImageSender.show_preloaded_image(pattern_idx)
+            elif pipeline_uploads:
+                raspiImageSender.show_staged_image()
+                # Only swapped in by the next show_staged_image, after this snap is done
+                if pattern_idx + 1 < len(circle_groups):
+                    raspiImageSender.stage_image(pattern_of_group(circle_groups[pattern_idx + 1]))
+            else:
+                raspiImageSender.send_image(pattern_of_group(group))
+            
+            group_pic = self.pycroInterface.snap_pic()
+            
+            for x_pos, y_pos, sensor_window in group:
+                # Pixel (0, 0) of cam_pic is at pixel (pic_x, pic_y) of the sensor at this binning
+                cam_pic = group_pic
+                pic_x, pic_y = roi_x, roi_y
+                if sensor_window is not None:
+                    top, left, bottom, right = sensor_window
+                    top, left = max(top // binning - roi_y, 0), max(left // binning - roi_x, 0)
+                    bottom = min(-(-bottom // binning) - roi_y, group_pic.shape[0])
+                    right = min(-(-right // binning) - roi_x, group_pic.shape[1])
+                    if bottom <= top or right <= left:
+                        # Window is off the part of the sensor that's read out
+                        continue
+                    cam_pic = group_pic[top:bottom, left:right].copy()
+                    pic_x, pic_y = roi_x + left, roi_y + top
+                
+                data_taken.append({
+                    "dmd_x_pos": x_pos,
+                    "dmd_y_pos": y_pos,
+                    "cam_pic": cam_pic,
+                    "binning": binning,
+                    "pic_x": pic_x,
+                    "pic_y": pic_y,
+                    "pattern_index": pattern_idx,
+                })
+        
+        return data_taken
+    
+    def coord_calibration_sensor_window(self, sensor_row, sensor_col, sensor_radius):
+        # Window around a circle at (sensor_row, sensor_col), as (top, left, bottom, right) in sensor pixels, big enough
+        # that find_blobs_in_photo doesn't throw the circle out for being near the edge
+        half_window = int(np.ceil(
+            sensor_radius + self.min_blob_distance_to_edge + self.blob_blur_kernel_size(1) // 2 + self.coord_calibration_refine_window_margin))
+        return (
+            int(sensor_row) - half_window,
+            int(sensor_col) - half_window,
+            int(sensor_row) + half_window + 1,
+            int(sensor_col) + half_window + 1,
+        )
+    
+    def refine_coord_calibration_pics(self, raspiImageSender, coarse_data, sensor_roi):
+        # Snaps the circles the coarse pass found on their own again at full resolution, keeping only a window around
+        # each. Circles that were shown together in the coarse pass are shown together again.
+        circle_groups = {}
+        for data_pt in coarse_data:
+            found_blobs = self.find_blobs_in_photo(data_pt["cam_pic"], data_pt["binning"])
+            if len(found_blobs) != 1:
+                continue
+            
+            sensor_row, sensor_col = self.sensor_position_of_blob(found_blobs[0], data_pt)
+            sensor_radius = np.sqrt(found_blobs[0]["area"] / np.pi) * data_pt["binning"]
+            circle_groups.setdefault(data_pt["pattern_index"], []).append((
+                data_pt["dmd_x_pos"],
+                data_pt["dmd_y_pos"],
+                self.coord_calibration_sensor_window(sensor_row, sensor_col, sensor_radius),
+            ))
+        
+        return self.snap_coord_calibration_pics(raspiImageSender, list(circle_groups.values()), 1, sensor_roi)
+    
+    def multiplexed_coord_calibration_circle_groups(self, raspiImageSender, x_positions, y_positions, binning, sensor_roi):
+        # Splits the grid into groups of circles to show in one pattern each: every stride-th circle along each axis,
+        # with stride just big enough that the windows around the circles in a group can't overlap on the sensor. Where
+        # a circle lands on the sensor, and so which found blob is which circle, comes from the affine transform of three
+        # neighbouring circles in the middle of the grid, snapped one at a time first. Returns None when multiplexing
+        # isn't possible, for taking one circle per pattern instead.
+        n_x, n_y = len(x_positions), len(y_positions)
+        if n_x < 2 or n_y < 2:
+            print("Coordinate calibration grid is {}x{}, not multiplexing circles".format(n_x, n_y))
+            return None
+        
+        x_idx, y_idx = (n_x - 1) // 2, (n_y - 1) // 2
+        seed_positions = [
+            (x_positions[x_idx], y_positions[y_idx]),
+            (x_positions[x_idx + 1], y_positions[y_idx]),
+            (x_positions[x_idx], y_positions[y_idx + 1]),
+        ]
+        seed_data = self.snap_coord_calibration_pics(
+            raspiImageSender, [[(x_pos, y_pos, None)] for x_pos, y_pos in seed_positions], binning, sensor_roi)
+        
+        seed_sensor_positions = []
+        sensor_radius = 0
+        for data_pt in seed_data:
+            found_blobs = self.find_blobs_in_photo(data_pt["cam_pic"], data_pt["binning"])
+            if len(found_blobs) != 1:
+                print("Found {} blobs for circle at DMD coords {}, {}, not multiplexing circles".format(
+                    len(found_blobs), data_pt["dmd_x_pos"], data_pt["dmd_y_pos"]))
+                return None
+            seed_sensor_positions.append(self.sensor_position_of_blob(found_blobs[0], data_pt))
+            sensor_radius = max(sensor_radius, np.sqrt(found_blobs[0]["area"] / np.pi) * data_pt["binning"])
+        
+        # DMD (x, y) to sensor (row, column)
+        A, b = best_fit_affine_transform(np.array(seed_positions).T, np.array(seed_sensor_positions).T)
+        
+        # Circles in a group are at least stride grid steps apart along some axis, so at least this far apart on the sensor
+        grid_step = min(np.min(np.diff(x_positions)), np.min(np.diff(y_positions)))
+        min_sensor_distance_per_step = grid_step * np.min(np.linalg.svd(A, compute_uv=False))
+        window_top, _, window_bottom, _ = self.coord_calibration_sensor_window(0, 0, sensor_radius)
+        stride = max(1, int(np.ceil((window_bottom - window_top) / min_sensor_distance_per_step)))
+        if stride >= n_x and stride >= n_y:
+            print("Circles have to be {} grid steps apart, not multiplexing circles".format(stride))
+            return None
+        
+        circle_groups = []
+        for y_offset in range(stride):
+            for x_offset in range(stride):
+                group = []
+                for y_pos in y_positions[y_offset::stride]:
+                    for x_pos in x_positions[x_offset::stride]:
+                        sensor_row, sensor_col = A @ np.array([x_pos, y_pos]) + b[:, 0]
+                        group.append((x_pos, y_pos, self.coord_calibration_sensor_window(sensor_row, sensor_col, sensor_radius)))
+                if len(group) > 0:
+                    circle_groups.append(group)
+        
+        print("Multiplexing {} calibration circles into {} patterns, every {} grid steps".format(n_x * n_y, len(circle_groups), stride))
+        return circle_groups
     
-    def find_blobs_in_photo(self, cam_pic):
+    def retake_lost_multiplexed_circles(self, raspiImageSender, circle_groups, multiplexed_data, binning, sensor_roi):
+        # A circle is lost from a multiplexed pattern when its window doesn't hold exactly one blob, like when it lands
+        # further from where the seed circles' transform puts it than the window's margin. Counts the lost circles of
+        # each pattern and snaps them again one per pattern, as without multiplexing, in place of their windows.
+        found_circles = set()
+        found_data = []
+        for data_pt in multiplexed_data:
+            if len(self.find_blobs_in_photo(data_pt["cam_pic"], data_pt["binning"])) == 1:
+                found_circles.add((data_pt["pattern_index"], data_pt["dmd_x_pos"], data_pt["dmd_y_pos"]))
+                found_data.append(data_pt)
+        
+        lost_positions = []
+        for pattern_idx, group in enumerate(circle_groups):
+            group_lost_positions = [(x_pos, y_pos) for x_pos, y_pos, _ in group if (pattern_idx, x_pos, y_pos) not in found_circles]
+            if len(group_lost_positions) > 0:
+                print("Lost {} of {} circles in multiplexed calibration pattern {}".format(len(group_lost_positions), len(group), pattern_idx))
+            lost_positions += group_lost_positions
+        
+        if len(lost_positions) == 0:
+            return multiplexed_data
+        
+        print("Warning: lost {} of {} calibration circles while multiplexing, snapping them one per pattern".format(
+            len(lost_positions), sum(len(group) for group in circle_groups)))
+        retaken_data = self.snap_coord_calibration_pics(
+            raspiImageSender, [[(x_pos, y_pos, None)] for x_pos, y_pos in lost_positions], binning, sensor_roi)
+        # Numbered after the multiplexed patterns, so the refinement pass doesn't show them together with those
+        for data_pt in retaken_data:
+            data_pt["pattern_index"] += len(circle_groups)
+        
+        return found_data + retaken_data
+    
+    def sensor_position_of_blob(self, blob, data_pt):
+        # Position of a blob found in a calibration pic, as (row, column) in full resolution sensor pixels. cx is along
+        # the pic's rows and cy along its columns, since find_blobs_in_photo swaps the axes for cv2. A binned pixel i
+        # covers sensor pixels i * b to i * b + b - 1, so its centre is at i * b + (b - 1) / 2.
+        binning = data_pt["binning"]
+        sensor_row = (blob["cx"] + data_pt["pic_y"]) * binning + (binning - 1) / 2
+        sensor_col = (blob["cy"] + data_pt["pic_x"]) * binning + (binning - 1) / 2
+        return sensor_row, sensor_col
+    
+    def blob_blur_kernel_size(self, binning):
+        # circle_identification_gaussian_blur_sigma is in full resolution pixels, and cv2 needs an odd kernel size
+        return int(self.circle_identification_gaussian_blur_sigma / binning) // 2 * 2 + 1
+    
+    def blob_threshold(self, binning):
+        # Halfway between the dark and bright levels in a binned pic. The exposure is cut by binning * binning, so the
+        # light collected per binned pixel is the same as unbinned, but the camera's offset is summed over the
+        # binning * binning pixels. Treats all of the dark level as offset, which puts the threshold a little high
+        # when some of it is light, instead of below the dark level.
+        return binning ** 2 * self._dark_level + (self._bright_level - self._dark_level) / 2
+    
+    def find_blobs_in_photo(self, cam_pic, binning=1):
         # Change coordinate order to match the x,y order used by cv2
         cv2_image = np.swapaxes(cam_pic, 0, 1)
-        thresh = (self._bright_level + self._dark_level) / 2
+        thresh = self.blob_threshold(binning)
         
-        sig = self.circle_identification_gaussian_blur_sigma
-        blurred = cv2.GaussianBlur(cv2_image, (sig, sig), 0)
+        kernel_size = self.blob_blur_kernel_size(binning)
+        blurred = cv2.GaussianBlur(cv2_image, (kernel_size, kernel_size), 0)
         above_thresh = np.uint8(blurred > thresh)
         
         img_contours, _ = cv2.findContours(above_thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)        
@@ -255,11 +981,13 @@ class Calibrator:
 
             x_min, y_min, x_width, y_height = cv2.boundingRect(contour)
 
+            # cv2's x runs along the columns of cv2_image, its second axis, and y along its first
+            min_distance_to_edge = self.min_blob_distance_to_edge / binning
             is_touching_edge = (
-                (x_min <= self.min_blob_distance_to_edge) or
-                (y_min <= self.min_blob_distance_to_edge) or
-                (x_min + x_width - 1 >= cv2_image.shape[0] - self.min_blob_distance_to_edge) or
-                (y_min + y_height - 1 >= cv2_image.shape[1] - self.min_blob_distance_to_edge)
+                (x_min <= min_distance_to_edge) or
+                (y_min <= min_distance_to_edge) or
+                (x_min + x_width - 1 >= cv2_image.shape[1] - min_distance_to_edge) or
+                (y_min + y_height - 1 >= cv2_image.shape[0] - min_distance_to_edge)
                 )
                 
             if is_touching_edge:
@@ -293,13 +1021,13 @@ class Calibrator:
             dmd_y = data_pt["dmd_y_pos"]
             cam_pic = data_pt["cam_pic"]
             
-            found_blobs = self.find_blobs_in_photo(cam_pic)
+            found_blobs = self.find_blobs_in_photo(cam_pic, data_pt["binning"])
             
-            if len(found_blobs) != 0:
+            if len(found_blobs) != 1:
                 continue
             
-            cam_x = found_blobs[0]["cx"]
-            cam_y = found_blobs[0]["cy"]
+            # Pics may be binned or cover only part of the sensor, positions are mapped back to full resolution
+            cam_x, cam_y = self.sensor_position_of_blob(found_blobs[0], data_pt)
             coord_pairs.append({
                 "cam_x": cam_x,
                 "cam_y": cam_y,
@@ -307,6 +1035,12 @@ class Calibrator:
                 "dmd_y": dmd_y,
             })
         
+        # An affine transform has 6 parameters, so it needs at least 3 points
+        if len(coord_pairs) < 3:
+            raise CalibrationException(
+                "Found a single calibration circle in only {} of {} pics, need at least 3 to fit the coordinate transform".format(
+                    len(coord_pairs), len(self._dmd_coords_and_acquired_images)))
+        
         dmd_coords = [[p["dmd_x"], p["dmd_y"]] for p in coord_pairs]
         cam_coords = [[p["cam_x"], p["cam_y"]] for p in coord_pairs]
         
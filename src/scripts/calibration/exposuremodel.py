@@ -0,0 +1,70 @@
+import numpy as np
+
+def tile_sums(frame, tile_size):
+    # Sums of frame over tile_size x tile_size tiles, the last row and column of tiles cut short by the frame's edges
+    row_sums = np.add.reduceat(frame, np.arange(0, frame.shape[0], tile_size), axis=0)
+    return np.add.reduceat(row_sums, np.arange(0, frame.shape[1], tile_size), axis=1)
+
+def tile_means(frame, tile_size):
+    return tile_sums(frame, tile_size) / tile_sums(np.ones(frame.shape), tile_size)
+
+class ExposureLinearityModel:
+    # Per-tile straight line fit of camera level against exposure time, for the solid bright and dark fields, so
+    # levels at any exposure come from the fit instead of a new acquisition:
+    #   level(exposure_ms) = offset + gain * exposure_ms
+    # The offset is mostly the camera's bias and the gain the light falling on the tile, plus dark current.
+    def __init__(self, exposures_ms, bright_tile_levels, dark_tile_levels, tile_size, frame_shape):
+        # bright_tile_levels and dark_tile_levels hold tile_means of an average pic of each field at each of exposures_ms
+        if len(exposures_ms) < 2:
+            raise Exception("Need at least 2 exposures to fit a linearity model, received {}".format(len(exposures_ms)))
+        if len(set(exposures_ms)) != len(exposures_ms):
+            raise Exception("Exposures for a linearity model should be different, received {}".format(exposures_ms))
+        
+        self.exposures_ms = np.array(exposures_ms, dtype=float)
+        self.tile_size = tile_size
+        self.frame_shape = tuple(frame_shape)
+        self.tile_pixel_counts = tile_sums(np.ones(self.frame_shape), tile_size)
+        
+        bright_tile_levels = np.asarray(bright_tile_levels, dtype=float)
+        dark_tile_levels = np.asarray(dark_tile_levels, dtype=float)
+        self.bright_offsets, self.bright_gains, bright_residuals = self.fit_tiles(bright_tile_levels)
+        self.dark_offsets, self.dark_gains, dark_residuals = self.fit_tiles(dark_tile_levels)
+        
+        # Largest difference between a tile's fitted and measured level, relative to the largest bright to dark
+        # difference measured, as a check on how linear the camera is
+        bright_to_dark = np.max(bright_tile_levels - dark_tile_levels)
+        self.max_relative_residual = max(np.max(np.abs(bright_residuals)), np.max(np.abs(dark_residuals))) / bright_to_dark
+    
+    def fit_tiles(self, tile_levels):
+        if tile_levels.shape != (len(self.exposures_ms),) + self.tile_pixel_counts.shape:
+            raise Exception("Tile levels should have shape {}, received {}".format(
+                (len(self.exposures_ms),) + self.tile_pixel_counts.shape, tile_levels.shape))
+        
+        # Least squares for every tile at once, one row per exposure
+        design = np.stack([np.ones(len(self.exposures_ms)), self.exposures_ms], axis=1)
+        coefficients = np.linalg.lstsq(design, tile_levels.reshape(len(self.exposures_ms), -1), rcond=None)[0]
+        
+        offsets = coefficients[0].reshape(self.tile_pixel_counts.shape)
+        gains = coefficients[1].reshape(self.tile_pixel_counts.shape)
+        residuals = tile_levels - (offsets + gains * self.exposures_ms[:, np.newaxis, np.newaxis])
+        return offsets, gains, residuals
+    
+    def tiles_to_frame(self, tiles):
+        return np.repeat(np.repeat(tiles, self.tile_size, axis=0), self.tile_size, axis=1)[:self.frame_shape[0], :self.frame_shape[1]]
+    
+    def bright_field_at(self, exposure_ms):
+        return self.tiles_to_frame(self.bright_offsets + self.bright_gains * exposure_ms)
+    
+    def dark_field_at(self, exposure_ms):
+        return self.tiles_to_frame(self.dark_offsets + self.dark_gains * exposure_ms)
+    
+    def levels_at(self, exposure_ms, illuminated_section_mask):
+        # Bright and dark levels as calculate_bright_and_dark_levels finds them: the bright field's average within the
+        # illuminated section and the dark field's average everywhere
+        masked_pixel_counts = tile_sums(illuminated_section_mask.astype(float), self.tile_size)
+        if np.sum(masked_pixel_counts) == 0:
+            raise Exception("Illuminated section mask is empty")
+        
+        bright_level = np.sum(masked_pixel_counts * (self.bright_offsets + self.bright_gains * exposure_ms)) / np.sum(masked_pixel_counts)
+        dark_level = np.sum(self.tile_pixel_counts * (self.dark_offsets + self.dark_gains * exposure_ms)) / np.sum(self.tile_pixel_counts)
+        return bright_level, dark_level
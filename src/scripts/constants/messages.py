@@ -18,6 +18,7 @@ class Messages:
     button_label_calibrate_dmd = "Calibrate DMD Geometry"
     exposure_ms_label = "Exposure (ms)"
     begin = "Begin"
+    button_label_auto_exposure = "Auto exposure"
     enter_raspi_ssh_login_creds = "Enter Raspi SSH login Credentials"
     connection_failed_title = "Connection Failed"
     invalid_field_title = "Invalid Field"
@@ -33,4 +34,5 @@ class Messages:
     dark_level = "Dark Level"
     button_label_begin_coord_calibration = "Begin coord calibration"
     done_calibrating_brightness = "Done calibrating brightness"
+    reused_cached_brightness_calibration = "Brightness unchanged since last calibration, reused cached levels"
     displaying_calibration_circle_at_dmd_coords = "Displaying calibration circle at DMD coords"
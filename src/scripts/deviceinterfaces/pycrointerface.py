@@ -1,5 +1,6 @@
 import pycromanager
 import numpy as np
+import time
 import random
 import math
 from skimage.draw import polygon
@@ -7,6 +8,59 @@ from skimage.draw import polygon
 class PycroConnectionError(Exception):
     pass
 
+def strings_of_java_vector(java_str_vector):
+    # toArray comes over the bridge as a list in one call, instead of a call per element with get(i)
+    return list(java_str_vector.to_array())
+
+class FramePool:
+    # Preallocated uint16 frames for camera acquisitions, so long acquisitions write into the same memory over and over
+    # instead of allocating a new array per frame. Frames are taken in contiguous blocks, so a block is a single
+    # (n, h, w) view of the pool that can be averaged or stacked without copying.
+    def __init__(self, n_frames, frame_h, frame_w):
+        self.frame_shape = (frame_h, frame_w)
+        self.frames = np.zeros((n_frames, frame_h, frame_w), dtype=np.uint16)
+        self.slot_in_use = np.zeros(n_frames, dtype=bool)
+    
+    def n_free_frames(self):
+        return int(np.count_nonzero(~self.slot_in_use))
+    
+    def acquire_frames(self, n_frames):
+        # First contiguous run of n_frames free slots
+        run_start = 0
+        for slot in range(len(self.slot_in_use) + 1):
+            if slot - run_start == n_frames:
+                self.slot_in_use[run_start:slot] = True
+                return PooledFrames(self, run_start, n_frames)
+            if slot < len(self.slot_in_use) and self.slot_in_use[slot]:
+                run_start = slot + 1
+        
+        raise Exception("Frame pool has no run of {} free frames, {} of {} frames are free".format(
+            n_frames, self.n_free_frames(), len(self.slot_in_use)))
+    
+    def release_frames(self, start_slot, n_frames):
+        self.slot_in_use[start_slot:start_slot + n_frames] = False
+
+
+class PooledFrames:
+    # Handle to a block of frames in a FramePool. frames is a view into the pool, which is only valid until release
+    # is called, after which the pool hands the memory out again.
+    def __init__(self, frame_pool, start_slot, n_frames):
+        self.frame_pool = frame_pool
+        self.start_slot = start_slot
+        self.frames = frame_pool.frames[start_slot:start_slot + n_frames]
+        self.released = False
+    
+    def __len__(self):
+        return len(self.frames)
+    
+    def release(self):
+        if self.released:
+            return
+        self.frame_pool.release_frames(self.start_slot, len(self.frames))
+        self.frames = None
+        self.released = True
+
+
 class StandInPycroInterface:
     def __init__(self):
         self.cam_h = 2000
@@ -18,10 +72,21 @@ class StandInPycroInterface:
         self.field_center_y = self.cam_h / 2
         self.field_center_x = self.cam_w / 2
 
+        # Field levels at reference_exposure_ms, they scale with the exposure
         self.bright_level = 2000
         self.dark_level = 100
+        self.reference_exposure_ms = 10
+        self.exposure_ms = 10
 
         self.pretend_image = None
+        
+        self.frame_pool = None
+        # Camera ROI as (x, y, width, height) in binned pixels, None for the full sensor
+        self.camera_roi = None
+        self.binning = 1
+        pass
+    
+    def invalidate_applied_settings(self):
         pass
     
     def make_field_mask(self):
@@ -68,23 +133,65 @@ class StandInPycroInterface:
             im =  self.generate_background_noise()
         elif self.pretend_image == "solid white":
             print("Making placeholder solid bright field image")
-            im = self.make_field_mask().astype(float) * self.bright_level
+            im = self.make_field_mask().astype(float) * self.bright_level * self.exposure_ms / self.reference_exposure_ms
             im += self.generate_background_noise()
             # return im
         elif self.pretend_image == "solid black":
             print("Making placeholder solid dark field image")
-            im = self.make_field_mask().astype(float) * self.dark_level
+            im = self.make_field_mask().astype(float) * self.dark_level * self.exposure_ms / self.reference_exposure_ms
             im += self.generate_background_noise()
         else:
             raise Exception("Unknown pretend image type '{}'".format(self.pretend_image))
         
-        im = im.astype(np.uint16)
+        if self.binning != 1:
+            # Sums each binning x binning block, like the camera does
+            b = self.binning
+            im = im[:im.shape[0] // b * b, :im.shape[1] // b * b]
+            im = im.reshape(im.shape[0] // b, b, im.shape[1] // b, b).sum(axis=(1, 3))
+        
+        im = np.clip(im, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+        if self.camera_roi is not None:
+            x, y, width, height = self.camera_roi
+            im = im[y:y + height, x:x + width]
         return im
 
         # mask = self.make_field_mask()
 
         # return dat
     
+    def get_camera_roi(self):
+        if self.camera_roi is None:
+            # snap_pic makes frames of shape (cam_w, cam_h)
+            return (0, 0, self.cam_h // self.binning, self.cam_w // self.binning)
+        return self.camera_roi
+    
+    def set_camera_roi(self, x, y, width, height):
+        self.camera_roi = (x, y, width, height)
+    
+    def get_camera_saturation_level(self):
+        return np.iinfo(np.uint16).max
+    
+    def camera_frame_shape(self):
+        x, y, width, height = self.get_camera_roi()
+        return (height, width)
+    
+    def allocate_frame_pool(self, n_frames):
+        self.frame_pool = FramePool(n_frames, *self.camera_frame_shape())
+    
+    def ensure_frame_pool(self, n_frames):
+        if self.frame_pool is None or self.frame_pool.frame_shape != self.camera_frame_shape() or self.frame_pool.n_free_frames() < n_frames:
+            self.allocate_frame_pool(n_frames)
+    
+    def snap_pics_into_pool(self, n_pics):
+        pooled_frames = self.frame_pool.acquire_frames(n_pics)
+        for frame in pooled_frames.frames:
+            frame[:] = self.snap_pic()
+        return pooled_frames
+    
+    def stream_pics(self, n_pics):
+        for i in range(n_pics):
+            yield self.snap_pic()
+    
     def standin_pretend_solid_white(self):
         self.pretend_image = "solid white"
         # self.pretend
@@ -103,7 +210,12 @@ class StandInPycroInterface:
         sapphireSetpoint="10",
         exposureMs=10,
     ):
-        pass
+        self.exposure_ms = exposureMs
+        binning = int(binning.split("x")[0])
+        if binning != self.binning:
+            # Cameras drop their ROI when the binning changes
+            self.binning = binning
+            self.camera_roi = None
     # def check_camera_res
 
 class PycroInterface:
@@ -114,6 +226,16 @@ class PycroInterface:
     sapphireOnOverride_group_presets = ["on", "off"]
     sapphire_power_setpoint_group_presets = ["10", "60", "110"]
     
+    # Presets check_configuration_groups expects in each config group, and what to call them in errors
+    expected_group_presets = {
+        "FilterWheel": (filt_group_presets, "filter wheel setting"),
+        "LightEnginePower": (lightengine_group_presets, "light engine setting"),
+        "MultiShutterMembers": (multishutter_group_presets, "multishutter group setting"),
+        "SapphireMinAndMaxPower": (sapphire_group_presets, "SapphireMinAndMaxPower group setting"),
+        "SapphireOnOverride": (sapphireOnOverride_group_presets, "SapphireOnOverride setting"),
+        "SapphirePowerSetpoint": (sapphire_power_setpoint_group_presets, "SapphirePowerSetpoint setting"),
+    }
+    
     def __init__(self):
         try:
             self.core = pycromanager.Core()
@@ -123,6 +245,16 @@ class PycroInterface:
         self.check_configuration_groups()
 
         self.camera_device_name = self.core.get_camera_device()
+        
+        # How long sequence_acquisition waits for the next frame of a burst before giving up, on top of the exposure time
+        self.sequence_frame_timeout_s = 5.0
+        
+        # FramePool for snap_pics_into_pool, see allocate_frame_pool
+        self.frame_pool = None
+        
+        # Settings last sent to Micro-Manager by set_imaging_settings_for_acquisition, by name, so unchanged ones
+        # aren't sent again. Has to be cleared with invalidate_applied_settings if they're changed from anywhere else.
+        self.applied_settings = {}
 
         # print(self.check_camera_res())
 
@@ -131,7 +263,104 @@ class PycroInterface:
     
     def snap_pic(self):
         self.core.snap_image()
-        tagged_image = self.core.get_tagged_image()
+        return self.pixels_of_tagged_image(self.core.get_tagged_image())
+    
+    def sequence_acquisition(self, n_pics, pop_next):
+        # Generator of the n_pics images of a sequence acquisition, popped from the circular buffer with pop_next as
+        # they arrive. The camera exposes them back to back and the shutter opens once, instead of a snap_image and
+        # get_tagged_image round trip over the Java bridge for each frame.
+        if n_pics == 0:
+            return
+        
+        self.core.clear_circular_buffer()
+        self.core.start_sequence_acquisition(n_pics, 0, True)
+        
+        n_popped = 0
+        try:
+            frame_timeout_s = self.core.get_exposure() / 1000 + self.sequence_frame_timeout_s
+            last_frame_time = time.perf_counter()
+            while n_popped < n_pics:
+                if self.core.get_remaining_image_count() > 0:
+                    yield pop_next()
+                    n_popped += 1
+                    last_frame_time = time.perf_counter()
+                elif not self.core.is_sequence_running() and self.core.get_remaining_image_count() == 0:
+                    raise PycroConnectionError("Camera sequence acquisition stopped after {} of {} images".format(n_popped, n_pics))
+                elif time.perf_counter() - last_frame_time > frame_timeout_s:
+                    raise PycroConnectionError("Timed out waiting for image {} of {} from camera sequence acquisition".format(n_popped + 1, n_pics))
+                else:
+                    time.sleep(0.001)
+        finally:
+            if self.core.is_sequence_running():
+                self.core.stop_sequence_acquisition()
+    
+    def get_camera_roi(self):
+        # (x, y, width, height) of the part of the sensor that's read out, in pixels of the current binning
+        roi = self.core.get_roi()
+        return (int(roi.x), int(roi.y), int(roi.width), int(roi.height))
+    
+    def set_camera_roi(self, x, y, width, height):
+        # The camera may round the ROI to its own constraints, so callers should read it back with get_camera_roi
+        self.core.set_roi(int(x), int(y), int(width), int(height))
+    
+    def get_camera_saturation_level(self):
+        # Highest pixel value the camera reads out. Frames are always uint16, but a 12 bit camera saturates at 4095.
+        return 2 ** int(self.core.get_image_bit_depth()) - 1
+    
+    def camera_frame_shape(self):
+        # (height, width) of the images the camera makes with its current binning and ROI
+        return (int(self.core.get_image_height()), int(self.core.get_image_width()))
+    
+    def allocate_frame_pool(self, n_frames):
+        # Sized once from the camera's current resolution. Has to be allocated again if the binning or ROI changes,
+        # see ensure_frame_pool.
+        self.frame_pool = FramePool(n_frames, *self.camera_frame_shape())
+    
+    def ensure_frame_pool(self, n_frames):
+        # Allocates the frame pool again unless it has n_frames free frames of the camera's current frame shape. Frames
+        # still held from an old pool stay valid, they're just not handed out again.
+        if self.frame_pool is None or self.frame_pool.frame_shape != self.camera_frame_shape() or self.frame_pool.n_free_frames() < n_frames:
+            self.allocate_frame_pool(n_frames)
+    
+    def snap_pics_into_pool(self, n_pics):
+        # Takes n_pics frames in one sequence acquisition, written into a block of the frame pool, and returns its
+        # PooledFrames handle, to be released once the frames aren't needed. Uses the raw image calls, so no tag
+        # metadata is parsed per frame.
+        if self.frame_pool is None:
+            raise Exception("Should call allocate_frame_pool before snap_pics_into_pool")
+        
+        pooled_frames = self.frame_pool.acquire_frames(n_pics)
+        try:
+            for frame, pix in zip(pooled_frames.frames, self.sequence_acquisition(n_pics, self.core.pop_next_image)):
+                if pix.size != frame.size:
+                    raise PycroConnectionError("Camera image has {} pixels, frame pool expects {}x{}, camera binning or ROI may have changed".format(
+                        pix.size, frame.shape[0], frame.shape[1]))
+                frame[:] = np.reshape(pix, frame.shape)
+        except:
+            pooled_frames.release()
+            raise
+        
+        return pooled_frames
+    
+    def stream_pics(self, n_pics):
+        # Generator of the n_pics frames of a sequence acquisition as they arrive, each one yielded in the same frame
+        # pool slot, so it's only valid until the next one. For processing frames without keeping them.
+        if self.frame_pool is None:
+            raise Exception("Should call allocate_frame_pool before stream_pics")
+        
+        pooled_frames = self.frame_pool.acquire_frames(1)
+        try:
+            frame = pooled_frames.frames[0]
+            for pix in self.sequence_acquisition(n_pics, self.core.pop_next_image):
+                if pix.size != frame.size:
+                    raise PycroConnectionError("Camera image has {} pixels, frame pool expects {}x{}, camera binning or ROI may have changed".format(
+                        pix.size, frame.shape[0], frame.shape[1]))
+                frame[:] = np.reshape(pix, frame.shape)
+                yield frame
+        finally:
+            pooled_frames.release()
+    
+    def pixels_of_tagged_image(self, tagged_image):
         pixels = np.reshape(tagged_image.pix, newshape=[tagged_image.tags['Height'], tagged_image.tags['Width']])
 
         assert pixels.dtype == np.uint16, "Expecting the raw image from micromanager to be 16 bit integer format"
@@ -170,89 +399,44 @@ class PycroInterface:
             raise Exception("Invalid SapphirePowerSetpoint preset '{}': must be from list '{}'".format(sapphireSetpoint, self.sapphire_power_setpoint_group_presets))
         
 
-        self.core.set_auto_shutter(autoShutter)
-        self.core.set_shutter_device("Multi Shutter")
-        self.core.set_property(self.camera_device_name, "Binning", binning)
-        self.core.set_config("SapphireOnOverride", sapphireOnOverride)
-        self.core.set_config("MultiShutterMembers", multishutterPreset)
-        self.core.set_exposure(exposureMs)
+        n_changed = 0
+        n_changed += self.apply_setting("autoShutter", autoShutter, self.core.set_auto_shutter)
+        n_changed += self.apply_setting("shutterDevice", "Multi Shutter", self.core.set_shutter_device)
+        # Changing the binning can make the camera reallocate its buffers, so it's the one most worth skipping
+        n_changed += self.apply_setting("binning", binning, lambda value: self.core.set_property(self.camera_device_name, "Binning", value))
+        n_changed += self.apply_setting("SapphireOnOverride", sapphireOnOverride, lambda value: self.core.set_config("SapphireOnOverride", value))
+        n_changed += self.apply_setting("MultiShutterMembers", multishutterPreset, lambda value: self.core.set_config("MultiShutterMembers", value))
+        n_changed += self.apply_setting("exposureMs", exposureMs, self.core.set_exposure)
 
-        print("Set imaging settings")
+        print("Set imaging settings, {} changed".format(n_changed))
+    
+    def apply_setting(self, name, value, set_fn):
+        # Calls set_fn(value) unless value was the last one applied. Returns whether it was called.
+        if name in self.applied_settings and self.applied_settings[name] == value:
+            return False
+        
+        # Forgotten first, so a failed call doesn't leave a stale value behind
+        self.applied_settings.pop(name, None)
+        set_fn(value)
+        self.applied_settings[name] = value
+        return True
+    
+    def invalidate_applied_settings(self):
+        # For when settings may have been changed outside this interface, like in the Micro-Manager GUI. The next call
+        # to set_imaging_settings_for_acquisition sends everything again.
+        self.applied_settings = {}
 
         
     def check_configuration_groups(self):
-        java_conf_names = self.core.get_available_config_groups()
-        conf_names = [java_conf_names.get(i) for i in range(java_conf_names.size())]
+        conf_names = strings_of_java_vector(self.core.get_available_config_groups())
         print("Configuration groups: {}".format(str(conf_names)))
 
-        expected_names = [
-            "FilterWheel",
-            "LightEnginePower",
-            "MultiShutterMembers",
-            "SapphireMinAndMaxPower",
-            "SapphireOnOverride",
-            "SapphirePowerSetpoint",
-            ]
-        
-        for exp_name in expected_names:
+        for exp_name in self.expected_group_presets:
             if exp_name not in conf_names:
                 raise PycroConnectionError("Missing config group '{}', could not find in Micromanager".format(exp_name))
         
-
-        java_filt_settings = self.core.get_available_configs("FilterWheel")
-        mm_filt_wheel_settings = [java_filt_settings.get(i) for i in range(java_filt_settings.size())]
-
-        
-        for f_set in self.filt_group_presets:
-            if f_set not in mm_filt_wheel_settings:
-                raise PycroConnectionError("Micromanager is missing filter wheel setting '{}'".format(f_set))
-        
-        
-        java_lightengine_sets = self.core.get_available_configs("LightEnginePower")
-        mm_lightengine_sets = [java_lightengine_sets.get(i) for i in range(java_lightengine_sets.size())]
-
-        
-        for l_set in self.lightengine_group_presets:
-            if l_set not in mm_lightengine_sets:
-                raise PycroConnectionError("Micromanager is missing light engine setting '{}'".format(l_set))
-        
-
-        java_multishutter_sets = self.core.get_available_configs("MultiShutterMembers")
-        mm_multishutter_settings = [java_multishutter_sets.get(i) for i in range(java_multishutter_sets.size())]
-
-        
-        for m_set in self.multishutter_group_presets:
-            if m_set not in mm_multishutter_settings:
-                raise PycroConnectionError("Micromanager is missing multishutter group setting '{}'".format(m_set))
-        
-
-        java_sapphire_minmax_sets = self.core.get_available_configs("SapphireMinAndMaxPower")
-        mm_sapphire_minmax_sets = [java_sapphire_minmax_sets.get(i) for i in range(java_sapphire_minmax_sets.size())]
-        
-        
-        for s_set in self.sapphire_group_presets:
-            if s_set not in mm_sapphire_minmax_sets:
-                raise PycroConnectionError("Micromanager is missing SapphireMinAndMaxPower group setting '{}'".format(s_set))
-        
-
-        java_sapphireOnOverride = self.core.get_available_configs("SapphireOnOverride")
-        mm_sapphireOnOverride_sets = [java_sapphireOnOverride.get(i) for i in range(java_sapphireOnOverride.size())]
-
-        
-        for s_on_set in self.sapphireOnOverride_group_presets:
-            if s_on_set not in mm_sapphireOnOverride_sets:
-                raise PycroConnectionError("Micromanager is missing SapphireOnOverride setting '{}'".format(s_on_set))
-        
-
-        java_sapphire_power_setpoint_sets = self.core.get_available_configs("SapphirePowerSetpoint")
-        mm_sapphire_power_setpoint_sets = [java_sapphire_power_setpoint_sets.get(i) for i in range(java_sapphire_power_setpoint_sets.size())]
-        
-        
-        for s_power_set in self.sapphire_power_setpoint_group_presets:
-            if s_power_set not in mm_sapphire_power_setpoint_sets:
-                raise PycroConnectionError("Micromanager is missing SapphirePowerSetpoint setting '{}'".format(s_power_set))
-        
-        
-        
-        
-        
+        for group_name, (expected_presets, setting_description) in self.expected_group_presets.items():
+            mm_presets = strings_of_java_vector(self.core.get_available_configs(group_name))
+            for preset in expected_presets:
+                if preset not in mm_presets:
+                    raise PycroConnectionError("Micromanager is missing {} '{}'".format(setting_description, preset))
@@ -1,28 +1,341 @@
 import paramiko
 import json
 import time
+import io
+import hashlib
+import tarfile
+import threading
 import numpy as np
 import os
 import tifffile
 
+# Only needed to write zstd compressed TIFFs
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
 from ..constants import DmdConstants
+from .. import raspidisplay
+from ..raspidisplay import read_message, write_message, encode_pattern, encode_pattern_rects, pattern_format_of_frame, PatternDescription
+
+def is_binary_pattern(np_img):
+    if np_img.dtype == bool:
+        return True
+    return bool(np.all((np_img == 0) | (np_img == 1)))
 
-def save_local_img_for_dmd(np_float_img, path):
-    assert np_float_img.dtype == float, "Image should be float array"
-    assert np.all(np_float_img >= 0), "Image should have no negative brightness values"
-    assert np.all(np_float_img <= 1), "Image should have no brightness values greater than 1"
+def convert_img_for_dmd(np_img, pattern_format="auto"):
+    # Validates a pattern and converts it to the frame that gets sent in the given format: bool for "bits",
+    # uint8 for "uint8" and uint16 for "uint16". "auto" sends strictly binary patterns as "bits" and
+    # anything else as "uint8".
+    assert np_img.dtype == float or np_img.dtype == bool, "Image should be float or bool array"
+    if np_img.dtype == float:
+        assert np.all(np_img >= 0), "Image should have no negative brightness values"
+        assert np.all(np_img <= 1), "Image should have no brightness values greater than 1"
     
     expected_arr_shape = (DmdConstants.DMD_H, DmdConstants.DMD_W)
-    if  np_float_img.shape != expected_arr_shape:
-        raise Exception("Numpy float image should have shape {}, "+
-            "instead received  {}".format(expected_arr_shape, np_float_img.shape))
+    if  np_img.shape != expected_arr_shape:
+        raise Exception("Numpy image should have shape {}, instead received {}".format(expected_arr_shape, np_img.shape))
+    
+    if pattern_format == "auto":
+        pattern_format = "bits" if is_binary_pattern(np_img) else "uint8"
+    
+    if pattern_format == "bits":
+        if not is_binary_pattern(np_img):
+            raise Exception("Pattern sent in 'bits' format should only have values 0 and 1")
+        return np_img == 1
+    elif pattern_format == "uint8":
+        return (np_img * np.iinfo(np.uint8).max).astype(np.uint8)
+    elif pattern_format == "uint16":
+        max_int16 =  np.iinfo(np.uint16).max
+
+        np_int16_img = (np_img *  max_int16 ).astype(np.uint16)
+
+        return np_int16_img
+    else:
+        raise Exception("Invalid pattern format '{}': must be 'auto' or from list '{}'".format(pattern_format, raspidisplay.PATTERN_FORMATS))
+
+def convert_pattern_for_dmd(pattern, pattern_format="auto"):
+    # Like convert_img_for_dmd, except pattern can also be a PatternDescription, which then gets drawn here
+    if not isinstance(pattern, PatternDescription):
+        return convert_img_for_dmd(pattern, pattern_format)
+    
+    frame = pattern.render((DmdConstants.DMD_H, DmdConstants.DMD_W))
+    is_binary = bool(np.all((frame == 0) | (frame == 255)))
+    if pattern_format == "auto":
+        pattern_format = "bits" if is_binary else "uint8"
+    
+    if pattern_format == "bits":
+        if not is_binary:
+            raise Exception("Pattern sent in 'bits' format should only have values 0 and 1")
+        return frame == 255
+    elif pattern_format == "uint8":
+        return frame
+    elif pattern_format == "uint16":
+        # Same as scaling the pattern's values to the uint16 range, since 65535 = 255 * 257
+        return frame.astype(np.uint16) * np.uint16(257)
+    else:
+        raise Exception("Invalid pattern format '{}': must be 'auto' or from list '{}'".format(pattern_format, raspidisplay.PATTERN_FORMATS))
+
+def tiff_compression_codecs():
+    # tifffile does zlib with the standard library, but needs imagecodecs for zstd. feh reads both through libtiff.
+    codecs = ["zlib"]
+    if imagecodecs is not None:
+        codecs.append("zstd")
+    return codecs
+
+def tiff_bytes_for_frame(frame, compression=None):
+    # Encode to an in-memory buffer so the image can be uploaded without touching the local disk. Bool frames
+    # become 1 bit TIFFs, which need telling that 1 is white
+    buf = io.BytesIO()
+    if compression is None:
+        tifffile.imwrite(buf, frame, photometric="minisblack")
+    else:
+        tifffile.imwrite(
+            buf,
+            frame,
+            photometric="minisblack",
+            compression=compression,
+            compressionargs={"level": raspidisplay.COMPRESSION_LEVELS[compression]},
+            )
+
+    return buf.getvalue()
+
+def encode_img_for_dmd(np_img, pattern_format="auto"):
+    return tiff_bytes_for_frame(convert_img_for_dmd(np_img, pattern_format))
+
+def pattern_cache_key(frame):
+    # Content hash that names a pattern in the pattern caches on the Pi
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update("{} {}".format(frame.dtype, frame.shape).encode("utf-8"))
+    hasher.update(np.ascontiguousarray(frame).tobytes())
+
+    return hasher.hexdigest()
+
+def dirty_rects(old_frame, new_frame, tile_size):
+    # Rectangles, as [top, left, height, width], covering the tile_size by tile_size tiles where new_frame differs
+    # from old_frame. Dirty tiles next to each other in a tile row are merged into one rectangle, and so are
+    # rectangles spanning the same columns in consecutive tile rows.
+    changed = old_frame != new_frame
+    h, w = changed.shape
+    n_tile_rows = -(-h // tile_size)
+    n_tile_cols = -(-w // tile_size)
+    padded_changed = np.zeros((n_tile_rows * tile_size, n_tile_cols * tile_size), dtype=bool)
+    padded_changed[:h, :w] = changed
+    dirty_tiles = padded_changed.reshape(n_tile_rows, tile_size, n_tile_cols, tile_size).any(axis=(1, 3))
+    
+    rects = []
+    # (first tile column, end tile column) -> rectangle that the next tile row can extend downwards
+    open_rects = {}
+    for tile_row in range(n_tile_rows):
+        run_edges = np.flatnonzero(np.diff(np.concatenate([[0], dirty_tiles[tile_row].astype(np.int8), [0]])))
+        next_open_rects = {}
+        for run in zip(run_edges[0::2], run_edges[1::2]):
+            if run in open_rects:
+                rect = open_rects[run]
+                rect[2] += tile_size
+            else:
+                rect = [tile_row * tile_size, int(run[0]) * tile_size, tile_size, int(run[1] - run[0]) * tile_size]
+                rects.append(rect)
+            next_open_rects[run] = rect
+        open_rects = next_open_rects
+    
+    # Tiles at the bottom and right edges can stick out of the frame
+    for rect in rects:
+        rect[2] = min(rect[0] + rect[2], h) - rect[0]
+        rect[3] = min(rect[1] + rect[3], w) - rect[1]
+    
+    return rects
 
-    max_int16 =  np.iinfo(np.uint16).max
+class TransferCompressor:
+    # Decides how each pattern is compressed on its way to the Pi, for RaspiImageSender and RaspiDaemonImageSender.
+    # compression is "off", a codec name, or "auto". "auto" uses the fastest codec both ends support, and sends a
+    # pattern compressed only when the link time saved is more than it costs to compress and decompress it. After
+    # several patterns in a row that didn't pay, it stops trying for a while.
+    compression_modes = ["off", "auto"] + raspidisplay.COMPRESSION_CODECS
+    
+    def __init__(self, compression, available_codecs):
+        if compression not in self.compression_modes:
+            raise Exception("Invalid compression '{}': must be from list '{}'".format(compression, self.compression_modes))
+        if compression not in ["off", "auto"] and compression not in available_codecs:
+            raise Exception("Compression codec '{}' isn't available, available codecs are '{}'".format(compression, available_codecs))
+        
+        self.compression = compression
+        self.available_codecs = available_codecs
+        
+        # Estimate of link throughput to the Pi, a slow Wi-Fi link to start with, updated from measured transfers
+        self.link_bytes_per_s = 2 * 1024 ** 2
+        # Transfers smaller than this are dominated by latency, so say little about throughput
+        self.min_bytes_for_link_estimate = 64 * 1024
+        # Pi's decompression time per uncompressed byte, once the Pi has reported one
+        self.decompress_s_per_byte = None
+        
+        self.max_unprofitable_streak = 3
+        self.n_skipped_after_unprofitable_streak = 20
+        self._unprofitable_streak = 0
+        self._n_left_to_skip = 0
+    
+    def codec_to_try(self):
+        # Codec to compress the next pattern with, or None to send it as it is
+        if self.compression == "off":
+            return None
+        if self.compression != "auto":
+            return self.compression
+        
+        if self._n_left_to_skip > 0:
+            self._n_left_to_skip -= 1
+            return None
+        if "zstd" in self.available_codecs:
+            return "zstd"
+        return "zlib"
+    
+    def worth_sending_compressed(self, n_raw_bytes, n_compressed_bytes, compress_s):
+        if self.compression != "auto":
+            return True
+        
+        saved_s = (n_raw_bytes - n_compressed_bytes) / self.link_bytes_per_s
+        if self.decompress_s_per_byte is None:
+            # Until the Pi reports, guess decompressing costs as much as compressing
+            decompress_s = compress_s
+        else:
+            decompress_s = self.decompress_s_per_byte * n_raw_bytes
+        
+        if saved_s > compress_s + decompress_s:
+            self._unprofitable_streak = 0
+            return True
+        
+        self._unprofitable_streak += 1
+        if self._unprofitable_streak >= self.max_unprofitable_streak:
+            self._unprofitable_streak = 0
+            self._n_left_to_skip = self.n_skipped_after_unprofitable_streak
+        return False
+    
+    def record_transfer(self, n_bytes, transfer_s):
+        if n_bytes < self.min_bytes_for_link_estimate or transfer_s <= 0:
+            return
+        self.link_bytes_per_s = 0.7 * self.link_bytes_per_s + 0.3 * (n_bytes / transfer_s)
+    
+    def record_decompress(self, n_raw_bytes, decompress_s):
+        if n_raw_bytes == 0:
+            return
+        s_per_byte = decompress_s / n_raw_bytes
+        if self.decompress_s_per_byte is None:
+            self.decompress_s_per_byte = s_per_byte
+        else:
+            self.decompress_s_per_byte = 0.7 * self.decompress_s_per_byte + 0.3 * s_per_byte
 
-    np_int8_img = (np_float_img *  max_int16 ).astype(np.uint16)
+def run_command_on_raspi(ssh_client, command, wait_for_output=True):
+    if wait_for_output:
+        print("executing command '{}', waiting for command to finish ... ".format(command), end="")
+    else:
+        print("executing command '{}'".format(command))
+    stdin, stdout, stderr = ssh_client.exec_command(command)
 
+    if not wait_for_output:
+        return
 
-    tifffile.imwrite(path, np_int8_img)
+    script_output = stdout.readlines()
+    script_err = stderr.readlines()
+    print("finished")
+    
+    if len(script_err)!= 0:
+        text_stderr = "\n".join(script_err)
+        text_stdout = "\n".join(script_output)
+        raise Exception("Error with pi running command:\n{}\nstderr:\n{}\nstdout:\n{}".format(command, text_stderr, text_stdout))
+
+def raise_for_command_errors(command_results):
+    # Raises for commands from a RemoteCommandBatch that wrote to stderr, like run_command_on_raspi does
+    failed_results = [r for r in command_results if len(r["stderr"]) != 0]
+    if len(failed_results) == 0:
+        return
+    raise Exception("\n".join(
+        "Error with pi running command:\n{}\nstderr:\n{}\nstdout:\n{}".format(r["command"], r["stderr"], r["stdout"])
+        for r in failed_results
+    ))
+
+class RemoteCommandBatch:
+    # Shell commands queued up to run on the Pi as one script through one exec_command, so a group of commands costs
+    # one round trip instead of one each. The commands run one after another in the same shell. After each, a marker
+    # line with its index and exit status is written to both stdout and stderr, so the output can be split back up
+    # by command.
+    done_marker = "__raspi_batch_command_done__"
+    
+    def __init__(self, ssh_client):
+        self.ssh_client = ssh_client
+        self.commands = []
+        self._stdout = None
+        self._stderr = None
+    
+    def add(self, command):
+        if self._stdout is not None:
+            raise Exception("Can't add commands to a batch that has already started")
+        self.commands.append(command)
+    
+    def script(self):
+        lines = []
+        for index, command in enumerate(self.commands):
+            lines.append(command)
+            lines.append('batch_status=$?; echo "{0} {1} $batch_status"; echo "{0} {1} $batch_status" >&2'.format(self.done_marker, index))
+        return "\n".join(lines)
+    
+    def start(self):
+        print("executing {} commands in one batch: '{}'".format(len(self.commands), "; ".join(self.commands)))
+        _, self._stdout, self._stderr = self.ssh_client.exec_command(self.script())
+    
+    def finish(self):
+        # Waits for the batch to finish. Returns a dict for each command with its stdout, stderr and exit status,
+        # which is None if the script ended before getting to it
+        command_results = [
+            {"command": command, "stdout": "", "stderr": "", "exit_status": None}
+            for command in self.commands
+        ]
+        
+        for stream_name, stream in [("stdout", self._stdout), ("stderr", self._stderr)]:
+            command_lines = []
+            for line in stream.readlines():
+                if line.startswith(self.done_marker):
+                    _, index, exit_status = line.split()
+                    command_results[int(index)][stream_name] = "".join(command_lines)
+                    command_results[int(index)]["exit_status"] = int(exit_status)
+                    command_lines = []
+                else:
+                    command_lines.append(line)
+            
+            # Output after the last marker belongs to the command the script stopped at
+            if len(command_lines) != 0:
+                for result in command_results:
+                    if result["exit_status"] is None:
+                        result[stream_name] = "".join(command_lines)
+                        break
+        
+        return command_results
+    
+    def run(self):
+        self.start()
+        command_results = self.finish()
+        raise_for_command_errors(command_results)
+        return command_results
+
+class BackgroundTask:
+    # Runs fn(*args) on its own thread. result() waits for it to finish, then returns what fn returned or raises what
+    # it raised
+    def __init__(self, fn, *args):
+        self._result = None
+        self._exception = None
+        self._thread = threading.Thread(target=self._run, args=(fn, args), daemon=True)
+        self._thread.start()
+    
+    def _run(self, fn, args):
+        try:
+            self._result = fn(*args)
+        except Exception as e:
+            self._exception = e
+    
+    def result(self):
+        self._thread.join()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
 
 class RaspiConnectionError(Exception):
     pass
@@ -33,6 +346,24 @@ class StandInRaspiImageSender:
     
     def send_image(self, np_float_img):
         pass
+    
+    def preload_images(self, np_float_imgs):
+        pass
+    
+    def show_preloaded_image(self, index):
+        pass
+    
+    def stage_image(self, np_float_img):
+        pass
+    
+    def show_staged_image(self):
+        pass
+    
+    def get_send_stats(self):
+        return []
+    
+    def get_preload_stats(self):
+        return []
 
 
 class StandInRaspiImageSenderContextManager:
@@ -53,48 +384,139 @@ class StandInRaspiInterface:
         print("password '{}'".format(password))
         print("tempdirpath '{}'".format(tempdirpath))
     
-    def image_sender(self):
+    def image_sender(self, display_sync="ack", compression="off"):
         return StandInRaspiImageSenderContextManager()
 
 class RaspiImageSender:
-    def __init__(self, ssh_client, local_image_temp_dirpath, raspi_remote_img_dirpath):
+    display_sync_modes = ["ack", "sleep"]
+    
+    def __init__(self, ssh_client, raspi_remote_img_dirpath, display_sync="ack", use_pattern_cache=True, compression="off"):
+        if display_sync not in self.display_sync_modes:
+            raise Exception("Invalid display sync mode '{}': must be from list '{}'".format(display_sync, self.display_sync_modes))
+        
         self.ssh_client = ssh_client
-        self.local_image_temp_dirpath = local_image_temp_dirpath
         self.sent_image_name_counter = 0
         self.tiffname_currently_on_pi = None
+        self.image_path_currently_on_pi = None
+        self._delete_image_currently_on_pi_after_swap = False
         self.raspi_remote_img_dirpath = raspi_remote_img_dirpath
         
         self.remote_image_folder = self.raspi_remote_img_dirpath + "/slideshow_image_files"
+        # Each call to preload_images unpacks its patterns into a new batch directory in here
+        self.remote_preloaded_image_folder = self.raspi_remote_img_dirpath + "/preloaded_image_files"
+        
+        # With use_pattern_cache, every pattern is stored here under its content hash and kept between sessions,
+        # so patterns the Pi already has are never uploaded again. Least recently used ones are evicted to keep the
+        # folder under pattern_cache_max_bytes.
+        self.use_pattern_cache = use_pattern_cache
+        self.remote_pattern_cache_folder = self.raspi_remote_img_dirpath + "/pattern_cache"
+        self.pattern_cache_max_bytes = 512 * 1024 ** 2
+        # Pattern file name -> [size in bytes, last use time]
+        self.cached_patterns = {}
         self.remote_slideshow_symlinks_folder = self.raspi_remote_img_dirpath + "/slideshow_symlinks"
+        # feh touches a marker file named after each image here when it renders it, see start_feh
+        self.remote_display_ack_folder = self.raspi_remote_img_dirpath + "/display_acks"
+        
+        # "ack": send_image returns once feh reports the new image is on screen, waiting at most display_ack_timeout_s.
+        # "sleep": send_image sleeps display_sleep_s after the swap and hopes feh has reloaded by then.
+        self.display_sync = display_sync
+        self.display_ack_timeout_s = 1.0
+        self.display_ack_poll_interval_s = 0.005
+        self.display_sleep_s = 0.2
+        
+        # Format patterns are sent in, see convert_img_for_dmd. "auto" sends binary patterns as 1 bit TIFFs and
+        # grayscale ones as 8 bit TIFFs
+        self.pattern_format = "auto"
+        
+        # Compression inside the uploaded TIFFs, which feh decompresses itself, see TransferCompressor
+        self.compressor = TransferCompressor(compression, tiff_compression_codecs())
         
         self._feh_running = False
+        
+        # SFTP session kept open for the life of the image sender, so each sent image doesn't pay for channel setup
+        self.sftp_client = None
+        
+        # Commands queued with queue_command_on_raspi, run as one batch by flush_commands_on_raspi
+        self.queued_commands = []
+        # Batch flushed without waiting for it to finish, its errors are raised by the next command run on the Pi
+        self._pending_command_batch = None
+        
+        # Timing info for each call to send_image or show_preloaded_image, see get_send_stats
+        self.send_stats = []
+        
+        # Upload started by stage_image, running in the background, and what it uploaded, for show_staged_image
+        self._staging_task = None
+        self._staged_upload = None
+        
+        self.preload_batch_counter = 0
+        self.preloaded_batch_dirpaths = []
+        self.preloaded_image_paths = []
+        # Timing info for each call to preload_images, see get_preload_stats
+        self.preload_stats = []
+    
+    def open_sftp_session(self):
+        if self.sftp_client is not None:
+            raise Exception("SFTP session is already open")
+        self.sftp_client = self.ssh_client.open_sftp()
+    
+    def close_sftp_session(self):
+        if self.sftp_client is None:
+            return
+        self.wait_for_staged_image()
+        self.sftp_client.close()
+        self.sftp_client = None
+    
+    def get_send_stats(self):
+        return self.send_stats
     
     def start_feh(self):
+        # All the setup commands go to the Pi as one batch
+        
         # Make directory for slideshow symlinks to images, if it doesn't exist already
-        self.run_command_on_raspi("mkdir -p '{}'".format(self.remote_slideshow_symlinks_folder))
+        self.queue_command_on_raspi("mkdir -p '{}'".format(self.remote_slideshow_symlinks_folder))
 
         # Make directory for image files themselves, if it doesn't exist already
-        self.run_command_on_raspi("mkdir -p '{}'".format(self.remote_image_folder))
+        self.queue_command_on_raspi("mkdir -p '{}'".format(self.remote_image_folder))
 
         # Clear out symlink directory in case it has leftover files from before
-        self.run_command_on_raspi("rm -f '{}'/*".format(self.remote_slideshow_symlinks_folder))
+        self.queue_command_on_raspi("rm -f '{}'/*".format(self.remote_slideshow_symlinks_folder))
         
         # Clear out image file directory in case it has leftover files from before
-        self.run_command_on_raspi("rm -f '{}'/*".format(self.remote_image_folder))
+        self.queue_command_on_raspi("rm -f '{}'/*".format(self.remote_image_folder))
+        
+        # Same for preloaded images
+        self.queue_command_on_raspi("mkdir -p '{}'".format(self.remote_preloaded_image_folder))
+        self.queue_command_on_raspi("rm -rf '{}'/*".format(self.remote_preloaded_image_folder))
+        
+        # The pattern cache is deliberately not cleared
+        if self.use_pattern_cache:
+            self.queue_command_on_raspi("mkdir -p '{}'".format(self.remote_pattern_cache_folder))
+        
+        if self.display_sync == "ack":
+            # Make directory for display acknowledgement markers, and clear out markers left from before
+            self.queue_command_on_raspi("mkdir -p '{}'".format(self.remote_display_ack_folder))
+            self.queue_command_on_raspi("rm -f '{}'/*".format(self.remote_display_ack_folder))
         
-        # Make placeholder with ImageMagick's convert command
         # Put placeholder image in image folder and symlink in slideshow folder, so feh program doesn't exit 
-        # because it has nothing to show in slideshow symlink folder
+        # because it has nothing to show in slideshow symlink folder. The symlink can be made before the image is
+        # uploaded, since feh isn't running yet
         placeholder_tiff_name = "placeholder.tiff"
         placeholder_tiff_path = self.remote_image_folder + "/" + placeholder_tiff_name
         placeholder_symlink_path = self.remote_slideshow_symlinks_folder + "/" + placeholder_tiff_name
-
-        placeholder_command = "convert -size 100x100 xc:black '{}'".format(placeholder_tiff_path)
-        print("Creating placeholder image: {}".format(placeholder_command))
-        self.run_command_on_raspi(placeholder_command)
-
-        self.run_command_on_raspi("ln -fs '{}' '{}'".format(placeholder_tiff_path, placeholder_symlink_path))
+        self.queue_command_on_raspi("ln -fs '{}' '{}'".format(placeholder_tiff_path, placeholder_symlink_path))
+        
+        self.flush_commands_on_raspi()
+        
+        if self.use_pattern_cache:
+            self.load_pattern_cache_index()
+        
+        # The placeholder is a small black TIFF, uploaded over the open SFTP session
+        placeholder_bytes = tiff_bytes_for_frame(np.zeros((100, 100), dtype=np.uint8))
+        self.sftp_client.putfo(io.BytesIO(placeholder_bytes), placeholder_tiff_path, file_size=len(placeholder_bytes), confirm=False)
+        
         self.tiffname_currently_on_pi = placeholder_tiff_name
+        self.image_path_currently_on_pi = placeholder_tiff_path
+        self._delete_image_currently_on_pi_after_swap = True
 
         # Execute command and detach
         # This starts a slideshow that doesn't switch slides by itself, but we can put a new file on raspberry pi,
@@ -103,7 +525,16 @@ class RaspiImageSender:
         # Using symlinks because it's probably less risky as far as deleting a file while it's still being read. This seems
         # unlikely, but I'm doing it this way just in case
         
-        feh_command = "export DISPLAY=:0; feh --reload 0.1 --hide-pointer --fullscreen --auto-zoom '{}' &".format(
+        # In ack mode, feh's --info command runs every time feh renders an image, with %n replaced by the image's
+        # file name. It prints nothing, so nothing is drawn over the pattern, but it leaves a marker in the ack folder
+        # that send_image waits for.
+        if self.display_sync == "ack":
+            feh_info_option = "--info \"touch '{}/%n'\" ".format(self.remote_display_ack_folder)
+        else:
+            feh_info_option = ""
+        
+        feh_command = "export DISPLAY=:0; feh --reload 0.1 --hide-pointer --fullscreen --auto-zoom {}'{}' &".format(
+            feh_info_option,
             self.remote_slideshow_symlinks_folder,
         )
         self.run_command_on_raspi(feh_command, wait_for_output=False)
@@ -113,26 +544,40 @@ class RaspiImageSender:
 
     
     def run_command_on_raspi(self, command, wait_for_output=True):
-        if wait_for_output:
-            print("executing command '{}', waiting for command to finish ... ".format(command), end="")
-        else:
-            print("executing command '{}'".format(command))
-        stdin, stdout, stderr = self.ssh_client.exec_command(command)
-
-        if not wait_for_output:
+        self.check_pending_commands_on_raspi()
+        run_command_on_raspi(self.ssh_client, command, wait_for_output=wait_for_output)
+    
+    def queue_command_on_raspi(self, command):
+        self.queued_commands.append(command)
+    
+    def flush_commands_on_raspi(self, wait_for_output=True):
+        # Runs the queued commands as one RemoteCommandBatch. With wait_for_output=False the batch is pipelined: this
+        # returns straight away, and any errors are raised by the next command run on the Pi or by
+        # check_pending_commands_on_raspi. Each run waits for the pending batch first, so commands still run in order.
+        self.check_pending_commands_on_raspi()
+        if len(self.queued_commands) == 0:
             return
-
-        script_output = stdout.readlines()
-        script_err = stderr.readlines()
-        print("finished")
         
-        if len(script_err)!= 0:
-            text_stderr = "\n".join(script_err)
-            text_stdout = "\n".join(script_output)
-            raise Exception("Error with pi running command:\n{}\nstderr:\n{}\nstdout:\n{}".format(command, text_stderr, text_stdout))
+        batch = RemoteCommandBatch(self.ssh_client)
+        for command in self.queued_commands:
+            batch.add(command)
+        self.queued_commands = []
+        
+        if wait_for_output:
+            batch.run()
+        else:
+            batch.start()
+            self._pending_command_batch = batch
     
+    def check_pending_commands_on_raspi(self):
+        if self._pending_command_batch is None:
+            return
+        batch = self._pending_command_batch
+        self._pending_command_batch = None
+        raise_for_command_errors(batch.finish())
     
     def kill_feh(self):
+        self.flush_commands_on_raspi()
         self.run_command_on_raspi("pkill feh")
         
         
@@ -141,60 +586,441 @@ class RaspiImageSender:
     def send_image(self, np_float_img):
         if not self._feh_running:
             raise Exception("Can't send images to show without feh up and running, should call start_feh before send_image_to_feh")
+        if self.sftp_client is None:
+            raise Exception("Can't send images without an open SFTP session, should call open_sftp_session before send_image")
+        self.wait_for_staged_image()
         
+        self.show_uploaded_image(self.upload_image(np_float_img))
+    
+    def stage_image(self, np_float_img):
+        # Starts uploading a pattern in the background and returns straight away, so the upload can overlap with
+        # something else, like a camera exposure of the pattern on screen. show_staged_image then swaps it onto
+        # the display. Nothing else should use this image sender until show_staged_image is called.
+        if not self._feh_running:
+            raise Exception("Can't stage images without feh up and running, should call start_feh before stage_image")
+        if self.sftp_client is None:
+            raise Exception("Can't stage images without an open SFTP session, should call open_sftp_session before stage_image")
+        if self._staging_task is not None or self._staged_upload is not None:
+            raise Exception("An image is already staged, should call show_staged_image before staging another")
         
-
-        local_image_path = os.path.join(self.local_image_temp_dirpath, "imgfordmd.tiff")
-        save_local_img_for_dmd(np_float_img, local_image_path)
+        self._staging_task = BackgroundTask(self.upload_image, np_float_img)
+    
+    def wait_for_staged_image(self):
+        # Waits for a staged upload to finish, so the SFTP session is free for something else
+        if self._staging_task is None:
+            return
+        try:
+            self._staged_upload = self._staging_task.result()
+        finally:
+            self._staging_task = None
+    
+    def show_staged_image(self):
+        self.wait_for_staged_image()
+        if self._staged_upload is None:
+            raise Exception("No image is staged, should call stage_image before show_staged_image")
         
-        # Need a new name for the image
-        while "pattern_{}.tiff".format(self.sent_image_name_counter) == self.tiffname_currently_on_pi:
-            self.sent_image_name_counter += 1
+        uploaded_image = self._staged_upload
+        self._staged_upload = None
+        self.show_uploaded_image(uploaded_image, staged=True)
+    
+    def upload_image(self, np_float_img):
+        # Converts a pattern and puts it on the Pi, unless it's there already. Returns what show_uploaded_image needs
+        # to swap it onto the display.
+        upload_start_time = time.perf_counter()
         
-        # This is the file name where we send the local image
-        new_tiff_name = "pattern_{}.tiff".format(self.sent_image_name_counter)
-
-        remote_path_for_image =   self.remote_image_folder + "/" + new_tiff_name
-        remote_path_for_symlink = self.remote_slideshow_symlinks_folder + "/" + new_tiff_name
+        # PatternDescriptions get drawn here, feh needs the pixels
+        frame = convert_pattern_for_dmd(np_float_img, self.pattern_format)
         
-        # Send the image to the remote image folder
-        ftp_client=self.ssh_client.open_sftp()
-        ftp_client.put(local_image_path, remote_path_for_image)
-        ftp_client.close()
-
-        # Create a symlink in remote slideshow symlink folder so that feh will see it
-        self.run_command_on_raspi("ln -fs '{}' '{}'".format(
-            remote_path_for_image,
-            remote_path_for_symlink,
+        if self.use_pattern_cache:
+            # Patterns are named by content hash, and ones already on the Pi aren't uploaded again
+            new_tiff_name = pattern_cache_key(frame) + ".tiff"
+            remote_path_for_image = self.remote_pattern_cache_folder + "/" + new_tiff_name
+            cache_hit = new_tiff_name in self.cached_patterns
+        else:
+            # Need a new name for the image
+            while "pattern_{}.tiff".format(self.sent_image_name_counter) == self.tiffname_currently_on_pi:
+                self.sent_image_name_counter += 1
+            
+            # This is the file name where we send the image
+            new_tiff_name = "pattern_{}.tiff".format(self.sent_image_name_counter)
+            remote_path_for_image = self.remote_image_folder + "/" + new_tiff_name
+            cache_hit = False
+        
+        if cache_hit:
+            n_bytes = 0
+            codec, compression_ratio, compress_s = None, 1.0, 0.0
+            encoded_time = uploaded_time = time.perf_counter()
+        else:
+            img_bytes, codec, compression_ratio, compress_s = self.encode_for_upload(frame)
+            n_bytes = len(img_bytes)
+            encoded_time = time.perf_counter()
+            
+            # Send the image straight from memory. confirm=False skips the extra stat round trip paramiko would
+            # otherwise do after the upload
+            self.sftp_client.putfo(io.BytesIO(img_bytes), remote_path_for_image, file_size=n_bytes, confirm=False)
+            uploaded_time = time.perf_counter()
+            self.compressor.record_transfer(n_bytes, uploaded_time - encoded_time)
+            
+            print("Uploaded image to Pi path '{}'".format(remote_path_for_image))
+        
+        return {
+            "image_name": new_tiff_name,
+            "remote_path": remote_path_for_image,
+            "n_bytes": n_bytes,
+            "cache_hit": cache_hit,
+            "codec": codec,
+            "compression_ratio": compression_ratio,
+            "compress_s": compress_s,
+            "encode_s": encoded_time - upload_start_time,
+            "upload_s": uploaded_time - encoded_time,
+        }
+    
+    def show_uploaded_image(self, uploaded_image, staged=False):
+        swap_start_time = time.perf_counter()
+        new_tiff_name = uploaded_image["image_name"]
+        remote_path_for_image = uploaded_image["remote_path"]
+        n_bytes = uploaded_image["n_bytes"]
+        cache_hit = uploaded_image["cache_hit"]
+        
+        if new_tiff_name == self.tiffname_currently_on_pi:
+            # Same pattern is already on screen
+            display_wait_s, display_acked = 0.0, True
+        else:
+            display_wait_s, display_acked = self.swap_displayed_image(
+                remote_path_for_image,
+                new_tiff_name,
+                delete_image_after_swap=not self.use_pattern_cache,
+                touch_image=cache_hit,
+                )
+        
+        if self.use_pattern_cache:
+            self.cached_patterns[new_tiff_name] = [n_bytes if not cache_hit else self.cached_patterns[new_tiff_name][0], time.time()]
+            if not cache_hit:
+                self.evict_from_pattern_cache()
+        
+        swap_end_time = time.perf_counter()
+        swap_s = swap_end_time - swap_start_time
+        self.record_send_stats({
+            "image_name": new_tiff_name,
+            "n_bytes": n_bytes,
+            "cache_hit": cache_hit,
+            # Staged images were uploaded in the background, so only swap_s was spent waiting
+            "staged": staged,
+            "codec": uploaded_image["codec"],
+            "compression_ratio": uploaded_image["compression_ratio"],
+            "compress_s": uploaded_image["compress_s"],
+            # feh decompresses the TIFF as it reads it, which can't be timed separately
+            "decompress_s": None,
+            "encode_s": uploaded_image["encode_s"],
+            "upload_s": uploaded_image["upload_s"],
+            "swap_s": swap_s,
+            "display_wait_s": display_wait_s,
+            "display_acked": display_acked,
+            "total_s": uploaded_image["encode_s"] + uploaded_image["upload_s"] + swap_s,
+        })
+    
+    def encode_for_upload(self, frame):
+        # Returns the TIFF bytes to upload for frame, the codec they're compressed with or None, the compression ratio
+        # and the time spent compressing
+        codec = self.compressor.codec_to_try()
+        if codec is None:
+            return tiff_bytes_for_frame(frame), None, 1.0, 0.0
+        
+        compress_start_time = time.perf_counter()
+        img_bytes = tiff_bytes_for_frame(frame, codec)
+        compress_s = time.perf_counter() - compress_start_time
+        
+        n_raw_bytes = raspidisplay.encoded_pattern_size(pattern_format_of_frame(frame), frame.shape)
+        if not self.compressor.worth_sending_compressed(n_raw_bytes, len(img_bytes), compress_s):
+            return tiff_bytes_for_frame(frame), None, 1.0, compress_s
+        
+        return img_bytes, codec, n_raw_bytes / len(img_bytes), compress_s
+    
+    def load_pattern_cache_index(self):
+        # Finds out which patterns the Pi already holds from earlier sessions, with one SFTP listing
+        self.cached_patterns = {}
+        for file_attr in self.sftp_client.listdir_attr(self.remote_pattern_cache_folder):
+            if file_attr.filename.endswith(".tiff"):
+                self.cached_patterns[file_attr.filename] = [file_attr.st_size, file_attr.st_mtime]
+    
+    def evict_from_pattern_cache(self):
+        # Removes least recently used patterns until the cache is under pattern_cache_max_bytes, never removing the
+        # pattern on screen or preloaded ones. All removals go in one command.
+        protected_names = set(os.path.basename(p) for p in self.preloaded_image_paths)
+        protected_names.add(self.tiffname_currently_on_pi)
+        if self._staged_upload is not None:
+            protected_names.add(self._staged_upload["image_name"])
+        
+        total_bytes = sum(size for size, _ in self.cached_patterns.values())
+        evicted_names = []
+        for name in sorted(self.cached_patterns, key=lambda n: self.cached_patterns[n][1]):
+            if total_bytes <= self.pattern_cache_max_bytes:
+                break
+            if name in protected_names:
+                continue
+            total_bytes -= self.cached_patterns[name][0]
+            evicted_names.append(name)
+        
+        if len(evicted_names) == 0:
+            return
+        
+        # Nothing waits on the removal, so it's pipelined with whatever comes next
+        self.queue_command_on_raspi("rm -f " + " ".join(
+            "'{}/{}'".format(self.remote_pattern_cache_folder, name) for name in evicted_names
+        ))
+        self.flush_commands_on_raspi(wait_for_output=False)
+        for name in evicted_names:
+            del self.cached_patterns[name]
+        print("Evicted {} patterns from Pi pattern cache".format(len(evicted_names)))
+    
+    def preload_images(self, np_float_imgs):
+        # Uploads a whole sequence of patterns as one archive, so that during acquisition show_preloaded_image
+        # only has to swap a symlink. np_float_imgs can be any iterable, e.g. a generator, so the patterns never
+        # all need to be in memory as float arrays at once. With the pattern cache on, patterns the Pi already
+        # has are left out of the archive.
+        if not self._feh_running:
+            raise Exception("Can't preload images without feh up and running, should call start_feh before preload_images")
+        if self.sftp_client is None:
+            raise Exception("Can't preload images without an open SFTP session, should call open_sftp_session before preload_images")
+        self.wait_for_staged_image()
+        
+        preload_start_time = time.perf_counter()
+        
+        self.preload_batch_counter += 1
+        if self.use_pattern_cache:
+            unpack_dirpath = self.remote_pattern_cache_folder
+            remote_archive_path = self.remote_pattern_cache_folder + "/preload_batch_{}.tar.gz".format(self.preload_batch_counter)
+        else:
+            unpack_dirpath = self.remote_preloaded_image_folder + "/batch_{}".format(self.preload_batch_counter)
+            remote_archive_path = unpack_dirpath + ".tar.gz"
+        
+        # Patterns are almost entirely one value, so even the fastest gzip level shrinks them enormously
+        archive_buf = io.BytesIO()
+        preloaded_image_paths = []
+        archived_names = {}
+        n_cache_hits = 0
+        with tarfile.open(fileobj=archive_buf, mode="w:gz", compresslevel=1) as archive:
+            for np_float_img in np_float_imgs:
+                frame = convert_pattern_for_dmd(np_float_img, self.pattern_format)
+                if self.use_pattern_cache:
+                    tiff_name = pattern_cache_key(frame) + ".tiff"
+                else:
+                    tiff_name = "pattern_{}.tiff".format(len(preloaded_image_paths))
+                preloaded_image_paths.append(unpack_dirpath + "/" + tiff_name)
+                
+                if tiff_name in self.cached_patterns:
+                    n_cache_hits += 1
+                    continue
+                if tiff_name in archived_names:
+                    continue
+                
+                img_bytes = tiff_bytes_for_frame(frame)
+                tar_info = tarfile.TarInfo(tiff_name)
+                tar_info.size = len(img_bytes)
+                archive.addfile(tar_info, io.BytesIO(img_bytes))
+                archived_names[tiff_name] = len(img_bytes)
+        archive_bytes = archive_buf.getvalue()
+        encoded_time = time.perf_counter()
+        
+        if len(archived_names) != 0:
+            archive_buf.seek(0)
+            self.sftp_client.putfo(archive_buf, remote_archive_path, file_size=len(archive_bytes), confirm=False)
+        uploaded_time = time.perf_counter()
+        
+        # Unpack on the Pi, and remove earlier batches unless the image on screen comes from one of them
+        stale_batch_dirpaths = [
+            d for d in self.preloaded_batch_dirpaths
+            if self.image_path_currently_on_pi is None or not self.image_path_currently_on_pi.startswith(d + "/")
+        ]
+        unpack_commands = []
+        if len(archived_names) != 0:
+            unpack_commands.append("mkdir -p '{}' && tar -xzf '{}' -C '{}' && rm '{}'".format(
+                unpack_dirpath,
+                remote_archive_path,
+                unpack_dirpath,
+                remote_archive_path,
+            ))
+        for stale_dirpath in stale_batch_dirpaths:
+            unpack_commands.append("rm -rf '{}'".format(stale_dirpath))
+        for command in unpack_commands:
+            self.queue_command_on_raspi(command)
+        self.flush_commands_on_raspi()
+        
+        self.preloaded_batch_dirpaths = [d for d in self.preloaded_batch_dirpaths if d not in stale_batch_dirpaths]
+        if not self.use_pattern_cache:
+            self.preloaded_batch_dirpaths.append(unpack_dirpath)
+        self.preloaded_image_paths = preloaded_image_paths
+        
+        if self.use_pattern_cache:
+            now = time.time()
+            for name, size in archived_names.items():
+                self.cached_patterns[name] = [size, now]
+            self.evict_from_pattern_cache()
+        
+        preload_end_time = time.perf_counter()
+        self.preload_stats.append({
+            "n_images": len(preloaded_image_paths),
+            "n_cache_hits": n_cache_hits,
+            "n_bytes": len(archive_bytes) if len(archived_names) != 0 else 0,
+            # The archive is always gzipped, this is how much that shrank the patterns in it
+            "compression_ratio": sum(archived_names.values()) / len(archive_bytes) if len(archived_names) != 0 else 1.0,
+            "encode_s": encoded_time - preload_start_time,
+            "upload_s": uploaded_time - encoded_time,
+            "unpack_s": preload_end_time - uploaded_time,
+            "total_s": preload_end_time - preload_start_time,
+        })
+        print("Preloaded {} images ({} already on Pi) in {:.1f} ms".format(
+            len(preloaded_image_paths),
+            n_cache_hits,
+            (preload_end_time - preload_start_time) * 1000,
         ))
+    
+    def get_preload_stats(self):
+        return self.preload_stats
+    
+    def show_preloaded_image(self, index):
+        if not self._feh_running:
+            raise Exception("Can't show images without feh up and running, should call start_feh before show_preloaded_image")
+        if index < 0 or index >= len(self.preloaded_image_paths):
+            raise Exception("No preloaded image at index {}, {} images are preloaded".format(index, len(self.preloaded_image_paths)))
+        self.wait_for_staged_image()
+        
+        show_start_time = time.perf_counter()
         
-        print("Copied local image '{}' to Pi path '{}', with symlink to it at '{}'".format(local_image_path, remote_path_for_image, remote_path_for_symlink))
+        # Cached patterns are named by content hash already. Otherwise the symlink name includes the batch, so it's
+        # different from whatever is on screen unless it's this same image
+        if self.use_pattern_cache:
+            symlink_name = os.path.basename(self.preloaded_image_paths[index])
+        else:
+            symlink_name = "preloaded_{}_{}.tiff".format(self.preload_batch_counter, index)
+        
+        if symlink_name == self.tiffname_currently_on_pi:
+            display_wait_s, display_acked = 0.0, True
+        else:
+            display_wait_s, display_acked = self.swap_displayed_image(
+                self.preloaded_image_paths[index],
+                symlink_name,
+                delete_image_after_swap=False,
+                touch_image=self.use_pattern_cache,
+                )
+            if self.use_pattern_cache:
+                self.cached_patterns[symlink_name][1] = time.time()
+        
+        show_end_time = time.perf_counter()
+        self.record_send_stats({
+            "image_name": symlink_name,
+            "n_bytes": 0,
+            "cache_hit": False,
+            "staged": False,
+            "codec": None,
+            "compression_ratio": 1.0,
+            "compress_s": 0.0,
+            "decompress_s": None,
+            "encode_s": 0.0,
+            "upload_s": 0.0,
+            "swap_s": show_end_time - show_start_time,
+            "display_wait_s": display_wait_s,
+            "display_acked": display_acked,
+            "total_s": show_end_time - show_start_time,
+        })
+    
+    def swap_displayed_image(self, remote_image_path, symlink_name, delete_image_after_swap, touch_image=False):
+        # Points feh at remote_image_path through a new symlink named symlink_name, removes the symlink for the
+        # image that was on screen, then waits for the new one to be shown according to display_sync.
+        # touch_image updates the image file's modification time, which the pattern cache uses as its last use time.
+        # Returns (seconds spent waiting for display, whether the display acknowledged the new image)
+        remote_path_for_symlink = self.remote_slideshow_symlinks_folder + "/" + symlink_name
+        
+        # Create a symlink in remote slideshow symlink folder so that feh will see it
+        link_command = "ln -fs '{}' '{}'".format(
+            remote_image_path,
+            remote_path_for_symlink,
+        )
+        if touch_image:
+            link_command = "touch -c '{}' && {}".format(remote_image_path, link_command)
+        self.queue_command_on_raspi(link_command)
 
         # Remove symlink for old image, then on the next update feh should read from the new image
         old_symlinkpath = self.remote_slideshow_symlinks_folder + "/" + self.tiffname_currently_on_pi
-        self.run_command_on_raspi("rm '{}'".format(
+        self.queue_command_on_raspi("rm '{}'".format(
             old_symlinkpath,
         ))
+        
+        # Both go as one batch. In ack mode there's no need to wait for it to finish, since feh's marker for the new
+        # image already shows the swap happened
+        self.flush_commands_on_raspi(wait_for_output=self.display_sync != "ack")
+        
+        swapped_time = time.perf_counter()
+        if self.display_sync == "ack":
+            display_acked = self.wait_for_display_ack(symlink_name)
+        else:
+            time.sleep(self.display_sleep_s)
+            display_acked = False
+        displayed_time = time.perf_counter()
 
-        time.sleep(0.2)
+        # Remove old file unless it's preloaded and might be shown again, and remove its display marker if it has one
+        # Cleanup is pipelined, nothing needs to wait for it
+        if self._delete_image_currently_on_pi_after_swap:
+            self.queue_command_on_raspi("rm '{}'".format(
+                self.image_path_currently_on_pi
+            ))
+        if self.display_sync == "ack":
+            old_ackpath = self.remote_display_ack_folder + "/" + self.tiffname_currently_on_pi
+            self.queue_command_on_raspi("rm -f '{}'".format(
+                old_ackpath
+            ))
+        self.flush_commands_on_raspi(wait_for_output=False)
 
-        old_imagepath = self.remote_image_folder + "/" + self.tiffname_currently_on_pi
-        # Remove old file
-        self.run_command_on_raspi("rm '{}'".format(
-            old_imagepath
+        # Set tiffname_currently_on_pi to the new symlink name
+        self.tiffname_currently_on_pi = symlink_name
+        self.image_path_currently_on_pi = remote_image_path
+        self._delete_image_currently_on_pi_after_swap = delete_image_after_swap
+        
+        return displayed_time - swapped_time, display_acked
+    
+    def record_send_stats(self, send_stats):
+        self.send_stats.append(send_stats)
+        print("Showed '{}', {} bytes sent ({} compression, ratio {:.1f}), in {:.1f} ms (encode {:.1f} ms, of which compress {:.1f} ms, upload {:.1f} ms, swap {:.1f} ms, of which display wait {:.1f} ms)".format(
+            send_stats["image_name"],
+            send_stats["n_bytes"],
+            send_stats["codec"] or "no",
+            send_stats["compression_ratio"],
+            send_stats["total_s"] * 1000,
+            send_stats["encode_s"] * 1000,
+            send_stats["compress_s"] * 1000,
+            send_stats["upload_s"] * 1000,
+            send_stats["swap_s"] * 1000,
+            send_stats["display_wait_s"] * 1000,
         ))
-
-        print("Removed old '{}' and '{}' from Pi".format( old_symlinkpath, old_imagepath))
-
-        # Set tiffname_currently_on_pi to the new filename
-        self.tiffname_currently_on_pi = new_tiff_name
+    
+    def wait_for_display_ack(self, image_name):
+        # Polls over the already-open SFTP session for feh's marker for image_name.
+        # Returns True once the marker shows up, or False if display_ack_timeout_s runs out first - in that case
+        # the caller goes on as if a fixed sleep had passed.
+        ack_path = self.remote_display_ack_folder + "/" + image_name
+        deadline = time.perf_counter() + self.display_ack_timeout_s
+        
+        while True:
+            try:
+                self.sftp_client.stat(ack_path)
+                return True
+            except IOError:
+                pass
+            
+            if time.perf_counter() >= deadline:
+                print("Warning: no display acknowledgement for '{}' after {} s, continuing anyway".format(image_name, self.display_ack_timeout_s))
+                return False
+            
+            time.sleep(self.display_ack_poll_interval_s)
 
 
 class RaspiImageSenderContextManager:
-    def __init__(self, ssh_client, img_tempdirpath, raspi_remote_img_dirpath):
+    def __init__(self, ssh_client, raspi_remote_img_dirpath, display_sync="ack", use_pattern_cache=True, compression="off"):
         self.ssh_client = ssh_client
-        self.img_tempdirpath = img_tempdirpath
         self.raspi_remote_img_dirpath = raspi_remote_img_dirpath
+        self.display_sync = display_sync
+        self.use_pattern_cache = use_pattern_cache
+        self.compression = compression
         
         self.entered = False
         self.exited = False
@@ -204,7 +1030,14 @@ class RaspiImageSenderContextManager:
             raise RuntimeError("__enter__ has been called twice on RaspiImageSenderContextManager - only meant to be used once!")
         self.entered = True
         
-        self.sender = RaspiImageSender(self.ssh_client, self.img_tempdirpath, self.raspi_remote_img_dirpath)
+        self.sender = RaspiImageSender(
+            self.ssh_client,
+            self.raspi_remote_img_dirpath,
+            display_sync=self.display_sync,
+            use_pattern_cache=self.use_pattern_cache,
+            compression=self.compression,
+            )
+        self.sender.open_sftp_session()
         self.sender.start_feh()
 
         return self.sender
@@ -212,11 +1045,619 @@ class RaspiImageSenderContextManager:
     def __exit__(self, exc_type, exc_value, traceback):
         if not self.entered:
             raise RuntimeError("__exit__ called on RaspiImageSenderContextManager without __enter__ called.")
-        self.sender.kill_feh()
+        try:
+            self.sender.kill_feh()
+        finally:
+            self.sender.close_sftp_session()
+        self.exited = True
+
+class RaspiDisplayDaemon:
+    # Desktop end of the display daemon in scripts/raspidisplay. start() copies that package onto the Pi and runs it
+    # over a single SSH exec channel, which stays open: after that, each request is one message written to the
+    # daemon's stdin and one reply read from its stdout.
+    def __init__(self, ssh_client, remote_dirpath, output_backend="x11", python_command="python3", use_pattern_cache=True):
+        if output_backend not in raspidisplay.DISPLAY_BACKENDS:
+            raise Exception("Invalid display daemon backend '{}': must be from list '{}'".format(output_backend, list(raspidisplay.DISPLAY_BACKENDS)))
+        
+        self.ssh_client = ssh_client
+        self.remote_dirpath = remote_dirpath
+        self.output_backend = output_backend
+        self.python_command = python_command
+        self.dmd_shape = (DmdConstants.DMD_H, DmdConstants.DMD_W)
+        
+        # Where the file backend writes frames on the Pi, for testing without a display
+        self.remote_output_path = self.remote_dirpath + "/displayed_frame.npy"
+        self.remote_log_path = self.remote_dirpath + "/displaydaemon.log"
+        
+        # The daemon keeps patterns it has been sent in a content-addressed cache on the Pi between sessions, see
+        # raspidisplay/patterncache.py. cached_keys is the desktop's copy of what's in it.
+        self.use_pattern_cache = use_pattern_cache
+        self.remote_pattern_cache_dirpath = self.remote_dirpath + "/pattern_cache"
+        self.pattern_cache_max_bytes = 512 * 1024 ** 2
+        self.cached_keys = set()
+        # Codecs the daemon can decompress, from its hello reply
+        self.compression_codecs = []
+        
+        self._stdin = None
+        self._stdout = None
+    
+    def is_running(self):
+        return self._stdin is not None
+    
+    def upload_package(self):
+        local_package_dirpath = os.path.dirname(raspidisplay.__file__)
+        remote_package_dirpath = self.remote_dirpath + "/raspidisplay"
+        run_command_on_raspi(self.ssh_client, "mkdir -p '{}'".format(remote_package_dirpath))
+        
+        sftp_client = self.ssh_client.open_sftp()
+        try:
+            for filename in sorted(os.listdir(local_package_dirpath)):
+                if filename.endswith(".py"):
+                    sftp_client.put(os.path.join(local_package_dirpath, filename), remote_package_dirpath + "/" + filename)
+        finally:
+            sftp_client.close()
+    
+    def start(self):
+        if self.is_running():
+            raise Exception("Display daemon is already running")
+        
+        self.upload_package()
+        
+        daemon_command = "cd '{}' && export DISPLAY=:0; exec {} -u -m raspidisplay.displaydaemon --backend {} --height {} --width {}".format(
+            self.remote_dirpath,
+            self.python_command,
+            self.output_backend,
+            self.dmd_shape[0],
+            self.dmd_shape[1],
+        )
+        if self.output_backend == "file":
+            daemon_command += " --output-path '{}'".format(self.remote_output_path)
+        if self.use_pattern_cache:
+            daemon_command += " --cache-dir '{}' --cache-max-bytes {}".format(self.remote_pattern_cache_dirpath, self.pattern_cache_max_bytes)
+        # The daemon's stderr goes to a log file on the Pi - nothing reads it over SSH, so it mustn't fill the channel
+        daemon_command += " 2> '{}'".format(self.remote_log_path)
+        
+        print("Starting display daemon: '{}'".format(daemon_command))
+        self._stdin, self._stdout, _ = self.ssh_client.exec_command(daemon_command)
+        
+        reply = self.request({"op": "hello"})
+        if tuple(reply["shape"]) != self.dmd_shape:
+            raise Exception("Display daemon is using shape {}, expected {}".format(reply["shape"], self.dmd_shape))
+        self.cached_keys = set(reply["cached_keys"])
+        self.compression_codecs = reply["compression_codecs"]
+        print("Display daemon running with '{}' backend, {} patterns cached".format(reply["backend"], len(self.cached_keys)))
+    
+    def request(self, meta, payload=b"", raise_on_error=True):
+        if not self.is_running():
+            raise Exception("Display daemon is not running, should call start before sending it requests")
+        
+        write_message(self._stdin, meta, payload)
+        reply = self._read_reply()
+        if not reply["ok"] and raise_on_error:
+            raise Exception("Display daemon error handling '{}': {}".format(meta["op"], reply["error"]))
+        
+        return reply
+    
+    def request_pipelined(self, messages, max_outstanding=16, raise_on_error=True):
+        # Sends (meta, payload) messages without waiting for each reply before writing the next, so a batch costs
+        # about one round trip instead of one per message. At most max_outstanding replies are left unread at a time,
+        # so the daemon never blocks writing replies nobody is reading. Returns the replies in order.
+        if not self.is_running():
+            raise Exception("Display daemon is not running, should call start before sending it requests")
+        
+        replies = []
+        sent_ops = []
+        for meta, payload in messages:
+            write_message(self._stdin, meta, payload)
+            sent_ops.append(meta["op"])
+            if len(sent_ops) - len(replies) >= max_outstanding:
+                replies.append(self._read_reply())
+        while len(replies) < len(sent_ops):
+            replies.append(self._read_reply())
+        
+        for op, reply in zip(sent_ops, replies):
+            if not reply["ok"] and raise_on_error:
+                raise Exception("Display daemon error handling '{}': {}".format(op, reply["error"]))
+        
+        return replies
+    
+    def trim_pattern_cache(self):
+        # Has the daemon evict least recently used patterns, if its cache has grown past its size limit
+        if not self.use_pattern_cache:
+            return
+        reply = self.request({"op": "trim_cache"})
+        self.cached_keys.difference_update(reply["evicted_cache_keys"])
+    
+    def _read_reply(self):
+        message = read_message(self._stdout)
+        if message is None:
+            self._stdin = None
+            self._stdout = None
+            raise Exception("Display daemon exited unexpectedly, see '{}' on the Pi".format(self.remote_log_path))
+        
+        reply, _ = message
+        return reply
+    
+    def stop(self):
+        if not self.is_running():
+            return
+        
+        try:
+            self.request({"op": "quit"})
+        finally:
+            self._stdin.close()
+            self._stdin = None
+            self._stdout = None
+
+
+class RaspiDaemonImageSender:
+    # Same interface as RaspiImageSender, but shows patterns through the resident display daemon
+    def __init__(self, display_daemon, compression="off"):
+        self.display_daemon = display_daemon
+        
+        # Format patterns are sent in, see convert_img_for_dmd. "auto" sends binary patterns bit-packed and grayscale
+        # ones as 8 bit
+        self.pattern_format = "auto"
+        
+        # Compression of frame payloads, with codecs both ends have, see TransferCompressor
+        self.compressor = TransferCompressor(
+            compression,
+            [c for c in raspidisplay.available_compression_codecs() if c in self.display_daemon.compression_codecs],
+            )
+        
+        # With delta updates, send_image only sends the tiles that changed since the frame the daemon is showing,
+        # which it patches in place. frame_on_pi is that frame, or None when it isn't known. Patterns changing in
+        # more than max_delta_fraction of the frame are sent whole. Only patterns sent as arrays go through this:
+        # PatternDescriptions, which the calibrator sends, are already smaller than a patch of the shapes in them
+        # would be, and leave frame_on_pi unknown, so the next array after one is sent whole.
+        self.use_delta_updates = True
+        self.delta_tile_size = 16
+        self.max_delta_fraction = 0.5
+        self.frame_on_pi = None
+        
+        # Timing info for each call to send_image or show_preloaded_image, see get_send_stats
+        self.send_stats = []
+        
+        # Pattern sent by stage_image, in the background, into this preload slot, and info about it once it's there
+        self.staged_image_index = -1
+        self._staging_task = None
+        self._staged_upload = None
+        
+        self.n_preloaded_images = 0
+        # Timing info for each call to preload_images, see get_preload_stats
+        self.preload_stats = []
+    
+    def get_send_stats(self):
+        return self.send_stats
+    
+    def get_preload_stats(self):
+        return self.preload_stats
+    
+    def send_image(self, np_float_img):
+        self.wait_for_staged_image()
+        if isinstance(np_float_img, PatternDescription):
+            self.send_pattern_description(np_float_img)
+            return
+        
+        send_start_time = time.perf_counter()
+        
+        frame = convert_img_for_dmd(np_float_img, self.pattern_format)
+        cache_key = pattern_cache_key(frame) if self.display_daemon.use_pattern_cache else None
+        encoded_time = time.perf_counter()
+        
+        # The daemon replies once the frame is on screen, so the reply doubles as the display acknowledgement.
+        # If it already has the pattern cached, only the key needs sending.
+        reply = None
+        cache_hit = False
+        n_bytes = 0
+        if cache_key in self.display_daemon.cached_keys:
+            reply = self.display_daemon.request({"op": "show_cached", "cache_key": cache_key}, raise_on_error=False)
+            if reply["ok"]:
+                cache_hit = True
+            elif reply.get("cache_miss"):
+                # Removed from the Pi behind our back, send the whole frame after all
+                self.display_daemon.cached_keys.discard(cache_key)
+                reply = None
+            else:
+                raise Exception("Display daemon error handling 'show_cached': {}".format(reply["error"]))
+        
+        codec, compression_ratio, compress_s = None, 1.0, 0.0
+        rects = None
+        if reply is None:
+            rects = self.delta_rects(frame)
+            if rects is not None:
+                frame_bytes = encode_pattern_rects(frame, rects)
+                meta = {
+                    "op": "patch_frame",
+                    "format": pattern_format_of_frame(frame),
+                    "rects": rects,
+                }
+            else:
+                frame_bytes = encode_pattern(frame)
+                meta = {
+                    "op": "show_frame",
+                    "format": pattern_format_of_frame(frame),
+                    "shape": list(frame.shape),
+                }
+            if cache_key is not None:
+                meta["cache_key"] = cache_key
+            payload, codec, compress_s = self.compress_payload(frame_bytes)
+            if codec is not None:
+                meta["compression"] = codec
+                compression_ratio = len(frame_bytes) / len(payload)
+            n_bytes = len(payload)
+            
+            transfer_start_time = time.perf_counter()
+            reply = self.display_daemon.request(meta, payload)
+            self.compressor.record_transfer(n_bytes, time.perf_counter() - transfer_start_time - reply["handle_ms"] / 1000)
+            if codec is not None:
+                self.compressor.record_decompress(len(frame_bytes), reply["decompress_ms"] / 1000)
+            if cache_key is not None:
+                self.display_daemon.cached_keys.add(cache_key)
+        self.frame_on_pi = frame
+        
+        send_end_time = time.perf_counter()
+        send_stats = {
+            "n_bytes": n_bytes,
+            "cache_hit": cache_hit,
+            "staged": False,
+            "delta": rects is not None,
+            "n_rects": len(rects) if rects is not None else 0,
+            "codec": codec,
+            "compression_ratio": compression_ratio,
+            "compress_s": compress_s,
+            "decompress_s": reply["decompress_ms"] / 1000,
+            "encode_s": encoded_time - send_start_time + compress_s,
+            "transfer_and_display_s": send_end_time - encoded_time - compress_s,
+            "display_s": reply["handle_ms"] / 1000,
+            "display_acked": True,
+            "total_s": send_end_time - send_start_time,
+        }
+        self.send_stats.append(send_stats)
+        print("Sent {} bytes{} to display daemon ({} compression, ratio {:.1f}) in {:.1f} ms (encode {:.1f} ms, of which compress {:.1f} ms, transfer and display {:.1f} ms, of which display {:.1f} ms)".format(
+            send_stats["n_bytes"],
+            " of {} changed rectangles".format(send_stats["n_rects"]) if send_stats["delta"] else "",
+            send_stats["codec"] or "no",
+            send_stats["compression_ratio"],
+            send_stats["total_s"] * 1000,
+            send_stats["encode_s"] * 1000,
+            send_stats["compress_s"] * 1000,
+            send_stats["transfer_and_display_s"] * 1000,
+            send_stats["display_s"] * 1000,
+        ))
+    
+    def send_pattern_description(self, description):
+        # The daemon draws the pattern itself, so only the description and any bitmaps in it are sent
+        send_start_time = time.perf_counter()
+        
+        meta = {"op": "show_description", "description": description.to_meta()}
+        bitmap_bytes = description.payload()
+        payload, codec, compress_s = self.compress_payload(bitmap_bytes)
+        if codec is not None:
+            meta["compression"] = codec
+        encoded_time = time.perf_counter()
+        
+        reply = self.display_daemon.request(meta, payload)
+        # The frame was drawn on the Pi, so this end doesn't know its pixels
+        self.frame_on_pi = None
+        
+        send_end_time = time.perf_counter()
+        send_stats = {
+            "n_bytes": len(json.dumps(meta)) + len(payload),
+            "cache_hit": False,
+            "staged": False,
+            "delta": False,
+            "n_rects": 0,
+            "codec": codec,
+            "compression_ratio": len(bitmap_bytes) / len(payload) if codec is not None else 1.0,
+            "compress_s": compress_s,
+            "decompress_s": reply["decompress_ms"] / 1000,
+            "encode_s": encoded_time - send_start_time,
+            "transfer_and_display_s": send_end_time - encoded_time,
+            "display_s": reply["handle_ms"] / 1000,
+            "display_acked": True,
+            "total_s": send_end_time - send_start_time,
+        }
+        self.send_stats.append(send_stats)
+        print("Sent description of {} shapes to display daemon, {} bytes, in {:.1f} ms (drawing and display {:.1f} ms)".format(
+            len(meta["description"]["shapes"]),
+            send_stats["n_bytes"],
+            send_stats["total_s"] * 1000,
+            send_stats["display_s"] * 1000,
+        ))
+    
+    def delta_rects(self, frame):
+        # Rectangles to send to update frame_on_pi to frame, or None if frame should be sent whole
+        if not self.use_delta_updates or self.frame_on_pi is None:
+            return None
+        if self.frame_on_pi.dtype != frame.dtype or self.frame_on_pi.shape != frame.shape:
+            return None
+        
+        rects = dirty_rects(self.frame_on_pi, frame, self.delta_tile_size)
+        if sum(h * w for _, _, h, w in rects) > self.max_delta_fraction * frame.size:
+            return None
+        return rects
+    
+    def compress_payload(self, frame_bytes):
+        # Returns the payload to send, the codec it's compressed with or None, and the time spent compressing
+        if len(frame_bytes) == 0:
+            return frame_bytes, None, 0.0
+        codec = self.compressor.codec_to_try()
+        if codec is None:
+            return frame_bytes, None, 0.0
+        
+        compress_start_time = time.perf_counter()
+        compressed_bytes = raspidisplay.compress_payload(frame_bytes, codec)
+        compress_s = time.perf_counter() - compress_start_time
+        
+        if not self.compressor.worth_sending_compressed(len(frame_bytes), len(compressed_bytes), compress_s):
+            return frame_bytes, None, compress_s
+        return compressed_bytes, codec, compress_s
+    
+    def preload_images(self, np_float_imgs):
+        # Uploads a whole sequence of patterns to the daemon's memory as one pipelined batch, so during acquisition
+        # show_preloaded_image only sends a tiny message. np_float_imgs can be any iterable, e.g. a generator.
+        self.wait_for_staged_image()
+        preload_start_time = time.perf_counter()
+        n_bytes = 0
+        n_raw_bytes = 0
+        n_cache_hits = 0
+        compress_s = 0.0
+        # Cache keys of the frames sent whole in this batch, which later copies in the batch can load from the cache.
+        # They're only added to cached_keys once the daemon has acked them.
+        batch_cache_keys = set()
+        # Messages that only sent a cache key, with their frames, in case the daemon doesn't have them after all
+        cache_hit_messages = {}
+        
+        def preload_messages():
+            nonlocal n_bytes, n_raw_bytes, n_cache_hits, compress_s
+            yield {"op": "clear_preloaded"}, b""
+            for index, np_float_img in enumerate(np_float_imgs):
+                meta, payload, message_info = self.preload_message(index, np_float_img, batch_cache_keys)
+                if message_info["cache_hit"]:
+                    cache_hit_messages[index] = (meta, message_info["frame"])
+                elif "cache_key" in meta:
+                    batch_cache_keys.add(meta["cache_key"])
+                n_raw_bytes += message_info["n_raw_bytes"]
+                n_bytes += message_info["n_bytes"]
+                n_cache_hits += message_info["cache_hit"]
+                compress_s += message_info["compress_s"]
+                yield meta, payload
+        
+        replies = self.display_daemon.request_pipelined(preload_messages(), raise_on_error=False)
+        self.n_preloaded_images = len(replies) - 1
+        
+        for reply_index, reply in enumerate(replies):
+            if reply["ok"]:
+                continue
+            index = reply_index - 1
+            if not reply.get("cache_miss") or index not in cache_hit_messages:
+                raise Exception("Display daemon error handling '{}': {}".format(reply["op"], reply["error"]))
+            
+            # Removed from the Pi behind our back, send the whole frame after all
+            meta, frame = cache_hit_messages[index]
+            self.display_daemon.cached_keys.discard(meta["cache_key"])
+            batch_cache_keys.discard(meta["cache_key"])
+            meta, payload, message_info = self.frame_preload_message(index, frame, allow_cache_hit=False)
+            replies[reply_index] = self.display_daemon.request(meta, payload)
+            batch_cache_keys.add(meta["cache_key"])
+            n_raw_bytes += message_info["n_raw_bytes"]
+            n_bytes += message_info["n_bytes"]
+            n_cache_hits -= 1
+            compress_s += message_info["compress_s"]
+        
+        self.display_daemon.cached_keys.update(batch_cache_keys)
+        
+        preload_end_time = time.perf_counter()
+        self.preload_stats.append({
+            "n_images": self.n_preloaded_images,
+            "n_cache_hits": n_cache_hits,
+            "n_bytes": n_bytes,
+            "compression_ratio": n_raw_bytes / n_bytes if n_bytes != 0 else 1.0,
+            "compress_s": compress_s,
+            "decompress_s": sum(r["decompress_ms"] for r in replies) / 1000,
+            "total_s": preload_end_time - preload_start_time,
+        })
+        print("Preloaded {} images ({} already on Pi), {} bytes (compression ratio {:.1f}), in {:.1f} ms".format(
+            self.n_preloaded_images,
+            n_cache_hits,
+            n_bytes,
+            self.preload_stats[-1]["compression_ratio"],
+            (preload_end_time - preload_start_time) * 1000,
+        ))
+    
+    def preload_message(self, index, np_float_img, batch_cache_keys=()):
+        # Returns the message that preloads a pattern into the daemon's slot index, and a dict of info about it. Frames
+        # the daemon has cached, or that are in batch_cache_keys, are only sent as their cache key.
+        if isinstance(np_float_img, PatternDescription):
+            # Drawn on the Pi, and not worth caching
+            meta = {"op": "preload_description", "index": index, "description": np_float_img.to_meta()}
+            bitmap_bytes = np_float_img.payload()
+            payload, codec, compress_s = self.compress_payload(bitmap_bytes)
+            if codec is not None:
+                meta["compression"] = codec
+            return meta, payload, {
+                "frame": None,
+                "cache_hit": False,
+                "n_raw_bytes": len(json.dumps(meta)) + len(bitmap_bytes),
+                "n_bytes": len(json.dumps(meta)) + len(payload),
+                "codec": codec,
+                "compress_s": compress_s,
+            }
+        
+        return self.frame_preload_message(index, convert_img_for_dmd(np_float_img, self.pattern_format), batch_cache_keys=batch_cache_keys)
+    
+    def frame_preload_message(self, index, frame, allow_cache_hit=True, batch_cache_keys=()):
+        # Like preload_message, for a frame already converted for the DMD. Sending the cache key isn't taken as the
+        # daemon having the frame cached, callers add it to cached_keys once the daemon acks the message.
+        meta = {
+            "op": "preload_frame",
+            "index": index,
+            "format": pattern_format_of_frame(frame),
+            "shape": list(frame.shape),
+        }
+        
+        if self.display_daemon.use_pattern_cache:
+            meta["cache_key"] = pattern_cache_key(frame)
+            is_cached = meta["cache_key"] in self.display_daemon.cached_keys or meta["cache_key"] in batch_cache_keys
+            if allow_cache_hit and is_cached:
+                # The daemon loads it from its cache
+                return meta, b"", {"frame": frame, "cache_hit": True, "n_raw_bytes": 0, "n_bytes": 0, "codec": None, "compress_s": 0.0}
+        
+        frame_bytes = encode_pattern(frame)
+        payload, codec, compress_s = self.compress_payload(frame_bytes)
+        if codec is not None:
+            meta["compression"] = codec
+        return meta, payload, {
+            "frame": frame,
+            "cache_hit": False,
+            "n_raw_bytes": len(frame_bytes),
+            "n_bytes": len(payload),
+            "codec": codec,
+            "compress_s": compress_s,
+        }
+    
+    def stage_image(self, np_float_img):
+        # Starts sending a pattern to the daemon in the background and returns straight away, so the transfer can
+        # overlap with something else, like a camera exposure of the pattern on screen. The daemon holds it in a
+        # preload slot of its own until show_staged_image puts it on screen. Nothing else should use this image
+        # sender until show_staged_image is called.
+        if self._staging_task is not None or self._staged_upload is not None:
+            raise Exception("An image is already staged, should call show_staged_image before staging another")
+        
+        self._staging_task = BackgroundTask(self.upload_staged_image, np_float_img)
+    
+    def upload_staged_image(self, np_float_img):
+        upload_start_time = time.perf_counter()
+        meta, payload, message_info = self.preload_message(self.staged_image_index, np_float_img)
+        encoded_time = time.perf_counter()
+        
+        reply = self.display_daemon.request(meta, payload, raise_on_error=False)
+        if not reply["ok"] and reply.get("cache_miss") and message_info["cache_hit"]:
+            # Removed from the Pi behind our back, send the whole frame after all
+            self.display_daemon.cached_keys.discard(meta["cache_key"])
+            meta, payload, message_info = self.frame_preload_message(self.staged_image_index, message_info["frame"], allow_cache_hit=False)
+            reply = self.display_daemon.request(meta, payload, raise_on_error=False)
+        if not reply["ok"]:
+            raise Exception("Display daemon error handling '{}': {}".format(meta["op"], reply["error"]))
+        if "cache_key" in meta and not message_info["cache_hit"]:
+            self.display_daemon.cached_keys.add(meta["cache_key"])
+        
+        message_info["encode_s"] = encoded_time - upload_start_time
+        message_info["transfer_s"] = time.perf_counter() - encoded_time
+        message_info["decompress_s"] = reply["decompress_ms"] / 1000
+        return message_info
+    
+    def wait_for_staged_image(self):
+        # Waits for a staged transfer to finish, so the channel to the daemon is free for something else
+        if self._staging_task is None:
+            return
+        try:
+            self._staged_upload = self._staging_task.result()
+        finally:
+            self._staging_task = None
+    
+    def show_staged_image(self):
+        self.wait_for_staged_image()
+        if self._staged_upload is None:
+            raise Exception("No image is staged, should call stage_image before show_staged_image")
+        staged_upload = self._staged_upload
+        self._staged_upload = None
+        
+        show_start_time = time.perf_counter()
+        reply = self.display_daemon.request({"op": "show_preloaded", "index": self.staged_image_index})
+        show_end_time = time.perf_counter()
+        self.frame_on_pi = staged_upload["frame"]
+        
+        self.send_stats.append({
+            "n_bytes": staged_upload["n_bytes"],
+            "cache_hit": staged_upload["cache_hit"],
+            # Staged images were sent in the background, so only transfer_and_display_s was spent waiting
+            "staged": True,
+            "delta": False,
+            "n_rects": 0,
+            "codec": staged_upload["codec"],
+            "compression_ratio": staged_upload["n_raw_bytes"] / staged_upload["n_bytes"] if staged_upload["n_bytes"] != 0 else 1.0,
+            "compress_s": staged_upload["compress_s"],
+            "decompress_s": staged_upload["decompress_s"],
+            "encode_s": staged_upload["encode_s"],
+            "transfer_and_display_s": show_end_time - show_start_time,
+            "display_s": reply["handle_ms"] / 1000,
+            "display_acked": True,
+            "total_s": staged_upload["encode_s"] + staged_upload["transfer_s"] + show_end_time - show_start_time,
+        })
+    
+    def show_preloaded_image(self, index):
+        if index < 0 or index >= self.n_preloaded_images:
+            raise Exception("No preloaded image at index {}, {} images are preloaded".format(index, self.n_preloaded_images))
+        self.wait_for_staged_image()
+        
+        show_start_time = time.perf_counter()
+        reply = self.display_daemon.request({"op": "show_preloaded", "index": index})
+        show_end_time = time.perf_counter()
+        # Preloaded frames aren't kept on this end
+        self.frame_on_pi = None
+        
+        self.send_stats.append({
+            "n_bytes": 0,
+            "cache_hit": False,
+            "staged": False,
+            "delta": False,
+            "n_rects": 0,
+            "codec": None,
+            "compression_ratio": 1.0,
+            "compress_s": 0.0,
+            "decompress_s": 0.0,
+            "encode_s": 0.0,
+            "transfer_and_display_s": show_end_time - show_start_time,
+            "display_s": reply["handle_ms"] / 1000,
+            "display_acked": True,
+            "total_s": show_end_time - show_start_time,
+        })
+    
+    def clear(self):
+        self.wait_for_staged_image()
+        self._staged_upload = None
+        self.display_daemon.request({"op": "clear"})
+        self.frame_on_pi = np.zeros((DmdConstants.DMD_H, DmdConstants.DMD_W), dtype=bool)
+        if self.n_preloaded_images != 0:
+            self.display_daemon.request({"op": "clear_preloaded"})
+            self.n_preloaded_images = 0
+
+
+class RaspiDaemonImageSenderContextManager:
+    def __init__(self, display_daemon, compression="off"):
+        self.display_daemon = display_daemon
+        self.compression = compression
+        
+        self.entered = False
+        self.exited = False
+    
+    def __enter__(self):
+        if self.entered:
+            raise RuntimeError("__enter__ has been called twice on RaspiDaemonImageSenderContextManager - only meant to be used once!")
+        self.entered = True
+        
+        # The daemon itself stays up between image senders, so there's nothing to start here
+        self.sender = RaspiDaemonImageSender(self.display_daemon, compression=self.compression)
+        
+        return self.sender
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.entered:
+            raise RuntimeError("__exit__ called on RaspiDaemonImageSenderContextManager without __enter__ called.")
+        if self.display_daemon.is_running():
+            self.sender.clear()
+            self.display_daemon.trim_pattern_cache()
         self.exited = True
 
 class RaspiInterface:
-    def __init__(self, hostname, username, password, tempdirpath):
+    display_methods = ["feh", "daemon"]
+    
+    def __init__(self, hostname, username, password, tempdirpath, display_method="feh", daemon_output_backend="x11", use_pattern_cache=True):
+        if display_method not in self.display_methods:
+            raise Exception("Invalid display method '{}': must be from list '{}'".format(display_method, self.display_methods))
+        
         self.ssh_client = paramiko.SSHClient()
         self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         
@@ -237,20 +1678,48 @@ class RaspiInterface:
         self.tempdirpath = tempdirpath
         os.makedirs(self.tempdirpath, exist_ok=True)
         
-        self.image_sender_tempdirpath = os.path.join(self.tempdirpath, "raspiImageSenderTmpImages")
-        os.makedirs(self.image_sender_tempdirpath, exist_ok=True)
-        
+        # With the "daemon" display method, the display daemon is started once here and shows every pattern
+        # sent by image senders created afterwards. "feh" starts a feh slideshow for each image sender instead.
+        self.display_method = display_method
+        # Whether patterns are kept on the Pi between sessions in a content-addressed cache, so they're only uploaded once
+        self.use_pattern_cache = use_pattern_cache
+        self.display_daemon = None
+        if self.display_method == "daemon":
+            self.display_daemon = RaspiDisplayDaemon(
+                self.ssh_client,
+                self.raspi_remote_img_dirpath + "/display_daemon",
+                daemon_output_backend,
+                use_pattern_cache=self.use_pattern_cache,
+                )
+            try:
+                self.display_daemon.start()
+            except Exception as e:
+                raise RaspiConnectionError("Starting display daemon: {}".format(str(e)))
     
-    def image_sender(self):
+    def close(self):
+        if self.display_daemon is not None:
+            self.display_daemon.stop()
+        self.ssh_client.close()
+    
+    def image_sender(self, display_sync="ack", compression="off"):
         if self.last_created_raspi_image_context_manager is not None:
-            if (last_created_raspi_image_context_manager.entered and
-                not last_created_raspi_image_context_manager.exited):
+            if (self.last_created_raspi_image_context_manager.entered and
+                not self.last_created_raspi_image_context_manager.exited):
                 raise RuntimeError(
                     "Cannot create new image sender until previous one has " +
                     "finished running - Raspi can only have one running at a given time.")
         
         # @TODO find out how __enter__ __exit__ logic is really supposed to work and implement better
-        context_manager = RaspiImageSenderContextManager(self.ssh_client, self.image_sender_tempdirpath, self.raspi_remote_img_dirpath)
+        if self.display_daemon is not None:
+            context_manager = RaspiDaemonImageSenderContextManager(self.display_daemon, compression=compression)
+        else:
+            context_manager = RaspiImageSenderContextManager(
+                self.ssh_client,
+                self.raspi_remote_img_dirpath,
+                display_sync=display_sync,
+                use_pattern_cache=self.use_pattern_cache,
+                compression=compression,
+                )
         self.last_created_raspi_image_context_manager = context_manager
         return context_manager
         
\ No newline at end of file
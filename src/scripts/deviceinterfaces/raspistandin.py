@@ -0,0 +1,168 @@
+import io
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import tifffile
+
+from ..raspidisplay import frame_for_display
+
+# Local stand-ins for the Raspberry Pi end of the SSH connection, so RaspiImageSender can be run and tested
+# without hardware. "Remote" paths are just paths on the local machine.
+
+
+class StandInFehDisplay:
+    # Pretends to be feh running as a slideshow on the Pi: every reload interval it rescans the slideshow
+    # folder, and when the image it was showing is gone it "renders" the next one, running the --info
+    # command for it like feh does.
+    def __init__(self, slideshow_dirpath, reload_interval_s, info_command=None, render_delay_s=0.0):
+        self.slideshow_dirpath = slideshow_dirpath
+        self.reload_interval_s = reload_interval_s
+        self.info_command = info_command
+        self.render_delay_s = render_delay_s
+
+        self.current_image_name = None
+        self.current_image = None
+        self.shown_image_names = []
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._reload()
+            self._stop_event.wait(self.reload_interval_s)
+
+    def _reload(self):
+        image_names = sorted(os.listdir(self.slideshow_dirpath))
+        if len(image_names) == 0 or self.current_image_name in image_names:
+            return
+
+        image_name = image_names[0]
+        time.sleep(self.render_delay_s)
+
+        try:
+            # Held as the 8 bit frame the screen would show, whatever format the TIFF was sent in
+            self.current_image = frame_for_display(tifffile.imread(os.path.join(self.slideshow_dirpath, image_name)))
+        except FileNotFoundError:
+            # Symlink was swapped out from under us, pick it up on the next reload
+            return
+        self.current_image_name = image_name
+        self.shown_image_names.append(image_name)
+
+        if self.info_command is not None:
+            subprocess.run(self.info_command.replace("%n", image_name), shell=True)
+
+
+class StandInSftpAttributes:
+    def __init__(self, filename, st_size, st_mtime):
+        self.filename = filename
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+
+
+class StandInRaspiSftpClient:
+    def __init__(self):
+        self.closed = False
+        self.n_uploads = 0
+
+    def put(self, localpath, remotepath, callback=None, confirm=True):
+        self.n_uploads += 1
+        shutil.copyfile(localpath, remotepath)
+
+    def putfo(self, fl, remotepath, file_size=0, callback=None, confirm=True):
+        self.n_uploads += 1
+        with open(remotepath, "wb") as f:
+            shutil.copyfileobj(fl, f)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def listdir_attr(self, path):
+        # paramiko's SFTPAttributes carry the file name along with the stat fields
+        attrs = []
+        for entry in os.scandir(path):
+            entry_stat = entry.stat()
+            attrs.append(StandInSftpAttributes(entry.name, entry_stat.st_size, entry_stat.st_mtime))
+        return attrs
+
+    def remove(self, path):
+        os.remove(path)
+
+    def close(self):
+        self.closed = True
+
+
+class StandInRaspiSshClient:
+    # Stands in for a paramiko.SSHClient connected to the Pi. Shell commands run on the local machine, except for
+    # feh, which is simulated with StandInFehDisplay. The display daemon really runs, as a local subprocess whose
+    # stdin and stdout stand in for the SSH channel.
+    def __init__(self, feh_render_delay_s=0.0):
+        self.feh_render_delay_s = feh_render_delay_s
+        self.feh_display = None
+        self.daemon_processes = []
+        self.executed_commands = []
+        # Every SFTP session opened, in order
+        self.sftp_clients = []
+
+    def exec_command(self, command):
+        self.executed_commands.append(command)
+
+        if "raspidisplay.displaydaemon" in command:
+            return self._start_daemon(command)
+        elif command.startswith("pkill feh"):
+            stdout_text, stderr_text = self._kill_feh()
+        elif re.search(r"\bfeh\b", command):
+            stdout_text, stderr_text = self._start_feh(command)
+        else:
+            completed = subprocess.run(command, shell=True, capture_output=True, text=True)
+            stdout_text, stderr_text = completed.stdout, completed.stderr
+
+        return io.StringIO(), io.StringIO(stdout_text), io.StringIO(stderr_text)
+
+    def open_sftp(self):
+        self.sftp_clients.append(StandInRaspiSftpClient())
+        return self.sftp_clients[-1]
+
+    def close(self):
+        self._kill_feh()
+        for process in self.daemon_processes:
+            process.stdin.close()
+            process.wait()
+
+    def _start_daemon(self, command):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.daemon_processes.append(process)
+
+        return process.stdin, process.stdout, io.BytesIO()
+
+    def _start_feh(self, command):
+        reload_match = re.search(r"--reload ([0-9.]+)", command)
+        info_match = re.search(r'--info "(.*?)"', command)
+        slideshow_dirpath = re.findall(r"'([^']*)'", command)[-1]
+
+        self.feh_display = StandInFehDisplay(
+            slideshow_dirpath,
+            float(reload_match.group(1)) if reload_match is not None else 0.1,
+            info_command=info_match.group(1) if info_match is not None else None,
+            render_delay_s=self.feh_render_delay_s,
+        )
+        self.feh_display.start()
+
+        return "", ""
+
+    def _kill_feh(self):
+        # Keeps feh_display around after stopping it, so tests can check what was shown
+        if self.feh_display is not None and not self.feh_display._stop_event.is_set():
+            self.feh_display.stop()
+
+        return "", ""
@@ -17,9 +17,10 @@ from PyQt6.QtCore import Qt
 from .errordialog import ErrorDialog
 from ..constants import Messages, DmdConstants
 from ..calibration import Calibrator, CalibrationException
+from ..raspidisplay import circle_stamp_at, blit_stamp
 
 def make_image_flipper(np_images, label_str=None, under_label=None):
-    np_images = np.array(np_images)
+    np_images = np.asarray(np_images)
     flipperWidget = QWidget()
     flipVLay = QVBoxLayout()
     flipperWidget.setLayout(flipVLay)
@@ -49,24 +50,8 @@ def draw_white_circle(np_float_img, diameter, center_x, center_y):
     assert diameter > 0, "Diameter should be positive"
     assert diameter % 2 == 1, "Diameter should be odd, so the circle will be centered on a single pixel"
 
-    diameter = int(diameter)
-    center_x = int(center_x)
-    center_y = int(center_y)
-
-    circ_xx, circ_yy = np.meshgrid(np.arange(diameter), np.arange(diameter))
-
-    # This should already be a whole number, but casting to an integer so we can array index with it
-    rad = int((diameter - 1) / 2)
-
-    circ_mask = (np.square(circ_xx - rad) + np.square(circ_yy - rad)) <= np.square(rad + 0.5)
-
-    # Convert to float
-    circ_mask  = circ_mask.astype(float)
-
-    np_float_img[center_y - rad:center_y + rad + 1, center_x - rad:center_x + rad + 1] += circ_mask
-
-    # If the spot wasn't already white, then it'll have brightness more than 1.0 now - fix this here
-    np_float_img[np_float_img > 1.0] = 1.0
+    # Pixels within diameter / 2 of the center, cut off at the edges of the image
+    blit_stamp(np_float_img, *circle_stamp_at(center_x, center_y, diameter), 1.0)
 
 
 class CoordCalibrationDialog(QDialog):
@@ -144,13 +129,17 @@ class BrightnessCalibrationDialog(QDialog):
 
         self.show_status(Messages.calibrating_colon + Messages.solid_bright_and_dark_field)
         
-        self.calibrator.take_solid_bright_and_dark_field_data()
+        # Kept to show them below, unless cached results are used and there are no new pics
+        self.calibrator.keep_solid_field_pics = True
+        used_cached_results = self.calibrator.calibrate_brightness()
         solid_bright_pics, solid_dark_pics = self.calibrator.get_solid_bright_and_dark_cam_pics()
         
-        self.calibrator.calculate_bright_and_dark_levels()
         bright_level, dark_level = self.calibrator.get_bright_and_dark_levels()
         
-        self.show_status(Messages.done_calibrating_brightness)
+        if used_cached_results:
+            self.show_status(Messages.reused_cached_brightness_calibration)
+        else:
+            self.show_status(Messages.done_calibrating_brightness)
         
         if solid_bright_pics is not None:
             if bright_level is not None:
@@ -195,7 +184,7 @@ class BrightnessCalibrationDialog(QDialog):
 
 
 class DmdCalibrationDialog(QDialog):
-    def __init__(self, pycroInterface, raspiInterface):
+    def __init__(self, pycroInterface, raspiInterface, brightness_calibration_cache_dirpath=None):
         super().__init__()
         pg.setConfigOptions(antialias=True)
 
@@ -209,6 +198,11 @@ class DmdCalibrationDialog(QDialog):
         self.exposureMsWidget.setText("100")
         self.vlayout.addWidget(self.exposureMsWidget)
 
+        # Searches for an exposure, starting from the one entered, and fills it in
+        self.autoExposureButton = QPushButton(Messages.button_label_auto_exposure)
+        self.autoExposureButton.clicked.connect(self.auto_exposure_button_clicked)
+        self.vlayout.addWidget(self.autoExposureButton)
+
         self.beginButton = QPushButton(Messages.begin)
         self.beginButton.clicked.connect(self.brightness_calibration_button_clicked)
 
@@ -220,10 +214,12 @@ class DmdCalibrationDialog(QDialog):
         self.pycroInterface = pycroInterface
         self.raspiInterface = raspiInterface
         # self.usingStandins = usingStandins
-        self.calibrator = Calibrator(self.pycroInterface, self.raspiInterface, self.exposureMs)
+        self.brightness_calibration_cache_dirpath = brightness_calibration_cache_dirpath
+        self.calibrator = None
 
 
-    def brightness_calibration_button_clicked(self):
+    def parse_exposure_ms_widget(self):
+        # Exposure entered in the widget, or None after showing an error if it isn't valid
         widgetTxt = self.exposureMsWidget.text()
         
         try:
@@ -231,15 +227,47 @@ class DmdCalibrationDialog(QDialog):
         except ValueError:
             dlg = ErrorDialog(Messages.invalid_field_title, "Can't parse '{}' as floating point number".format(widgetTxt))
             dlg.exec()
-            return
+            return None
         
         if exposureFlt <= 0:
             dlg = ErrorDialog(Messages.invalid_field_title, "Exposure must be greater than zero - invalid value '{}'".format(widgetTxt))
             dlg.exec()
+            return None
+        
+        return exposureFlt
+
+    def auto_exposure_button_clicked(self):
+        exposureFlt = self.parse_exposure_ms_widget()
+        if exposureFlt is None:
+            return
+        
+        self.pycroInterface.invalidate_applied_settings()
+        
+        # Only used for the search, the calibration gets its own Calibrator with whatever exposure ends up entered
+        calibrator = Calibrator(self.pycroInterface, self.raspiInterface, exposureFlt, self.brightness_calibration_cache_dirpath)
+        try:
+            exposureFlt = calibrator.find_auto_exposure()
+        except CalibrationException as e:
+            dlg = ErrorDialog(Messages.calibration_error, str(e))
+            dlg.exec()
+            return
+        
+        self.exposureMsWidget.setText("{:.4g}".format(exposureFlt))
+
+    def brightness_calibration_button_clicked(self):
+        exposureFlt = self.parse_exposure_ms_widget()
+        if exposureFlt is None:
             return
         
         self.exposureMsWidget.setEnabled(False)
+        self.autoExposureButton.setEnabled(False)
         self.beginButton.setEnabled(False)
         
+        # Settings may have been changed in the Micro-Manager GUI since they were last set from here
+        self.pycroInterface.invalidate_applied_settings()
+        
+        # Made here, once the exposure is known
+        self.calibrator = Calibrator(self.pycroInterface, self.raspiInterface, exposureFlt, self.brightness_calibration_cache_dirpath)
+        
         dlg = BrightnessCalibrationDialog(self.pycroInterface, self.raspiInterface, self.calibrator, exposureFlt)
         dlg.exec()
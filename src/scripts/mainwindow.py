@@ -93,7 +93,7 @@ class MainWindow(QMainWindow):
     
     def calibrateDmdButtonClicked(self):
         print("Calibrating dmd")
-        dmdcalibrationdialog = DmdCalibrationDialog(self.pycroInterface, self.raspiInterface)
+        dmdcalibrationdialog = DmdCalibrationDialog(self.pycroInterface, self.raspiInterface, os.path.join(self.workdir, "brightnesscache"))
         dmdcalibrationdialog.exec()
 
         
@@ -166,6 +166,17 @@ class MainWindow(QMainWindow):
         
         self.updateOptions()
     
+    def closeEvent(self, event):
+        # Stops the display daemon and closes the SSH connection, so neither is left running on the Pi after exit
+        if self.raspiInterface is not None:
+            try:
+                self.raspiInterface.close()
+            except Exception as e:
+                print("Failed to close Raspi connection: {}".format(str(e)))
+            self.raspiInterface = None
+        
+        super().closeEvent(event)
+    
     def updateOptions(self):
         if self.pycroInterface is not None:
 
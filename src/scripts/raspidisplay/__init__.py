@@ -0,0 +1,51 @@
+# Code that runs on the Raspberry Pi. RaspiInterface copies this package onto the Pi and runs it with
+# "python3 -m raspidisplay.displaydaemon", so it can only use the standard library and numpy, and
+# displaydaemon isn't imported here so that running it as __main__ doesn't import it twice.
+from .protocol import (
+    read_message,
+    write_message,
+    ProtocolError
+    )
+
+from .backends import (
+    DISPLAY_BACKENDS,
+    make_display_backend
+    )
+
+from .patterncache import (
+    PatternCache,
+    CacheMiss
+    )
+
+from .patternformats import (
+    PATTERN_FORMATS,
+    pattern_format_of_frame,
+    encode_pattern,
+    encode_pattern_rects,
+    encoded_pattern_size,
+    decode_pattern,
+    frame_for_display
+    )
+
+from .compression import (
+    COMPRESSION_CODECS,
+    COMPRESSION_LEVELS,
+    available_compression_codecs,
+    compress_payload,
+    decompress_payload
+    )
+
+from .rasterize import (
+    circle_stamp,
+    circle_stamp_at,
+    clip_stamp,
+    blit_stamp,
+    PatternFrameBuffer,
+    render_circle_patterns
+    )
+
+from .shapes import (
+    SHAPE_TYPES,
+    PatternDescription,
+    render_pattern_description
+    )
@@ -0,0 +1,103 @@
+import os
+import numpy as np
+
+# Output backends for the display daemon. Each one takes (h, w) uint8 frames and puts them on the DMD's screen,
+# or somewhere that stands in for it.
+
+class FileDisplayBackend:
+    # Stand-in for a screen, for testing without a display: each shown frame replaces the .npy file at output_path
+    name = "file"
+    
+    def __init__(self, shape, output_path):
+        self.shape = shape
+        self.output_path = output_path
+        self.frames_shown = 0
+    
+    def show(self, frame):
+        # Write then rename, so a reader never sees a half-written frame
+        tmp_path = self.output_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, frame)
+        os.replace(tmp_path, self.output_path)
+        self.frames_shown += 1
+    
+    def close(self):
+        pass
+
+
+class FramebufferDisplayBackend:
+    # Writes straight into the Linux framebuffer device, with no X server in between
+    name = "framebuffer"
+    
+    def __init__(self, shape, fbdev="/dev/fb0"):
+        self.shape = shape
+        sys_dirpath = os.path.join("/sys/class/graphics", os.path.basename(fbdev))
+        
+        with open(os.path.join(sys_dirpath, "virtual_size")) as f:
+            self.fb_w, self.fb_h = [int(v) for v in f.read().strip().split(",")]
+        with open(os.path.join(sys_dirpath, "bits_per_pixel")) as f:
+            self.fb_bpp = int(f.read().strip())
+        with open(os.path.join(sys_dirpath, "stride")) as f:
+            self.fb_stride = int(f.read().strip())
+        
+        if self.fb_bpp not in [16, 32]:
+            raise Exception("Unsupported framebuffer depth {} bits per pixel, should be 16 or 32".format(self.fb_bpp))
+        
+        self._fb = np.memmap(fbdev, dtype=np.uint8, mode="r+", shape=(self.fb_h, self.fb_stride))
+    
+    def show(self, frame):
+        h = min(frame.shape[0], self.fb_h)
+        w = min(frame.shape[1], self.fb_w)
+        frame = frame[:h, :w]
+        
+        if self.fb_bpp == 32:
+            rows = self._fb[:h, :self.fb_w * 4].reshape(h, self.fb_w, 4)
+            rows[:, :w, :3] = frame[:, :, np.newaxis]
+        else:
+            # RGB565
+            frame16 = frame.astype(np.uint16)
+            rows = self._fb[:h, :self.fb_w * 2].view(np.uint16)
+            rows[:, :w] = ((frame16 >> 3) << 11) | ((frame16 >> 2) << 5) | (frame16 >> 3)
+    
+    def close(self):
+        self._fb.flush()
+        del self._fb
+
+
+class X11DisplayBackend:
+    # Fullscreen borderless Tk window on the X display given by $DISPLAY
+    name = "x11"
+    
+    def __init__(self, shape):
+        import tkinter
+        
+        self.shape = shape
+        self._root = tkinter.Tk()
+        self._root.attributes("-fullscreen", True)
+        self._root.configure(background="black", cursor="none")
+        
+        self._photo = tkinter.PhotoImage(width=shape[1], height=shape[0])
+        label = tkinter.Label(self._root, image=self._photo, borderwidth=0, highlightthickness=0, background="black")
+        label.pack()
+        self._root.update()
+    
+    def show(self, frame):
+        h, w = frame.shape
+        pgm_bytes = b"P5 %d %d 255\n" % (w, h) + frame.tobytes()
+        self._photo.configure(data=pgm_bytes, format="PPM")
+        self._root.update()
+    
+    def close(self):
+        self._root.destroy()
+
+
+DISPLAY_BACKENDS = {
+    FileDisplayBackend.name: FileDisplayBackend,
+    FramebufferDisplayBackend.name: FramebufferDisplayBackend,
+    X11DisplayBackend.name: X11DisplayBackend,
+}
+
+def make_display_backend(name, shape, **backend_kwargs):
+    if name not in DISPLAY_BACKENDS:
+        raise Exception("Unknown display backend '{}': must be from list '{}'".format(name, list(DISPLAY_BACKENDS)))
+    return DISPLAY_BACKENDS[name](shape, **backend_kwargs)
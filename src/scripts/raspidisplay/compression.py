@@ -0,0 +1,41 @@
+import zlib
+
+# zstd is much faster than zlib at a similar ratio, but needs the zstandard package, which may not be installed
+# on the Pi or on the desktop. zlib always works.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codecs for compressing frame payloads on the way to the Pi. Calibration patterns are mostly one value, so even
+# the fastest levels shrink them by orders of magnitude.
+COMPRESSION_CODECS = ["zlib", "zstd"]
+
+COMPRESSION_LEVELS = {
+    "zlib": 1,
+    "zstd": 1,
+}
+
+def available_compression_codecs():
+    codecs = ["zlib"]
+    if zstandard is not None:
+        codecs.append("zstd")
+    return codecs
+
+def check_compression_codec(codec):
+    if codec not in COMPRESSION_CODECS:
+        raise Exception("Invalid compression codec '{}': must be from list '{}'".format(codec, COMPRESSION_CODECS))
+    if codec not in available_compression_codecs():
+        raise Exception("Compression codec '{}' needs the zstandard package, which isn't installed".format(codec))
+
+def compress_payload(payload, codec):
+    check_compression_codec(codec)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVELS["zstd"]).compress(payload)
+    return zlib.compress(payload, COMPRESSION_LEVELS["zlib"])
+
+def decompress_payload(payload, codec):
+    check_compression_codec(codec)
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
@@ -0,0 +1,237 @@
+import argparse
+import sys
+import time
+import numpy as np
+
+from .protocol import read_message, write_message
+from .backends import DISPLAY_BACKENDS, make_display_backend
+from .patterncache import PatternCache, CacheMiss
+from .patternformats import decode_pattern, encoded_pattern_size
+from .compression import available_compression_codecs, decompress_payload
+from .shapes import render_pattern_description
+
+# Runs on the Raspberry Pi. Started once over SSH, then reads messages from stdin and answers each one
+# with a reply on stdout, so every pattern switch costs one message on an already-open channel.
+# Only uses the standard library and numpy, since this package is copied onto the Pi as-is.
+
+class DisplayDaemon:
+    def __init__(self, backend, shape, in_stream, out_stream, pattern_cache=None):
+        self.backend = backend
+        self.shape = tuple(shape)
+        self.in_stream = in_stream
+        self.out_stream = out_stream
+
+        # Optional PatternCache. Frames sent with a cache_key are stored in it after the reply has gone out, so storing
+        # doesn't add to the display latency, and can later be shown by key alone.
+        self.pattern_cache = pattern_cache
+        self._after_reply_tasks = []
+
+        # Time spent decompressing the payload of the message being handled, reported back in its reply
+        self._decompress_s = 0.0
+
+        self.current_frame = np.zeros(self.shape, dtype=np.uint8)
+        # Whether current_frame is the daemon's own copy, which patch_frame can change in place. Frames that are
+        # also preloaded or read-only views of a message payload get copied before the first patch.
+        self._current_frame_writable = False
+        # Frames uploaded ahead of time with preload_frame, by index, so showing one later needs no frame data
+        self.preloaded_frames = {}
+        self._running = False
+
+        self.handlers = {
+            "hello": self.handle_hello,
+            "show_frame": self.handle_show_frame,
+            "show_cached": self.handle_show_cached,
+            "trim_cache": self.handle_trim_cache,
+            "clear": self.handle_clear,
+            "patch_frame": self.handle_patch_frame,
+            "show_description": self.handle_show_description,
+            "preload_description": self.handle_preload_description,
+            "preload_frame": self.handle_preload_frame,
+            "show_preloaded": self.handle_show_preloaded,
+            "clear_preloaded": self.handle_clear_preloaded,
+            "quit": self.handle_quit,
+        }
+
+    def run(self):
+        self._running = True
+        self.show(self.current_frame)
+
+        while self._running:
+            message = read_message(self.in_stream)
+            if message is None:
+                # Desktop closed the channel
+                break
+
+            meta, payload = message
+            write_message(self.out_stream, self.handle_message(meta, payload))
+
+            for task in self._after_reply_tasks:
+                task()
+            self._after_reply_tasks = []
+
+        self.backend.close()
+
+    def handle_message(self, meta, payload):
+        start_time = time.perf_counter()
+        self._decompress_s = 0.0
+
+        op = meta.get("op")
+        try:
+            if op not in self.handlers:
+                raise Exception("Unknown op '{}'".format(op))
+            reply = self.handlers[op](meta, payload)
+            if reply is None:
+                reply = {}
+            reply["ok"] = True
+        except CacheMiss as e:
+            reply = {"ok": False, "cache_miss": True, "error": str(e)}
+        except Exception as e:
+            reply = {"ok": False, "error": "{}: {}".format(type(e).__name__, str(e))}
+
+        reply["op"] = op
+        reply["handle_ms"] = (time.perf_counter() - start_time) * 1000
+        reply["decompress_ms"] = self._decompress_s * 1000
+
+        return reply
+
+    def show(self, frame, writable=False):
+        self.backend.show(frame)
+        self.current_frame = frame
+        self._current_frame_writable = writable
+
+    def decompress(self, meta, payload):
+        if meta.get("compression") is None:
+            return payload
+
+        decompress_start_time = time.perf_counter()
+        payload = decompress_payload(payload, meta["compression"])
+        self._decompress_s = time.perf_counter() - decompress_start_time
+
+        return payload
+
+    def decode_frame(self, meta, payload):
+        shape = tuple(meta["shape"])
+        if shape != self.shape:
+            raise Exception("Frame should have shape {}, instead received {}".format(self.shape, shape))
+
+        return decode_pattern(self.decompress(meta, payload), meta["format"], shape)
+
+    def render_description(self, meta, payload):
+        return render_pattern_description(meta["description"], self.decompress(meta, payload), self.shape)
+
+    def store_in_cache_after_reply(self, meta, frame):
+        if self.pattern_cache is None or "cache_key" not in meta:
+            return
+
+        self._after_reply_tasks.append(lambda: self.pattern_cache.store(meta["cache_key"], frame))
+
+    def load_from_cache(self, meta):
+        if self.pattern_cache is None:
+            raise CacheMiss("Display daemon was started without a pattern cache")
+        return self.pattern_cache.load(meta["cache_key"])
+
+    def handle_hello(self, meta, payload):
+        return {
+            "backend": self.backend.name,
+            "shape": list(self.shape),
+            "cached_keys": self.pattern_cache.keys() if self.pattern_cache is not None else [],
+            "compression_codecs": available_compression_codecs(),
+        }
+
+    def handle_show_frame(self, meta, payload):
+        frame = self.decode_frame(meta, payload)
+        self.show(frame)
+        self.store_in_cache_after_reply(meta, frame)
+
+    def handle_show_cached(self, meta, payload):
+        self.show(self.load_from_cache(meta))
+
+    def handle_trim_cache(self, meta, payload):
+        if self.pattern_cache is None:
+            return {"evicted_cache_keys": []}
+        return {"evicted_cache_keys": self.pattern_cache.evict()}
+
+    def handle_clear(self, meta, payload):
+        self.show(np.zeros(self.shape, dtype=np.uint8))
+
+    def handle_patch_frame(self, meta, payload):
+        # Changes only some rectangles of the frame on screen. meta["rects"] lists them as [top, left, height, width],
+        # and the payload is their pixels one rectangle after another, each encoded in meta["format"].
+        payload = self.decompress(meta, payload)
+
+        decoded_rects = []
+        offset = 0
+        for top, left, height, width in meta["rects"]:
+            if top < 0 or left < 0 or height <= 0 or width <= 0 or top + height > self.shape[0] or left + width > self.shape[1]:
+                raise Exception("Rectangle {} is outside frame of shape {}".format([top, left, height, width], self.shape))
+            n_bytes = encoded_pattern_size(meta["format"], (height, width))
+            decoded_rects.append((top, left, decode_pattern(payload[offset:offset + n_bytes], meta["format"], (height, width))))
+            offset += n_bytes
+        if offset != len(payload):
+            raise Exception("Patch payload should be {} bytes, received {}".format(offset, len(payload)))
+
+        frame = self.current_frame if self._current_frame_writable else self.current_frame.copy()
+        for top, left, rect_frame in decoded_rects:
+            frame[top:top + rect_frame.shape[0], left:left + rect_frame.shape[1]] = rect_frame
+        self.show(frame, writable=True)
+        self.store_in_cache_after_reply(meta, frame)
+
+    def handle_show_description(self, meta, payload):
+        # Freshly rendered, so nothing else holds the frame and it can be patched in place
+        self.show(self.render_description(meta, payload), writable=True)
+
+    def handle_preload_description(self, meta, payload):
+        self.preloaded_frames[meta["index"]] = self.render_description(meta, payload)
+
+    def handle_preload_frame(self, meta, payload):
+        # Without a payload, the frame comes from the pattern cache
+        if len(payload) == 0 and "cache_key" in meta:
+            self.preloaded_frames[meta["index"]] = self.load_from_cache(meta)
+        else:
+            frame = self.decode_frame(meta, payload)
+            self.preloaded_frames[meta["index"]] = frame
+            self.store_in_cache_after_reply(meta, frame)
+
+    def handle_show_preloaded(self, meta, payload):
+        index = meta["index"]
+        if index not in self.preloaded_frames:
+            raise Exception("No preloaded frame at index {}".format(index))
+        self.show(self.preloaded_frames[index])
+
+    def handle_clear_preloaded(self, meta, payload):
+        self.preloaded_frames = {}
+
+    def handle_quit(self, meta, payload):
+        self._running = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DMD pattern display daemon")
+    parser.add_argument("--backend", default="x11", choices=list(DISPLAY_BACKENDS), help="Where to show patterns")
+    parser.add_argument("--height", type=int, required=True, help="Pattern height in pixels")
+    parser.add_argument("--width", type=int, required=True, help="Pattern width in pixels")
+    parser.add_argument("--output-path", default=None, help="Path to write frames to, for the file backend")
+    parser.add_argument("--fbdev", default="/dev/fb0", help="Framebuffer device, for the framebuffer backend")
+    parser.add_argument("--cache-dir", default=None, help="Directory for the persistent pattern cache, no cache if not given")
+    parser.add_argument("--cache-max-bytes", type=int, default=512 * 1024 ** 2, help="Size the pattern cache is kept under")
+    args = parser.parse_args()
+
+    shape = (args.height, args.width)
+    if args.backend == "file":
+        backend = make_display_backend(args.backend, shape, output_path=args.output_path)
+    elif args.backend == "framebuffer":
+        backend = make_display_backend(args.backend, shape, fbdev=args.fbdev)
+    else:
+        backend = make_display_backend(args.backend, shape)
+
+    pattern_cache = None
+    if args.cache_dir is not None:
+        pattern_cache = PatternCache(args.cache_dir, args.cache_max_bytes)
+        pattern_cache.evict()
+
+    daemon = DisplayDaemon(backend, shape, sys.stdin.buffer, sys.stdout.buffer, pattern_cache=pattern_cache)
+    daemon.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+import re
+import time
+import numpy as np
+
+# Content-addressed store of frames on the Pi's SD card, kept between sessions so patterns that were shown before
+# never need uploading again. Each frame is a .npy file named after its key (a hash of the pattern, computed on the
+# desktop). File modification times double as last-use times, for evicting the least recently used frames once the
+# store grows past max_bytes. Eviction only happens when evict is called, between sessions, so the desktop's
+# list of cached keys stays valid while it's sending patterns.
+
+class CacheMiss(Exception):
+    pass
+
+class PatternCache:
+    key_pattern = re.compile("[0-9a-f]+")
+
+    def __init__(self, dirpath, max_bytes):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        os.makedirs(self.dirpath, exist_ok=True)
+
+        # key -> [size in bytes, last use time]
+        self.entries = {}
+        for filename in os.listdir(self.dirpath):
+            key, ext = os.path.splitext(filename)
+            if ext != ".npy" or not self.key_pattern.fullmatch(key):
+                continue
+            file_stat = os.stat(os.path.join(self.dirpath, filename))
+            self.entries[key] = [file_stat.st_size, file_stat.st_mtime]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def total_bytes(self):
+        return sum(size for size, _ in self.entries.values())
+
+    def path_for_key(self, key):
+        # Keys come from the desktop, make sure they can't point outside the cache directory
+        if not self.key_pattern.fullmatch(key):
+            raise Exception("Invalid pattern cache key '{}'".format(key))
+        return os.path.join(self.dirpath, key + ".npy")
+
+    def load(self, key):
+        if key not in self.entries:
+            raise CacheMiss("Pattern '{}' is not in the cache".format(key))
+
+        path = self.path_for_key(key)
+        try:
+            frame = np.load(path)
+        except FileNotFoundError:
+            del self.entries[key]
+            raise CacheMiss("Pattern '{}' is not in the cache".format(key))
+
+        now = time.time()
+        os.utime(path, (now, now))
+        self.entries[key][1] = now
+
+        return frame
+
+    def store(self, key, frame):
+        path = self.path_for_key(key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, frame)
+        os.replace(tmp_path, path)
+        self.entries[key] = [os.path.getsize(path), time.time()]
+
+    def evict(self, protected_keys=()):
+        # Removes least recently used frames until the cache is under max_bytes, returns the evicted keys
+        evicted_keys = []
+        total_bytes = self.total_bytes()
+        lru_keys = sorted(self.entries, key=lambda k: self.entries[k][1])
+        for key in lru_keys:
+            if total_bytes <= self.max_bytes:
+                break
+            if key in protected_keys:
+                continue
+
+            total_bytes -= self.entries[key][0]
+            del self.entries[key]
+            try:
+                os.remove(self.path_for_key(key))
+            except FileNotFoundError:
+                pass
+            evicted_keys.append(key)
+
+        return evicted_keys
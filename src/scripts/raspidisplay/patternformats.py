@@ -0,0 +1,61 @@
+import numpy as np
+
+# Wire formats for patterns sent to the Pi. DMD patterns are nearly always strictly on/off, so "bits" packs them
+# 8 pixels to a byte, about 128 KB for a whole 800x1280 frame. Grayscale patterns use "uint8", which is all the
+# HDMI output can show anyway. "uint16" is only kept for callers that really need it, the display drops the low byte.
+# On the desktop the format is carried by the frame's dtype: bool, uint8 or uint16.
+PATTERN_FORMATS = ["bits", "uint8", "uint16"]
+
+FORMAT_DTYPES = {
+    "bits": np.dtype(bool),
+    "uint8": np.dtype(np.uint8),
+    "uint16": np.dtype(np.uint16),
+}
+
+def pattern_format_of_frame(frame):
+    for pattern_format, dtype in FORMAT_DTYPES.items():
+        if frame.dtype == dtype:
+            return pattern_format
+    raise Exception("No pattern format for frames of dtype '{}', should be one of '{}'".format(frame.dtype, list(FORMAT_DTYPES.values())))
+
+def encode_pattern(frame):
+    if pattern_format_of_frame(frame) == "bits":
+        return np.packbits(frame, axis=None).tobytes()
+    return np.ascontiguousarray(frame).tobytes()
+
+def encode_pattern_rects(frame, rects):
+    # Encodes just the given [top, left, height, width] rectangles of frame, one after another, for patch_frame
+    return b"".join(encode_pattern(frame[top:top + height, left:left + width]) for top, left, height, width in rects)
+
+def frame_for_display(frame):
+    # Converts a bool, uint8 or uint16 frame to the 8 bit frame that ends up on screen
+    pattern_format = pattern_format_of_frame(frame)
+    if pattern_format == "bits":
+        return frame.astype(np.uint8) * np.uint8(255)
+    elif pattern_format == "uint16":
+        return (frame >> 8).astype(np.uint8)
+    return frame
+
+def encoded_pattern_size(pattern_format, shape):
+    n_pixels = shape[0] * shape[1]
+    if pattern_format == "bits":
+        return (n_pixels + 7) // 8
+    return n_pixels * FORMAT_DTYPES[pattern_format].itemsize
+
+def decode_pattern(payload, pattern_format, shape):
+    # Returns the 8 bit frame to display
+    if pattern_format not in PATTERN_FORMATS:
+        raise Exception("Unsupported pattern format '{}'".format(pattern_format))
+
+    n_pixels = shape[0] * shape[1]
+    expected_n_bytes = encoded_pattern_size(pattern_format, shape)
+    if len(payload) != expected_n_bytes:
+        raise Exception("Pattern in '{}' format with shape {} should be {} bytes, received {}".format(
+            pattern_format, shape, expected_n_bytes, len(payload)))
+
+    if pattern_format == "bits":
+        frame = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=n_pixels).reshape(shape).astype(bool)
+    else:
+        frame = np.frombuffer(payload, dtype=FORMAT_DTYPES[pattern_format]).reshape(shape)
+
+    return frame_for_display(frame)
@@ -0,0 +1,45 @@
+import json
+import struct
+
+# Framing for messages between the desktop and the display daemon on the Pi, in both directions.
+# Each message is an 8 byte header holding two little-endian uint32s (length of the metadata, length of the
+# payload), then the metadata as UTF-8 JSON, then the binary payload, e.g. raw frame bytes.
+HEADER_STRUCT = struct.Struct("<II")
+
+class ProtocolError(Exception):
+    pass
+
+def read_exactly(stream, n_bytes):
+    chunks = []
+    n_remaining = n_bytes
+    while n_remaining > 0:
+        chunk = stream.read(n_remaining)
+        if not chunk:
+            if n_remaining == n_bytes:
+                return None
+            raise ProtocolError("Stream closed partway through a message, expected {} more bytes".format(n_remaining))
+        chunks.append(chunk)
+        n_remaining -= len(chunk)
+    
+    return b"".join(chunks)
+
+def write_message(stream, meta, payload=b""):
+    meta_bytes = json.dumps(meta).encode("utf-8")
+    stream.write(HEADER_STRUCT.pack(len(meta_bytes), len(payload)) + meta_bytes)
+    if len(payload) != 0:
+        stream.write(payload)
+    stream.flush()
+
+def read_message(stream):
+    # Returns (meta, payload), or None if the stream was closed cleanly between messages
+    header = read_exactly(stream, HEADER_STRUCT.size)
+    if header is None:
+        return None
+    
+    meta_len, payload_len = HEADER_STRUCT.unpack(header)
+    meta_bytes = read_exactly(stream, meta_len) if meta_len > 0 else b""
+    payload = read_exactly(stream, payload_len) if payload_len > 0 else b""
+    if meta_bytes is None or payload is None:
+        raise ProtocolError("Stream closed partway through a message")
+    
+    return json.loads(meta_bytes.decode("utf-8")), payload
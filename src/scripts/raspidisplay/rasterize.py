@@ -0,0 +1,72 @@
+import functools
+import numpy as np
+
+# Shapes drawn by copying precomputed stamps into frames, so drawing one only touches the pixels it covers. A stamp
+# is a bool mask of a shape with the row and column of its top left corner relative to the pixel the shape is
+# centred in. Circle stamps only depend on the diameter and where the centre is within its pixel, so they're cached
+# and calibration grids, whose circles all sit on whole pixels, need just one.
+
+@functools.lru_cache(maxsize=256)
+def circle_stamp(diameter, x_frac=0.0, y_frac=0.0):
+    # Stamp of the pixels whose centre is within diameter / 2 of (x_frac, y_frac), relative to pixel (0, 0). The
+    # mask is shared between callers, so it's read-only.
+    radius = diameter / 2
+    top = int(np.ceil(y_frac - radius))
+    left = int(np.ceil(x_frac - radius))
+    bottom = int(np.floor(y_frac + radius)) + 1
+    right = int(np.floor(x_frac + radius)) + 1
+
+    rows, cols = np.ogrid[top:bottom, left:right]
+    mask = (rows - y_frac) ** 2 + (cols - x_frac) ** 2 <= radius ** 2
+    mask.setflags(write=False)
+    return top, left, mask
+
+def circle_stamp_at(x, y, diameter):
+    # Stamp of a circle centred at column x and row y, with its top left corner in frame coordinates
+    x_pixel = int(np.floor(x))
+    y_pixel = int(np.floor(y))
+    top, left, mask = circle_stamp(float(diameter), float(x - x_pixel), float(y - y_pixel))
+    return y_pixel + top, x_pixel + left, mask
+
+def clip_stamp(top, left, mask, frame_shape):
+    # Returns the box, as (top, left, bottom, right) with the ends excluded, of the part of the stamp inside the frame,
+    # and the stamp's mask cut down to it
+    clipped_top = max(top, 0)
+    clipped_left = max(left, 0)
+    bottom = max(min(top + mask.shape[0], frame_shape[0]), clipped_top)
+    right = max(min(left + mask.shape[1], frame_shape[1]), clipped_left)
+    return (clipped_top, clipped_left, bottom, right), mask[clipped_top - top:bottom - top, clipped_left - left:right - left]
+
+def blit_stamp(frame, top, left, mask, value):
+    # Sets the pixels of frame under the stamp to value, leaving out any part of it outside the frame. Returns the box
+    # that was drawn in.
+    (clipped_top, clipped_left, bottom, right), clipped_mask = clip_stamp(top, left, mask, frame.shape)
+    frame[clipped_top:bottom, clipped_left:right][clipped_mask] = value
+    return clipped_top, clipped_left, bottom, right
+
+
+class PatternFrameBuffer:
+    # A frame that's drawn into again and again. clear only resets the boxes drawn in since the last clear, so a frame
+    # with a few small shapes on it costs about as much to redraw as the shapes themselves.
+    def __init__(self, shape, dtype=np.uint8, fill=0):
+        self.fill = fill
+        self.frame = np.full(shape, fill, dtype=dtype)
+        self._drawn_boxes = []
+
+    def draw_circle(self, x, y, diameter, value):
+        self._drawn_boxes.append(blit_stamp(self.frame, *circle_stamp_at(x, y, diameter), value))
+
+    def clear(self):
+        for top, left, bottom, right in self._drawn_boxes:
+            self.frame[top:bottom, left:right] = self.fill
+        self._drawn_boxes = []
+
+
+def render_circle_patterns(shape, positions, diameter, value=1, fill=0, dtype=np.uint8):
+    # Generator of a frame with one circle at each of positions, given as (x, y), drawn only once it's asked for. Every
+    # frame is yielded in the same buffer, so it's only valid until the next one and has to be copied to be kept.
+    frame_buffer = PatternFrameBuffer(shape, dtype, fill)
+    for x, y in positions:
+        frame_buffer.clear()
+        frame_buffer.draw_circle(x, y, diameter, value)
+        yield frame_buffer.frame
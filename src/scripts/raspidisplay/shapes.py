@@ -0,0 +1,129 @@
+import numpy as np
+
+from .patternformats import pattern_format_of_frame, encode_pattern, encoded_pattern_size, decode_pattern
+from .rasterize import circle_stamp_at, clip_stamp
+
+# Patterns described by shapes instead of pixels, so they can be sent to the Pi in a few bytes and drawn there.
+# A description is a dict that goes into a message's JSON meta as it is:
+#   {"fill": value, "shapes": [shape, ...]}
+# Shapes are drawn in order over the fill. Each is a dict with a "type" and, except for bitmaps, a "value"
+# between 0 and 1, which is drawn at the same 8 bit level convert_img_for_dmd would give it:
+#   circle: "x", "y" and "diameter", covers the pixels whose centre is within diameter / 2 of (x, y)
+#   rect: "top", "left", "height" and "width"
+#   polygon: "points", a list of [x, y] vertices, covers the pixels whose centre is inside it (even-odd rule)
+#   bitmap: "top", "left", "height", "width" and "format", pixels come from the message payload
+# x is the column and y the row. Bitmap pixels are encoded as in patternformats.py, one bitmap after another in
+# the payload in the order they appear in shapes.
+SHAPE_TYPES = ["circle", "rect", "polygon", "bitmap"]
+
+class PatternDescription:
+    # Builds a description on the desktop. The add_ methods return the description, so calls can be chained.
+    def __init__(self, fill=0.0):
+        level_for_value(fill)
+        self.fill = fill
+        self.shapes = []
+        self.bitmaps = []
+
+    def add_circle(self, x, y, diameter, value=1.0):
+        level_for_value(value)
+        self.shapes.append({"type": "circle", "x": float(x), "y": float(y), "diameter": float(diameter), "value": value})
+        return self
+
+    def add_rect(self, top, left, height, width, value=1.0):
+        level_for_value(value)
+        self.shapes.append({"type": "rect", "top": int(top), "left": int(left), "height": int(height), "width": int(width), "value": value})
+        return self
+
+    def add_polygon(self, points, value=1.0):
+        level_for_value(value)
+        if len(points) < 3:
+            raise Exception("Polygon should have at least 3 points, received {}".format(len(points)))
+        self.shapes.append({"type": "polygon", "points": [[float(x), float(y)] for x, y in points], "value": value})
+        return self
+
+    def add_bitmap(self, top, left, frame):
+        # frame is a bool or uint8 array, like the ones convert_img_for_dmd makes
+        self.shapes.append({
+            "type": "bitmap",
+            "top": int(top),
+            "left": int(left),
+            "height": frame.shape[0],
+            "width": frame.shape[1],
+            "format": pattern_format_of_frame(frame),
+        })
+        self.bitmaps.append(frame)
+        return self
+
+    def to_meta(self):
+        return {"fill": self.fill, "shapes": self.shapes}
+
+    def payload(self):
+        return b"".join(encode_pattern(bitmap) for bitmap in self.bitmaps)
+
+    def render(self, shape):
+        return render_pattern_description(self.to_meta(), self.payload(), shape)
+
+
+def level_for_value(value):
+    if not 0 <= value <= 1:
+        raise Exception("Shape value should be between 0 and 1, received {}".format(value))
+    return np.uint8(value * np.iinfo(np.uint8).max)
+
+def box_within_frame(top, left, bottom, right, shape):
+    # Clips the box of rows top to bottom and columns left to right, ends excluded, to the frame
+    return max(top, 0), max(left, 0), min(bottom, shape[0]), min(right, shape[1])
+
+def circle_mask(shape_dict, frame_shape):
+    # Returns the box the circle is in and its mask within the box, cut from a cached stamp
+    return clip_stamp(*circle_stamp_at(shape_dict["x"], shape_dict["y"], shape_dict["diameter"]), frame_shape)
+
+def polygon_mask(shape_dict, frame_shape):
+    points = np.array(shape_dict["points"], dtype=float)
+    top, left, bottom, right = box_within_frame(
+        int(np.ceil(points[:, 1].min())), int(np.ceil(points[:, 0].min())),
+        int(np.floor(points[:, 1].max())) + 1, int(np.floor(points[:, 0].max())) + 1,
+        frame_shape)
+    rows, cols = np.ogrid[top:bottom, left:right]
+
+    # Even-odd rule: a pixel is inside if a ray from it to the right crosses an odd number of edges
+    inside = np.zeros((max(bottom - top, 0), max(right - left, 0)), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(points, np.roll(points, -1, axis=0)):
+        if y1 == y2:
+            continue
+        spans_row = (y1 > rows) != (y2 > rows)
+        crossing_x = x1 + (rows - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= spans_row & (cols < crossing_x)
+
+    return (top, left, bottom, right), inside
+
+def render_pattern_description(description, payload, shape):
+    # Draws a description into an 8 bit frame of the given shape, like the ones decode_pattern returns
+    frame = np.full(shape, level_for_value(description["fill"]), dtype=np.uint8)
+
+    offset = 0
+    for shape_dict in description["shapes"]:
+        shape_type = shape_dict["type"]
+        if shape_type == "circle" or shape_type == "polygon":
+            mask_fn = circle_mask if shape_type == "circle" else polygon_mask
+            (top, left, bottom, right), mask = mask_fn(shape_dict, shape)
+            frame[top:bottom, left:right][mask] = level_for_value(shape_dict["value"])
+        elif shape_type == "rect":
+            top, left, bottom, right = box_within_frame(
+                shape_dict["top"], shape_dict["left"], shape_dict["top"] + shape_dict["height"], shape_dict["left"] + shape_dict["width"], shape)
+            frame[top:bottom, left:right] = level_for_value(shape_dict["value"])
+        elif shape_type == "bitmap":
+            bitmap_shape = (shape_dict["height"], shape_dict["width"])
+            n_bytes = encoded_pattern_size(shape_dict["format"], bitmap_shape)
+            bitmap = decode_pattern(payload[offset:offset + n_bytes], shape_dict["format"], bitmap_shape)
+            offset += n_bytes
+
+            top, left = shape_dict["top"], shape_dict["left"]
+            clipped_top, clipped_left, bottom, right = box_within_frame(top, left, top + bitmap_shape[0], left + bitmap_shape[1], shape)
+            frame[clipped_top:bottom, clipped_left:right] = bitmap[clipped_top - top:bottom - top, clipped_left - left:right - left]
+        else:
+            raise Exception("Invalid shape type '{}': must be from list '{}'".format(shape_type, SHAPE_TYPES))
+
+    if offset != len(payload):
+        raise Exception("Bitmaps in description should be {} bytes, received {}".format(offset, len(payload)))
+
+    return frame
@@ -0,0 +1,31 @@
+import numpy as np
+import cv2
+
+def gaussian_sigma_for_kernel_size(kernel_size):
+    # The sigma cv2.GaussianBlur uses for a kernel size when it's given sigma 0
+    return 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+
+def pyramid_gaussian_blur(img, sigma, min_low_res_sigma=2.0):
+    # Approximates cv2.GaussianBlur with a large sigma by halving the image with pyrDown until the blur left to do
+    # is min_low_res_sigma pixels or so, blurring there, and scaling back up. pyrDown blurs with a sigma of 1 pixel at
+    # the scale it's applied, so after k halvings the image has already been blurred by sqrt((4 ** k - 1) / 3)
+    # full resolution pixels, and only the rest is left to do at low resolution.
+    n_levels = 0
+    while sigma ** 2 - (4 ** (n_levels + 1) - 1) / 3 >= (min_low_res_sigma * 2 ** (n_levels + 1)) ** 2:
+        n_levels += 1
+    
+    low_res = img.astype(np.float32)
+    for i in range(n_levels):
+        low_res = cv2.pyrDown(low_res)
+    
+    scale = 2 ** n_levels
+    low_res_sigma = np.sqrt(sigma ** 2 - (4 ** n_levels - 1) / 3) / scale
+    low_res = cv2.GaussianBlur(low_res, (0, 0), low_res_sigma)
+    
+    if n_levels == 0:
+        return low_res
+    
+    # Pixel i at low resolution is centred on pixel i * scale at full resolution, which cv2.resize would put half a
+    # low resolution pixel off, so it's scaled up with an exact affine map
+    upscale = np.array([[scale, 0, 0], [0, scale, 0]], dtype=np.float64)
+    return cv2.warpAffine(low_res, upscale, (img.shape[1], img.shape[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
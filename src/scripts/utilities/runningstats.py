@@ -0,0 +1,38 @@
+import numpy as np
+
+class RunningPixelStats:
+    # Per-pixel mean and variance of a series of frames, updated one frame at a time with Welford's algorithm, so
+    # frames don't need to be kept or stacked. Memory is a few frames' worth of accumulators however many are added.
+    def __init__(self, dtype=np.float64):
+        self.dtype = dtype
+        self.n_frames = 0
+        self.mean = None
+        # Sum of squared differences from the mean
+        self.m2 = None
+        self._delta = None
+    
+    def add(self, frame):
+        if self.mean is None:
+            self.mean = np.zeros(frame.shape, dtype=self.dtype)
+            self.m2 = np.zeros(frame.shape, dtype=self.dtype)
+            self._delta = np.zeros(frame.shape, dtype=self.dtype)
+        elif frame.shape != self.mean.shape:
+            raise Exception("Frame should have shape {}, instead received {}".format(self.mean.shape, frame.shape))
+        
+        self.n_frames += 1
+        
+        # With delta = frame - old mean: mean += delta / n and m2 += delta * (frame - new mean), which is
+        # delta ** 2 * (n - 1) / n. Done in place, so no frame-sized temporaries are allocated per frame.
+        n = self.n_frames
+        np.subtract(frame, self.mean, out=self._delta, casting="unsafe")
+        self._delta /= n
+        self.mean += self._delta
+        self._delta *= self._delta
+        self._delta *= n * (n - 1)
+        self.m2 += self._delta
+    
+    def variance(self):
+        # Population variance, like np.var with its default ddof=0
+        if self.n_frames == 0:
+            raise Exception("No frames have been added")
+        return self.m2 / self.n_frames
@@ -0,0 +1,455 @@
+import contextlib
+import pytest
+import numpy as np
+
+from ...scripts.calibration import Calibrator, CalibrationException
+from ...scripts.deviceinterfaces.pycrointerface import StandInPycroInterface
+
+class BiasedCamera:
+    # 12 bit camera with a 100 count offset, lit at 200 counts per ms on its left half while the DMD shows white
+    def __init__(self):
+        self.exposures_ms = []
+        self.binning = "1x1"
+        self.camera_roi = (0, 0, 64, 32)
+
+    def get_camera_saturation_level(self):
+        return 4095
+
+    def set_imaging_settings_for_acquisition(self, binning="1x1", exposureMs=10, **kwargs):
+        self.binning = binning
+        self.exposures_ms.append(exposureMs)
+
+    def get_camera_roi(self):
+        return self.camera_roi
+
+    def set_camera_roi(self, x, y, width, height):
+        self.camera_roi = (x, y, width, height)
+
+    def snap_pic(self):
+        assert self.binning == "1x1"
+        pic = np.full((32, 64), 100.0)
+        pic[:, :32] += 200 * self.exposures_ms[-1]
+        return np.minimum(pic, 4095).astype(np.uint16)
+
+class WhiteFieldRaspi:
+    @contextlib.contextmanager
+    def image_sender(self):
+        class Sender:
+            def send_image(self, pattern):
+                assert pattern.fill == 1.0
+        yield Sender()
+
+class CircleCamera:
+    # Camera looking at the DMD through a lens that maps DMD (x, y) to sensor (row, column) with sensor_position_of,
+    # summing binned pixels and reading out only its ROI like the real one. Records how many circles each pic showed.
+    sensor_shape = (1600, 2400)
+    
+    def __init__(self, sensor_position_of, scale=1.5, bright_level=2000, dark_level=100):
+        self.sensor_position_of = sensor_position_of
+        self.scale = scale
+        self.bright_level = bright_level
+        self.dark_level = dark_level
+        self.binning = 1
+        self.camera_roi = None
+        self.pattern = None
+        self.circles_per_pic = []
+    
+    def set_imaging_settings_for_acquisition(self, binning="1x1", **kwargs):
+        binning = int(binning.split("x")[0])
+        if binning != self.binning:
+            # Like the real camera, changing the binning resets the ROI
+            self.binning = binning
+            self.camera_roi = None
+    
+    def get_camera_roi(self):
+        if self.camera_roi is None:
+            return (0, 0, self.sensor_shape[1] // self.binning, self.sensor_shape[0] // self.binning)
+        return self.camera_roi
+    
+    def set_camera_roi(self, x, y, width, height):
+        self.camera_roi = (x, y, width, height)
+    
+    def snap_pic(self):
+        pic = np.full(self.sensor_shape, self.dark_level, dtype=float)
+        circles = [shape for shape in self.pattern.shapes if shape["type"] == "circle"]
+        for circle in circles:
+            row, col = self.sensor_position_of(circle["x"], circle["y"])
+            radius = circle["diameter"] / 2 * self.scale
+            top, left = max(int(row - radius) - 1, 0), max(int(col - radius) - 1, 0)
+            rows, cols = np.mgrid[top:int(row + radius) + 2, left:int(col + radius) + 2]
+            patch = pic[top:top + rows.shape[0], left:left + rows.shape[1]]
+            patch[((rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2)[:patch.shape[0], :patch.shape[1]]] = self.bright_level
+        self.circles_per_pic.append(len(circles))
+        
+        b = self.binning
+        pic = pic.reshape(self.sensor_shape[0] // b, b, self.sensor_shape[1] // b, b).sum(axis=(1, 3))
+        x, y, width, height = self.get_camera_roi()
+        return pic[y:y + height, x:x + width].astype(np.uint16)
+
+class PatternRaspi:
+    # Shows the circle patterns calibration sends on the CircleCamera's DMD
+    def __init__(self, camera):
+        self.camera = camera
+    
+    @contextlib.contextmanager
+    def image_sender(self):
+        camera = self.camera
+        class Sender:
+            def preload_images(self, patterns):
+                self.preloaded = list(patterns)
+            def show_preloaded_image(self, index):
+                camera.pattern = self.preloaded[index]
+            def send_image(self, pattern):
+                camera.pattern = pattern
+        yield Sender()
+
+class SolidFieldCamera(StandInPycroInterface):
+    # Stand-in camera with a smaller sensor, a field that doesn't move between pics, and noise uniform between 0 and
+    # noise_width. Counts the pics of each field. With circle set to (row, col, radius) in sensor pixels, the bright
+    # field is only that circle, like a coordinate calibration pattern.
+    def __init__(self, noise_width=100, sensor_shape=(300, 400), field_fraction=0.7):
+        super().__init__()
+        # The stand-in's frames are (cam_w, cam_h)
+        self.cam_w, self.cam_h = sensor_shape
+        self.field_h = self.cam_h * field_fraction
+        self.field_w = self.cam_w * field_fraction
+        self.field_center_y = self.cam_h / 2
+        self.field_center_x = self.cam_w / 2
+        self.noise_width = noise_width
+        self.field_mask = super().make_field_mask()
+        self.circle = None
+        self.n_pics = {"solid white": 0, "solid black": 0}
+    
+    def make_field_mask(self):
+        if self.circle is not None:
+            row, col, radius = self.circle
+            rows, cols = np.mgrid[0:self.cam_w, 0:self.cam_h]
+            return ((rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2).astype(np.uint8)
+        return self.field_mask
+    
+    def generate_background_noise(self):
+        return np.random.uniform(0, self.noise_width, (self.cam_w, self.cam_h))
+    
+    def snap_pic(self):
+        self.n_pics[self.pretend_image] += 1
+        return super().snap_pic()
+
+class SolidFieldRaspi:
+    # Shows the solid fields calibration sends on the SolidFieldCamera
+    def __init__(self, camera):
+        self.camera = camera
+    
+    @contextlib.contextmanager
+    def image_sender(self):
+        camera = self.camera
+        class Sender:
+            def send_image(self, pattern):
+                if pattern.fill == 1.0:
+                    camera.standin_pretend_solid_white()
+                else:
+                    camera.standin_pretend_solid_black()
+        yield Sender()
+
+def make_solid_field_calibrator(noise_width=100, **kwargs):
+    camera = SolidFieldCamera(noise_width)
+    return camera, Calibrator(camera, SolidFieldRaspi(camera), 10, **kwargs)
+
+def affine_sensor_position(x, y):
+    return 150 + 1.5 * y - 0.03 * x, 150 + 1.5 * x + 0.02 * y
+
+def make_calibrator(bright_level, dark_level):
+    calibrator = Calibrator(None, None, 10)
+    calibrator._bright_level = bright_level
+    calibrator._dark_level = dark_level
+    return calibrator
+
+def circle_pic(shape, row, col, radius, bright_level, dark_level, binning=1):
+    # Full resolution pic of a bright circle on the dark level, summed over binning x binning blocks like the camera
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    pic = np.where((rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2, bright_level, dark_level).astype(float)
+    pic = pic.reshape(shape[0] // binning, binning, shape[1] // binning, binning).sum(axis=(1, 3))
+    return pic.astype(np.uint16)
+
+@pytest.mark.parametrize("binning", [1, 2, 4])
+def test_blobs_are_found_in_binned_pics_with_dark_offset(binning):
+    calibrator = make_calibrator(2000, 100)
+
+    cam_pic = circle_pic((800, 800), 400, 360, 60, 2000, 100, binning)
+    found_blobs = calibrator.find_blobs_in_photo(cam_pic, binning)
+
+    assert len(found_blobs) == 1
+    sensor_row, sensor_col = calibrator.sensor_position_of_blob(found_blobs[0], {"binning": binning, "pic_x": 0, "pic_y": 0})
+    assert abs(sensor_row - 400) < 1
+    assert abs(sensor_col - 360) < 1
+
+def test_coord_calibration_needs_three_circles():
+    calibrator = make_calibrator(2000, 100)
+
+    found_circle = {"dmd_x_pos": 100, "dmd_y_pos": 200, "cam_pic": circle_pic((400, 400), 200, 200, 40, 2000, 100), "binning": 1, "pic_x": 0, "pic_y": 0}
+    no_circle = dict(found_circle, cam_pic=np.full((400, 400), 100, dtype=np.uint16))
+    calibrator._dmd_coords_and_acquired_images = [found_circle, dict(found_circle, dmd_x_pos=300), no_circle, no_circle]
+
+    with pytest.raises(CalibrationException, match="only 2 of 4"):
+        calibrator.calculate_coord_calibration()
+
+    calibrator._dmd_coords_and_acquired_images = []
+    with pytest.raises(CalibrationException):
+        calibrator.calculate_coord_calibration()
+
+@pytest.mark.parametrize("start_exposure_ms", [0.01, 10, 1000])
+def test_auto_exposure_targets_unbinned_levels(start_exposure_ms):
+    camera = BiasedCamera()
+    calibrator = Calibrator(camera, WhiteFieldRaspi(), start_exposure_ms)
+
+    exposure_ms = calibrator.find_auto_exposure()
+
+    # Lit pixels end up within tolerance of 70% of saturation, offset included
+    target_level = calibrator.auto_exposure_target_fraction * 4095
+    assert abs(100 + 200 * exposure_ms - target_level) <= calibrator.auto_exposure_tolerance_fraction * target_level
+    assert calibrator.cameraExposureMs == exposure_ms
+    # The camera is never asked for less than the shortest auto exposure, and gets its ROI back
+    assert min(camera.exposures_ms) >= calibrator.min_auto_exposure_ms
+    assert camera.camera_roi == (0, 0, 64, 32)
+    assert len(camera.exposures_ms) <= calibrator.max_auto_exposure_frames + 2
+
+class Test_MultiplexedCoordCalibration():
+    def check_every_circle_is_found(self, calibrator, sensor_position_of):
+        x_positions, y_positions = calibrator.create_calibration_positions()
+        found_positions = {}
+        for data_pt in calibrator._dmd_coords_and_acquired_images:
+            found_blobs = calibrator.find_blobs_in_photo(data_pt["cam_pic"], data_pt["binning"])
+            if len(found_blobs) == 1:
+                found_positions[(data_pt["dmd_x_pos"], data_pt["dmd_y_pos"])] = calibrator.sensor_position_of_blob(found_blobs[0], data_pt)
+        
+        assert set(found_positions) == {(x_pos, y_pos) for y_pos in y_positions for x_pos in x_positions}
+        for (x_pos, y_pos), (sensor_row, sensor_col) in found_positions.items():
+            true_row, true_col = sensor_position_of(x_pos, y_pos)
+            assert abs(sensor_row - true_row) < 1 and abs(sensor_col - true_col) < 1
+    
+    def test_circle_windows_in_a_group_are_apart(self):
+        camera = CircleCamera(affine_sensor_position)
+        raspi = PatternRaspi(camera)
+        calibrator = Calibrator(camera, raspi, 10)
+        calibrator._bright_level, calibrator._dark_level = 2000, 100
+        
+        x_positions, y_positions = calibrator.create_calibration_positions()
+        with raspi.image_sender() as sender:
+            circle_groups = calibrator.multiplexed_coord_calibration_circle_groups(sender, x_positions, y_positions, 4, None)
+        
+        assert len(circle_groups) < len(x_positions) * len(y_positions)
+        assert sorted((x_pos, y_pos) for group in circle_groups for x_pos, y_pos, _ in group) == sorted(
+            (x_pos, y_pos) for y_pos in y_positions for x_pos in x_positions)
+        for group in circle_groups:
+            for i, (x_pos, y_pos, (top, left, bottom, right)) in enumerate(group):
+                # Each window holds its own circle, well away from the window's edges
+                true_row, true_col = affine_sensor_position(x_pos, y_pos)
+                assert abs(true_row - (top + bottom) / 2) < 3 and abs(true_col - (left + right) / 2) < 3
+                for _, _, (other_top, other_left, other_bottom, other_right) in group[i + 1:]:
+                    assert bottom <= other_top or other_bottom <= top or right <= other_left or other_right <= left
+    
+    def test_every_circle_is_recovered(self):
+        camera = CircleCamera(affine_sensor_position)
+        calibrator = Calibrator(camera, PatternRaspi(camera), 10)
+        calibrator._bright_level, calibrator._dark_level = 2000, 100
+        
+        calibrator.take_coord_calibration_data()
+        
+        self.check_every_circle_is_found(calibrator, affine_sensor_position)
+        # Only the three seed circles are shown on their own
+        assert camera.circles_per_pic.count(1) == 3
+        assert camera.binning == 1 and camera.get_camera_roi() == (0, 0, 2400, 1600)
+    
+    def test_circles_lost_from_their_windows_are_snapped_again(self):
+        # Away from the middle of the DMD, circles land further from where the seed circles' transform puts them than
+        # the window margin
+        def distorted_sensor_position(x, y):
+            row, col = affine_sensor_position(x, y)
+            return row + 2.5e-4 * (x - 640) ** 2, col
+        camera = CircleCamera(distorted_sensor_position)
+        calibrator = Calibrator(camera, PatternRaspi(camera), 10)
+        calibrator._bright_level, calibrator._dark_level = 2000, 100
+        
+        calibrator.take_coord_calibration_data()
+        
+        self.check_every_circle_is_found(calibrator, distorted_sensor_position)
+        assert camera.circles_per_pic.count(1) > 3
+
+class Test_AdaptiveSolidFieldExposures():
+    # With the stand-in's levels the variance check allows a noise variance of about 0.1 * 0.49 * (1900 / 2) ** 2, so
+    # uniform noise about 730 wide. Well under that passes and well over it fails, but at 1100 wide, 2.3 times the
+    # variance allowed, 10 pics aren't enough to tell.
+    def test_clean_field_stops_at_the_minimum(self):
+        camera, calibrator = make_solid_field_calibrator(noise_width=100)
+        
+        calibrator.take_solid_bright_and_dark_field_data()
+        
+        assert camera.n_pics == {"solid white": 5, "solid black": 5}
+        assert calibrator.solid_field_variance_check_decision(calibrator._solid_bright_field_stats, calibrator._solid_dark_field_stats) == "pass"
+        calibrator.calculate_bright_and_dark_levels()
+        assert calibrator._dark_level < calibrator._bright_level
+    
+    def test_noisy_field_fails_at_the_minimum(self):
+        camera, calibrator = make_solid_field_calibrator(noise_width=5000)
+        
+        calibrator.take_solid_bright_and_dark_field_data()
+        
+        assert camera.n_pics == {"solid white": 5, "solid black": 5}
+        assert calibrator.solid_field_variance_check_decision(calibrator._solid_bright_field_stats, calibrator._solid_dark_field_stats) == "fail"
+        with pytest.raises(CalibrationException, match="Variance among calibration images is high"):
+            calibrator.calculate_bright_and_dark_levels()
+    
+    def test_undecided_field_stops_at_the_maximum(self):
+        camera, calibrator = make_solid_field_calibrator(noise_width=1100)
+        
+        calibrator.take_solid_bright_and_dark_field_data()
+        
+        # 5, then batches of 2 up to the cap
+        assert camera.n_pics == {"solid white": 10, "solid black": 10}
+        assert calibrator._solid_bright_field_stats.n_frames == calibrator._solid_dark_field_stats.n_frames == 10
+    
+    def test_without_adaptive_exposures_takes_them_all(self):
+        camera, calibrator = make_solid_field_calibrator(noise_width=100)
+        calibrator.adaptive_solid_field_exposures = False
+        
+        calibrator.take_solid_bright_and_dark_field_data()
+        
+        assert camera.n_pics == {"solid white": 10, "solid black": 10}
+        calibrator.calculate_bright_and_dark_levels()
+    
+    @pytest.mark.parametrize("noise_width, n_pics", [(100, 5), (1100, 10)])
+    def test_kept_pics_fit_in_the_frame_pool(self, noise_width, n_pics):
+        camera, calibrator = make_solid_field_calibrator(noise_width)
+        calibrator.keep_solid_field_pics = True
+        
+        calibrator.take_solid_bright_and_dark_field_data()
+        
+        # The pool has room for every pic the cap allows, and holds the ones taken
+        assert len(camera.frame_pool.slot_in_use) == 2 * calibrator.number_of_solid_field_calibration_exposures
+        assert camera.frame_pool.n_free_frames() == len(camera.frame_pool.slot_in_use) - 2 * n_pics
+        bright_pics, dark_pics = calibrator.get_solid_bright_and_dark_cam_pics()
+        assert bright_pics.shape == dark_pics.shape == (n_pics, 300, 400)
+        
+        # Taking them again hands the old pics back first
+        calibrator.take_solid_bright_and_dark_field_data()
+        assert camera.frame_pool.n_free_frames() == len(camera.frame_pool.slot_in_use) - 2 * n_pics
+    
+    def test_streamed_pics_use_one_frame(self):
+        camera, calibrator = make_solid_field_calibrator(noise_width=1100)
+        
+        calibrator.take_solid_bright_and_dark_field_data()
+        
+        assert len(camera.frame_pool.slot_in_use) == 1
+        assert calibrator.get_solid_bright_and_dark_cam_pics() == (None, None)
+
+class Test_BrightnessCalibrationCache():
+    def test_cached_results_are_reused(self, tmp_path):
+        camera, calibrator = make_solid_field_calibrator(brightness_calibration_cache_dirpath=str(tmp_path))
+        assert not calibrator.calibrate_brightness()
+        
+        camera.n_pics = {"solid white": 0, "solid black": 0}
+        # Like a new session with the same setup
+        cached_calibrator = Calibrator(camera, calibrator.raspiInterface, 10, brightness_calibration_cache_dirpath=str(tmp_path))
+        assert cached_calibrator.calibrate_brightness()
+        
+        # One pic of each field to check the cache against
+        assert camera.n_pics == {"solid white": 1, "solid black": 1}
+        assert cached_calibrator.get_bright_and_dark_levels() == pytest.approx(calibrator.get_bright_and_dark_levels())
+        assert np.array_equal(cached_calibrator._illuminated_section_mask, calibrator._illuminated_section_mask)
+        assert cached_calibrator._solid_field_camera_roi == calibrator._solid_field_camera_roi
+        assert np.allclose(cached_calibrator._solid_bright_field_mean, calibrator._solid_bright_field_mean, rtol=1e-6)
+    
+    def test_cache_for_another_key_is_not_used(self, tmp_path):
+        camera, calibrator = make_solid_field_calibrator(brightness_calibration_cache_dirpath=str(tmp_path))
+        calibrator.calibrate_brightness()
+        cache_key = calibrator._brightness_calibration_cache_key
+        
+        # Same file name, since only the first 16 characters of the key go into it
+        other_key = cache_key[:16] + "0" * (len(cache_key) - 16)
+        assert calibrator.brightness_calibration_cache_path(other_key) == calibrator.brightness_calibration_cache_path(cache_key)
+        assert calibrator.load_brightness_calibration(other_key) is None
+        assert calibrator.load_brightness_calibration(cache_key) is not None
+        
+        calibrator.brightness_calibration_cache_key = lambda: other_key
+        assert not calibrator.verify_cached_brightness_calibration()
+    
+    @pytest.mark.parametrize("level_name", ["bright_level", "dark_level"])
+    def test_cache_is_rejected_when_levels_drift(self, tmp_path, level_name):
+        camera, calibrator = make_solid_field_calibrator(brightness_calibration_cache_dirpath=str(tmp_path))
+        calibrator.calibrate_brightness()
+        assert calibrator.verify_cached_brightness_calibration()
+        
+        # 10% of the bright to dark difference, twice what's allowed
+        setattr(camera, level_name, getattr(camera, level_name) + 190)
+        bright_level, dark_level = calibrator.get_bright_and_dark_levels()
+        assert not calibrator.verify_cached_brightness_calibration()
+        assert calibrator.get_bright_and_dark_levels() == (bright_level, dark_level)
+    
+    def test_rejected_cache_is_calibrated_again(self, tmp_path):
+        camera, calibrator = make_solid_field_calibrator(brightness_calibration_cache_dirpath=str(tmp_path))
+        calibrator.calibrate_brightness()
+        old_bright_level = calibrator._bright_level
+        
+        camera.bright_level = 2500
+        camera.n_pics = {"solid white": 0, "solid black": 0}
+        assert not calibrator.calibrate_brightness()
+        
+        # The check's pics, then the full calibration
+        assert camera.n_pics == {"solid white": 6, "solid black": 6}
+        assert calibrator._bright_level > old_bright_level
+        cached = calibrator.load_brightness_calibration(calibrator._brightness_calibration_cache_key)
+        assert float(cached["bright_level"]) == pytest.approx(calibrator._bright_level)
+        assert calibrator.verify_cached_brightness_calibration()
+
+
+class Test_IlluminatedSectionCameraRoi():
+    @pytest.mark.parametrize("binning", [1, 4])
+    def test_circle_is_found_through_the_roi(self, binning):
+        camera = SolidFieldCamera(sensor_shape=(600, 800), field_fraction=0.5)
+        calibrator = Calibrator(camera, SolidFieldRaspi(camera), 10)
+        # Solid field pics taken with an ROI already set, so the mask is relative to it
+        camera.set_camera_roi(40, 20, 720, 560)
+        calibrator.take_solid_bright_and_dark_field_data()
+        calibrator.calculate_bright_and_dark_levels()
+        
+        sensor_roi = calibrator.illuminated_section_camera_roi()
+        
+        # Covers the field, rows 150 to 450 and columns 200 to 600 of the sensor, but not the whole sensor
+        x, y, width, height = sensor_roi
+        assert x <= 200 and y <= 150 and x + width >= 600 and y + height >= 450
+        assert width * height < 720 * 560
+        
+        camera.set_imaging_settings_for_acquisition(binning="{}x{}".format(binning, binning))
+        camera.set_camera_roi(*calibrator.camera_roi_for_binning(sensor_roi, binning))
+        roi_x, roi_y, _, _ = camera.get_camera_roi()
+        camera.circle = (331, 467, 20)
+        camera.standin_pretend_solid_white()
+        cam_pic = camera.snap_pic()
+        
+        found_blobs = calibrator.find_blobs_in_photo(cam_pic, binning)
+        assert len(found_blobs) == 1
+        sensor_row, sensor_col = calibrator.sensor_position_of_blob(found_blobs[0], {"binning": binning, "pic_x": roi_x, "pic_y": roi_y})
+        assert abs(sensor_row - 331) < 1
+        assert abs(sensor_col - 467) < 1
+    
+    def test_coord_calibration_restores_roi_after_an_error(self):
+        camera = CircleCamera(affine_sensor_position)
+        calibrator = Calibrator(camera, PatternRaspi(camera), 10)
+        calibrator._bright_level, calibrator._dark_level = 2000, 100
+        calibrator._illuminated_section_mask = np.zeros((1400, 2000), dtype=bool)
+        calibrator._illuminated_section_mask[300:1000, 400:1800] = True
+        calibrator._solid_field_camera_roi = (16, 8, 2000, 1400)
+        camera.set_camera_roi(16, 8, 2000, 1400)
+        
+        rois_snapped_with = []
+        def failing_snap_pic():
+            rois_snapped_with.append((camera.binning, camera.get_camera_roi()))
+            raise RuntimeError("camera disconnected")
+        camera.snap_pic = failing_snap_pic
+        
+        with pytest.raises(CalibrationException, match="camera disconnected"):
+            calibrator.take_coord_calibration_data()
+        
+        # Failed while cropped and binned, then got the binning and ROI from before back
+        assert rois_snapped_with == [(4, calibrator.camera_roi_for_binning(calibrator.illuminated_section_camera_roi(), 4))]
+        assert camera.binning == 1
+        assert camera.get_camera_roi() == (16, 8, 2000, 1400)
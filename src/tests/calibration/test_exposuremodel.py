@@ -0,0 +1,41 @@
+import pytest
+import numpy as np
+
+from ...scripts.calibration.exposuremodel import ExposureLinearityModel, tile_sums, tile_means
+
+def test_tile_sums_cover_partial_tiles():
+    frame = np.ones((10, 7))
+    
+    assert np.array_equal(tile_sums(frame, 4), [[16, 12], [16, 12], [8, 6]])
+    assert np.allclose(tile_means(frame * 3, 4), 3)
+
+def test_model_recovers_linear_levels():
+    shape = (40, 50)
+    exposures_ms = [5, 10, 20]
+    illuminated = np.zeros(shape, dtype=bool)
+    # Lines up with the tiles, since levels are only known per tile
+    illuminated[8:32, 16:40] = True
+    
+    # Bias of 100, light at 200 counts per ms where illuminated and 1 count per ms of dark current everywhere
+    bright_means = [100 + exposure_ms * (1 + 200 * illuminated) for exposure_ms in exposures_ms]
+    dark_means = [100 + exposure_ms * np.ones(shape) for exposure_ms in exposures_ms]
+    
+    model = ExposureLinearityModel(
+        exposures_ms,
+        [tile_means(m, 8) for m in bright_means],
+        [tile_means(m, 8) for m in dark_means],
+        8,
+        shape,
+        )
+    
+    assert model.max_relative_residual < 1e-9
+    bright_level, dark_level = model.levels_at(15, illuminated)
+    assert bright_level == pytest.approx(100 + 15 * 201)
+    assert dark_level == pytest.approx(115)
+    assert np.allclose(model.bright_field_at(15)[illuminated], 100 + 15 * 201)
+    assert model.dark_field_at(15).shape == shape
+
+def test_model_needs_two_exposures():
+    levels = [np.zeros((2, 2))]
+    with pytest.raises(Exception):
+        ExposureLinearityModel([10], levels, levels, 8, (16, 16))
@@ -0,0 +1,230 @@
+import numpy as np
+import pytest
+
+from ...scripts.deviceinterfaces import pycrointerface
+from ...scripts.deviceinterfaces.pycrointerface import (
+    FramePool,
+    PycroConnectionError,
+    PycroInterface,
+    StandInPycroInterface
+    )
+
+
+class JavaVector:
+    def __init__(self, strings):
+        self.strings = strings
+
+    def to_array(self):
+        return list(self.strings)
+
+class FakeCore:
+    # Just enough of the Micro-Manager core for PycroInterface. The camera makes n_deliverable_frames frames of a
+    # sequence, then keeps running without making more unless sequence_stops_early is set.
+    def __init__(self, n_deliverable_frames=100, sequence_stops_early=False):
+        self.n_deliverable_frames = n_deliverable_frames
+        self.sequence_stops_early = sequence_stops_early
+        self.calls = []
+        self.buffer = []
+        self.sequence_running = False
+
+    def get_available_config_groups(self):
+        return JavaVector(PycroInterface.expected_group_presets.keys())
+
+    def get_available_configs(self, group_name):
+        return JavaVector(PycroInterface.expected_group_presets[group_name][0])
+
+    def get_camera_device(self):
+        return "Camera"
+
+    def set_auto_shutter(self, value):
+        self.calls.append(("set_auto_shutter", value))
+
+    def set_shutter_device(self, value):
+        self.calls.append(("set_shutter_device", value))
+
+    def set_property(self, device, name, value):
+        self.calls.append(("set_property", device, name, value))
+
+    def set_config(self, group, value):
+        self.calls.append(("set_config", group, value))
+
+    def set_exposure(self, value):
+        self.calls.append(("set_exposure", value))
+
+    def get_exposure(self):
+        return 1.0
+
+    def get_image_height(self):
+        return 4
+
+    def get_image_width(self):
+        return 3
+
+    def clear_circular_buffer(self):
+        self.buffer = []
+
+    def start_sequence_acquisition(self, n_pics, interval_ms, stop_on_overflow):
+        self.buffer = [np.full(12, i, dtype=np.uint16) for i in range(min(n_pics, self.n_deliverable_frames))]
+        self.sequence_running = True
+
+    def get_remaining_image_count(self):
+        return len(self.buffer)
+
+    def is_sequence_running(self):
+        if self.sequence_stops_early and not self.buffer:
+            self.sequence_running = False
+        return self.sequence_running
+
+    def stop_sequence_acquisition(self):
+        self.sequence_running = False
+
+    def pop_next_image(self):
+        return self.buffer.pop(0)
+
+@pytest.fixture
+def fake_core(monkeypatch):
+    # Replaced before PycroInterface is made, so it connects to the fake instead of Micro-Manager
+    core = FakeCore()
+    monkeypatch.setattr(pycrointerface.pycromanager, "Core", lambda: core)
+    return core
+
+
+def test_frame_pool_hands_out_contiguous_blocks():
+    frame_pool = FramePool(5, 4, 3)
+    
+    first = frame_pool.acquire_frames(2)
+    second = frame_pool.acquire_frames(3)
+    assert frame_pool.n_free_frames() == 0
+    with pytest.raises(Exception):
+        frame_pool.acquire_frames(1)
+    
+    # Blocks are views into the pool
+    second.frames[:] = 7
+    assert np.all(frame_pool.frames[2:] == 7)
+    assert second.frames.shape == (3, 4, 3)
+    
+    first.release()
+    first.release()
+    assert first.frames is None
+    assert frame_pool.n_free_frames() == 2
+    assert frame_pool.acquire_frames(2).start_slot == 0
+
+def test_standin_snaps_into_frame_pool():
+    pycro_interface = StandInPycroInterface()
+    pycro_interface.allocate_frame_pool(4)
+    
+    pooled_frames = pycro_interface.snap_pics_into_pool(3)
+    
+    assert len(pooled_frames) == 3
+    assert pooled_frames.frames.dtype == np.uint16
+    assert np.all(pooled_frames.frames.max(axis=(1, 2)) > 0)
+    assert pycro_interface.frame_pool.n_free_frames() == 1
+
+def test_frame_pool_is_reallocated_when_frame_shape_changes():
+    pycro_interface = StandInPycroInterface()
+    pycro_interface.ensure_frame_pool(2)
+    full_frame_pool = pycro_interface.frame_pool
+    
+    # Enough free frames of the right shape, so kept
+    pycro_interface.ensure_frame_pool(1)
+    assert pycro_interface.frame_pool is full_frame_pool
+    
+    for binning, roi in [("2x2", None), ("2x2", (10, 20, 100, 50)), ("1x1", None)]:
+        pycro_interface.set_imaging_settings_for_acquisition(binning=binning)
+        if roi is not None:
+            pycro_interface.set_camera_roi(*roi)
+        pycro_interface.ensure_frame_pool(1)
+        
+        pooled_frames = pycro_interface.snap_pics_into_pool(1)
+        assert pooled_frames.frames[0].shape == pycro_interface.snap_pic().shape
+        pooled_frames.release()
+    
+    assert pycro_interface.frame_pool.frame_shape == full_frame_pool.frame_shape
+
+
+class Test_SequenceAcquisition():
+    def test_exactly_n_pics_come_back(self, fake_core):
+        pycro_interface = PycroInterface()
+        pycro_interface.allocate_frame_pool(3)
+        
+        pooled_frames = pycro_interface.snap_pics_into_pool(3)
+        
+        assert len(pooled_frames) == 3
+        assert [frame[0, 0] for frame in pooled_frames.frames] == [0, 1, 2]
+        assert not fake_core.sequence_running
+        pooled_frames.release()
+        
+        # Streaming stops after n_pics too, even if the generator is abandoned early
+        assert len(list(pycro_interface.stream_pics(2))) == 2
+        stream = pycro_interface.stream_pics(5)
+        next(stream)
+        stream.close()
+        assert not fake_core.sequence_running
+        assert pycro_interface.frame_pool.n_free_frames() == 3
+    
+    def test_times_out_when_frames_stop_coming(self, fake_core):
+        fake_core.n_deliverable_frames = 2
+        pycro_interface = PycroInterface()
+        pycro_interface.sequence_frame_timeout_s = 0.05
+        pycro_interface.allocate_frame_pool(3)
+        
+        with pytest.raises(PycroConnectionError, match="Timed out waiting for image 3 of 3"):
+            pycro_interface.snap_pics_into_pool(3)
+        
+        # The sequence is stopped and the frames go back to the pool
+        assert not fake_core.sequence_running
+        assert pycro_interface.frame_pool.n_free_frames() == 3
+    
+    def test_fails_when_sequence_stops_early(self, fake_core):
+        fake_core.n_deliverable_frames = 1
+        fake_core.sequence_stops_early = True
+        pycro_interface = PycroInterface()
+        pycro_interface.allocate_frame_pool(3)
+        
+        with pytest.raises(PycroConnectionError, match="stopped after 1 of 3"):
+            pycro_interface.snap_pics_into_pool(3)
+        assert pycro_interface.frame_pool.n_free_frames() == 3
+
+
+class Test_AppliedSettings():
+    def test_unchanged_settings_are_not_sent_again(self, fake_core):
+        pycro_interface = PycroInterface()
+        
+        pycro_interface.set_imaging_settings_for_acquisition(binning="2x2", exposureMs=20)
+        assert len(fake_core.calls) == 6
+        
+        fake_core.calls = []
+        pycro_interface.set_imaging_settings_for_acquisition(binning="2x2", exposureMs=20)
+        assert fake_core.calls == []
+    
+    def test_changed_settings_are_sent(self, fake_core):
+        pycro_interface = PycroInterface()
+        pycro_interface.set_imaging_settings_for_acquisition(binning="2x2", exposureMs=20)
+        
+        fake_core.calls = []
+        pycro_interface.set_imaging_settings_for_acquisition(binning="4x4", exposureMs=20, multishutterPreset="LaserOnly")
+        assert sorted(fake_core.calls) == [
+            ("set_config", "MultiShutterMembers", "LaserOnly"),
+            ("set_property", "Camera", "Binning", "4x4"),
+            ]
+    
+    def test_invalidate_sends_everything_again(self, fake_core):
+        pycro_interface = PycroInterface()
+        pycro_interface.set_imaging_settings_for_acquisition(binning="2x2", exposureMs=20)
+        first_calls = fake_core.calls
+        
+        fake_core.calls = []
+        pycro_interface.invalidate_applied_settings()
+        pycro_interface.set_imaging_settings_for_acquisition(binning="2x2", exposureMs=20)
+        assert fake_core.calls == first_calls
+    
+    def test_failed_setting_is_sent_again(self, fake_core):
+        pycro_interface = PycroInterface()
+        
+        def failing_set(value):
+            raise RuntimeError("device busy")
+        with pytest.raises(RuntimeError):
+            pycro_interface.apply_setting("exposureMs", 20, failing_set)
+        
+        assert pycro_interface.apply_setting("exposureMs", 20, fake_core.set_exposure)
+        assert fake_core.calls == [("set_exposure", 20)]
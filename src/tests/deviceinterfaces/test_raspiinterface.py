@@ -0,0 +1,504 @@
+import io
+import sys
+import numpy as np
+import pytest
+import tifffile
+
+from ...scripts.constants import DmdConstants
+from ...scripts.deviceinterfaces.raspiinterface import (
+    convert_img_for_dmd,
+    encode_img_for_dmd,
+    pattern_cache_key,
+    TransferCompressor,
+    RemoteCommandBatch,
+    dirty_rects,
+    RaspiImageSender,
+    RaspiDisplayDaemon,
+    RaspiDaemonImageSenderContextManager
+    )
+from ...scripts.deviceinterfaces.raspistandin import StandInRaspiSshClient
+from ...scripts.raspidisplay import PatternDescription
+
+
+def test_convert_img_for_dmd_picks_pattern_format():
+    binary_pattern = np.zeros((DmdConstants.DMD_H, DmdConstants.DMD_W), dtype=float)
+    binary_pattern[5:10, 5:10] = 1.0
+    grey_pattern = binary_pattern * 0.5
+    
+    assert convert_img_for_dmd(binary_pattern).dtype == bool
+    assert convert_img_for_dmd(binary_pattern == 1.0).dtype == bool
+    assert convert_img_for_dmd(grey_pattern).dtype == np.uint8
+    assert convert_img_for_dmd(grey_pattern, "uint16").dtype == np.uint16
+    assert np.all(convert_img_for_dmd(binary_pattern, "uint8")[5:10, 5:10] == 255)
+    
+    with pytest.raises(Exception):
+        convert_img_for_dmd(grey_pattern, "bits")
+    
+    # 1 bit TIFF is much smaller than an 8 bit one, and reads back with 1 as white
+    assert len(encode_img_for_dmd(binary_pattern)) * 4 < len(encode_img_for_dmd(binary_pattern, "uint8"))
+    assert np.array_equal(tifffile.imread(io.BytesIO(encode_img_for_dmd(binary_pattern))), binary_pattern == 1.0)
+
+def test_transfer_compressor_auto_skips_unprofitable_compression():
+    compressor = TransferCompressor("auto", ["zlib"])
+    assert compressor.codec_to_try() == "zlib"
+    assert compressor.worth_sending_compressed(1000000, 1000, 0.001)
+    
+    # On a fast link, shrinking a little isn't worth the time: after a few of those, it stops trying for a while
+    compressor.link_bytes_per_s = 1e9
+    for _ in range(compressor.max_unprofitable_streak):
+        assert compressor.codec_to_try() == "zlib"
+        assert not compressor.worth_sending_compressed(1000000, 900000, 0.01)
+    assert compressor.codec_to_try() is None
+    
+    with pytest.raises(Exception):
+        TransferCompressor("lzma", ["zlib"])
+
+def test_remote_command_batch_reports_each_commands_stderr(tmp_path):
+    batch = RemoteCommandBatch(StandInRaspiSshClient())
+    batch.add("echo first")
+    batch.add("ls '{}'".format(tmp_path / "missing"))
+    batch.add("echo third; echo third err >&2")
+    batch.start()
+    results = batch.finish()
+    
+    assert [r["stdout"] for r in results] == ["first\n", "", "third\n"]
+    assert results[0]["stderr"] == ""
+    assert "missing" in results[1]["stderr"]
+    assert results[1]["exit_status"] != 0
+    assert results[2]["stderr"] == "third err\n"
+    
+    batch = RemoteCommandBatch(StandInRaspiSshClient())
+    batch.add("ls '{}'".format(tmp_path / "missing"))
+    with pytest.raises(Exception, match="missing"):
+        batch.run()
+
+def test_dirty_rects_cover_changed_tiles():
+    old_frame = np.zeros((40, 70), dtype=bool)
+    new_frame = old_frame.copy()
+    new_frame[3, 5] = True
+    new_frame[12:20, 20:40] = True
+    # Partial tile at the bottom right corner
+    new_frame[39, 69] = True
+    
+    rects = dirty_rects(old_frame, new_frame, 8)
+    assert rects == [[0, 0, 8, 8], [8, 16, 16, 24], [32, 64, 8, 6]]
+    
+    covered = np.zeros(new_frame.shape, dtype=bool)
+    for top, left, height, width in rects:
+        covered[top:top + height, left:left + width] = True
+    assert np.all(covered[old_frame != new_frame])
+    
+    assert dirty_rects(old_frame, old_frame, 8) == []
+
+def start_sender(tmp_path, ssh_client, display_sync="ack", use_pattern_cache=True, compression="off"):
+    sender = RaspiImageSender(ssh_client, str(tmp_path / "pi"), display_sync=display_sync, use_pattern_cache=use_pattern_cache, compression=compression)
+    sender.open_sftp_session()
+    sender.start_feh()
+    return sender
+
+def stop_sender(sender):
+    sender.kill_feh()
+    sender.close_sftp_session()
+
+class Test_RaspiImageSender():
+    def test_send_image_returns_after_display_ack(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client)
+        
+        pattern = np.zeros((DmdConstants.DMD_H, DmdConstants.DMD_W), dtype=float)
+        pattern[100:200, 300:400] = 1.0
+        sender.send_image(pattern)
+        
+        # By the time send_image returns, the display should already be showing the new pattern
+        assert ssh_client.feh_display.current_image_name == sender.tiffname_currently_on_pi
+        assert np.all((ssh_client.feh_display.current_image > 0) == (pattern > 0))
+        
+        stop_sender(sender)
+        
+        stats = sender.get_send_stats()
+        assert len(stats) == 1
+        assert stats[0]["display_acked"]
+        # Setup is one batch plus starting feh, each pattern one batch for the swap and one for cleanup, then pkill
+        assert len(ssh_client.executed_commands) == 5
+        assert stats[0]["display_wait_s"] < sender.display_ack_timeout_s
+    
+    def test_consecutive_sends_are_each_displayed(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client, use_pattern_cache=False)
+        
+        for i in range(3):
+            sender.send_image(np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), i / 2))
+            assert ssh_client.feh_display.current_image_name == sender.tiffname_currently_on_pi
+        
+        stop_sender(sender)
+        
+        assert all(s["display_acked"] for s in sender.get_send_stats())
+        # Old images and their markers should have been cleaned up
+        assert len(list((tmp_path / "pi" / "slideshow_image_files").iterdir())) == 1
+        assert len(list((tmp_path / "pi" / "display_acks").iterdir())) == 1
+    
+    def test_uploads_share_one_sftp_session(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client, use_pattern_cache=False)
+        
+        patterns = [np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), v) for v in [0.0, 0.5, 1.0]]
+        for pattern in patterns:
+            sender.send_image(pattern)
+        sender.stage_image(patterns[0])
+        sender.show_staged_image()
+        sender.preload_images(patterns)
+        
+        assert len(ssh_client.sftp_clients) == 1
+        sftp_client = ssh_client.sftp_clients[0]
+        assert sftp_client is sender.sftp_client
+        assert not sftp_client.closed
+        # Every pattern and the preload archive went through it
+        assert sftp_client.n_uploads >= 5
+        
+        stop_sender(sender)
+        assert sftp_client.closed
+        assert sender.sftp_client is None
+    
+    def test_preloaded_images_are_shown_by_index(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client, use_pattern_cache=False)
+        
+        patterns = [np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), v) for v in [0.0, 0.5, 1.0]]
+        sender.preload_images(iter(patterns))
+        
+        for index in [2, 0, 1, 2]:
+            sender.show_preloaded_image(index)
+            shown = ssh_client.feh_display.current_image
+            assert np.all(shown == int(patterns[index][0, 0] * np.iinfo(np.uint8).max))
+        
+        # Preloading again replaces the earlier batch, except for the image that's on screen
+        sender.preload_images(patterns[:1])
+        sender.show_preloaded_image(0)
+        
+        stop_sender(sender)
+        
+        assert len(sender.get_preload_stats()) == 2
+        assert sender.get_preload_stats()[0]["n_images"] == 3
+        assert all(s["display_acked"] and s["n_bytes"] == 0 for s in sender.get_send_stats())
+        assert len(list((tmp_path / "pi" / "preloaded_image_files").iterdir())) == 2
+    
+    def test_staged_image_is_shown_only_when_asked(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client, use_pattern_cache=False)
+        
+        patterns = [np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), v) for v in [0.25, 0.75]]
+        sender.send_image(patterns[0])
+        sender.stage_image(patterns[1])
+        sender.wait_for_staged_image()
+        # Uploaded, but the first pattern stays on screen until show_staged_image
+        assert np.all(ssh_client.feh_display.current_image == int(0.25 * np.iinfo(np.uint8).max))
+        
+        sender.show_staged_image()
+        assert np.all(ssh_client.feh_display.current_image == int(0.75 * np.iinfo(np.uint8).max))
+        with pytest.raises(Exception):
+            sender.show_staged_image()
+        
+        stop_sender(sender)
+        
+        assert [s["staged"] for s in sender.get_send_stats()] == [False, True]
+    
+    def test_pattern_cache_skips_uploads_across_sessions(self, tmp_path):
+        patterns = [np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), v) for v in [0.0, 1.0]]
+        
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client)
+        for pattern in patterns:
+            sender.send_image(pattern)
+        stop_sender(sender)
+        
+        assert [s["cache_hit"] for s in sender.get_send_stats()] == [False, False]
+        
+        # New session, same Pi: nothing needs uploading
+        sender = start_sender(tmp_path, ssh_client)
+        sender.send_image(patterns[1])
+        sender.preload_images(patterns)
+        sender.show_preloaded_image(0)
+        assert np.all(ssh_client.feh_display.current_image == 0)
+        stop_sender(sender)
+        
+        assert sender.get_send_stats()[0]["cache_hit"]
+        assert sender.get_send_stats()[0]["n_bytes"] == 0
+        assert sender.get_preload_stats()[0]["n_cache_hits"] == 2
+        assert sender.get_preload_stats()[0]["n_bytes"] == 0
+    
+    def test_pattern_cache_evicts_least_recently_used(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client)
+        
+        # All grey, so every pattern is sent as an equally sized 8 bit TIFF
+        patterns = [np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), (v + 1) / 5) for v in range(4)]
+        pattern_bytes = len(encode_img_for_dmd(patterns[0]))
+        sender.pattern_cache_max_bytes = 2 * pattern_bytes
+        
+        sender.send_image(patterns[0])
+        sender.send_image(patterns[1])
+        # Using pattern 0 again makes pattern 1 the least recently used one
+        sender.send_image(patterns[0])
+        sender.send_image(patterns[2])
+        stop_sender(sender)
+        
+        cached_names = set(p.name for p in (tmp_path / "pi" / "pattern_cache").iterdir())
+        expected_names = set(pattern_cache_key(convert_img_for_dmd(patterns[i])) + ".tiff" for i in [0, 2])
+        assert cached_names == expected_names
+    
+    def test_compressed_tiffs_are_shown(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client, compression="zlib")
+        
+        pattern = np.zeros((DmdConstants.DMD_H, DmdConstants.DMD_W), dtype=float)
+        pattern[300:340, 500:540] = 0.5
+        sender.send_image(pattern)
+        assert np.all(ssh_client.feh_display.current_image == (pattern * 255).astype(np.uint8))
+        
+        stop_sender(sender)
+        
+        stats = sender.get_send_stats()[0]
+        assert stats["codec"] == "zlib"
+        assert stats["compression_ratio"] > 100
+        assert stats["n_bytes"] * 100 < DmdConstants.DMD_H * DmdConstants.DMD_W
+    
+    def test_pipelined_command_errors_are_raised_later(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client)
+        
+        sender.queue_command_on_raspi("rm '{}'".format(tmp_path / "missing"))
+        sender.flush_commands_on_raspi(wait_for_output=False)
+        with pytest.raises(Exception, match="missing"):
+            sender.check_pending_commands_on_raspi()
+        
+        stop_sender(sender)
+    
+    def test_pattern_descriptions_are_drawn_locally_for_feh(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        sender = start_sender(tmp_path, ssh_client)
+        
+        description = PatternDescription().add_circle(640, 400, 31)
+        sender.send_image(description)
+        
+        shown = ssh_client.feh_display.current_image
+        assert np.array_equal(shown, description.render((DmdConstants.DMD_H, DmdConstants.DMD_W)))
+        
+        stop_sender(sender)
+    
+    def test_ack_timeout_falls_back_to_continuing(self, tmp_path):
+        ssh_client = StandInRaspiSshClient(feh_render_delay_s=0.5)
+        sender = start_sender(tmp_path, ssh_client)
+        sender.display_ack_timeout_s = 0.05
+        
+        sender.send_image(np.ones((DmdConstants.DMD_H, DmdConstants.DMD_W), dtype=float))
+        
+        stop_sender(sender)
+        
+        stats = sender.get_send_stats()
+        assert not stats[0]["display_acked"]
+        assert stats[0]["display_wait_s"] >= 0.05
+
+class Test_RaspiDisplayDaemon():
+    def test_daemon_shows_sent_images(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable)
+        display_daemon.start()
+        
+        with RaspiDaemonImageSenderContextManager(display_daemon) as sender:
+            pattern = np.zeros((DmdConstants.DMD_H, DmdConstants.DMD_W), dtype=float)
+            pattern[10:20, 30:40] = 1.0
+            sender.send_image(pattern)
+            
+            shown = np.load(display_daemon.remote_output_path)
+            assert np.all((shown == 255) == (pattern == 1.0))
+        
+        # Leaving the image sender blanks the display, but the daemon keeps running
+        assert np.all(np.load(display_daemon.remote_output_path) == 0)
+        assert display_daemon.is_running()
+        
+        display_daemon.stop()
+        ssh_client.close()
+        
+        assert len(sender.get_send_stats()) == 1
+        # Binary patterns go over the wire bit-packed
+        assert sender.get_send_stats()[0]["n_bytes"] == DmdConstants.DMD_H * DmdConstants.DMD_W // 8
+    
+    def test_daemon_shows_preloaded_images(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable)
+        display_daemon.start()
+        
+        with RaspiDaemonImageSenderContextManager(display_daemon) as sender:
+            patterns = [np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), v / 20) for v in range(20)]
+            sender.preload_images(p for p in patterns)
+            
+            for index in [5, 19, 0]:
+                sender.show_preloaded_image(index)
+                shown = np.load(display_daemon.remote_output_path)
+                assert np.all(shown == int(patterns[index][0, 0] * np.iinfo(np.uint8).max))
+        
+        display_daemon.stop()
+        ssh_client.close()
+        
+        assert sender.get_preload_stats()[0]["n_images"] == 20
+    
+    def test_daemon_shows_staged_images(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable)
+        display_daemon.start()
+        
+        descriptions = [PatternDescription().add_circle(100 * i, 300, 31) for i in range(1, 4)]
+        
+        with RaspiDaemonImageSenderContextManager(display_daemon) as sender:
+            # Stage each pattern while the one before is on screen, as the calibrator does around its snaps
+            sender.stage_image(descriptions[0])
+            for index in range(len(descriptions)):
+                sender.show_staged_image()
+                if index + 1 < len(descriptions):
+                    sender.stage_image(descriptions[index + 1])
+                shown = np.load(display_daemon.remote_output_path)
+                assert np.array_equal(shown, descriptions[index].render((DmdConstants.DMD_H, DmdConstants.DMD_W)))
+            
+            # Sending directly still works after staging
+            sender.send_image(np.ones((DmdConstants.DMD_H, DmdConstants.DMD_W)))
+            assert np.all(np.load(display_daemon.remote_output_path) == 255)
+        
+        display_daemon.stop()
+        ssh_client.close()
+        
+        assert [s["staged"] for s in sender.get_send_stats()] == [True, True, True, False]
+    
+    def test_daemon_preload_falls_back_on_cache_miss(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable)
+        display_daemon.start()
+        
+        patterns = [np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), v) for v in [0.25, 0.5, 0.75]]
+        # The desktop thinks the Pi has these cached, but it doesn't
+        for pattern in patterns[:2]:
+            display_daemon.cached_keys.add(pattern_cache_key(convert_img_for_dmd(pattern)))
+        
+        with RaspiDaemonImageSenderContextManager(display_daemon) as sender:
+            sender.preload_images(patterns)
+            for index in [0, 1, 2]:
+                sender.show_preloaded_image(index)
+                assert np.all(np.load(display_daemon.remote_output_path) == int(patterns[index][0, 0] * np.iinfo(np.uint8).max))
+            
+            staged_pattern = np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), 1.0)
+            display_daemon.cached_keys.add(pattern_cache_key(convert_img_for_dmd(staged_pattern)))
+            sender.stage_image(staged_pattern)
+            sender.show_staged_image()
+            assert np.all(np.load(display_daemon.remote_output_path) == 255)
+        
+        display_daemon.stop()
+        ssh_client.close()
+        
+        assert sender.get_preload_stats()[0]["n_cache_hits"] == 0
+        assert sender.get_send_stats()[-1]["cache_hit"] is False
+    
+    def test_daemon_decompresses_frames(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable, use_pattern_cache=False)
+        display_daemon.start()
+        
+        patterns = [np.zeros((DmdConstants.DMD_H, DmdConstants.DMD_W), dtype=float) for _ in range(3)]
+        for i, pattern in enumerate(patterns):
+            pattern[100 * i:100 * i + 50, 200:250] = 0.25 * (i + 1)
+        
+        with RaspiDaemonImageSenderContextManager(display_daemon, compression="auto") as sender:
+            sender.send_image(patterns[0])
+            assert np.all(np.load(display_daemon.remote_output_path) == (patterns[0] * 255).astype(np.uint8))
+            sender.preload_images(patterns)
+            sender.show_preloaded_image(2)
+            assert np.all(np.load(display_daemon.remote_output_path) == (patterns[2] * 255).astype(np.uint8))
+        
+        display_daemon.stop()
+        ssh_client.close()
+        
+        send_stats = sender.get_send_stats()[0]
+        assert send_stats["codec"] in display_daemon.compression_codecs
+        assert send_stats["compression_ratio"] > 100
+        assert sender.get_preload_stats()[0]["compression_ratio"] > 100
+    
+    def test_daemon_patches_changed_tiles(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable)
+        display_daemon.start()
+        
+        patterns = []
+        for i in range(4):
+            pattern = np.zeros((DmdConstants.DMD_H, DmdConstants.DMD_W), dtype=float)
+            pattern[100 + 50 * i:131 + 50 * i, 200:231] = 1.0
+            patterns.append(pattern)
+        
+        with RaspiDaemonImageSenderContextManager(display_daemon) as sender:
+            # The first pattern is sent whole, the next ones as patches to the one before. Going back to the first
+            # pattern is a cache hit, then the last one is patched onto it.
+            for index in [0, 1, 2, 0, 3]:
+                sender.send_image(patterns[index])
+                assert np.all(np.load(display_daemon.remote_output_path) == patterns[index] * 255)
+        
+        display_daemon.stop()
+        ssh_client.close()
+        
+        stats = sender.get_send_stats()
+        assert [s["delta"] for s in stats] == [False, True, True, False, True]
+        assert [s["cache_hit"] for s in stats] == [False, False, False, True, False]
+        # Over 99% less than a whole bit-packed frame
+        full_frame_bytes = DmdConstants.DMD_H * DmdConstants.DMD_W // 8
+        assert stats[0]["n_bytes"] == full_frame_bytes
+        assert all(s["n_bytes"] * 100 < full_frame_bytes for s in stats[1:])
+    
+    def test_daemon_draws_pattern_descriptions(self, tmp_path):
+        ssh_client = StandInRaspiSshClient()
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable)
+        display_daemon.start()
+        
+        descriptions = [PatternDescription().add_circle(100 * i, 300, 31) for i in range(1, 4)]
+        descriptions.append(PatternDescription(fill=0.5).add_bitmap(10, 20, np.ones((5, 8), dtype=bool)))
+        
+        with RaspiDaemonImageSenderContextManager(display_daemon) as sender:
+            sender.send_image(descriptions[0])
+            shown = np.load(display_daemon.remote_output_path)
+            assert np.array_equal(shown, descriptions[0].render((DmdConstants.DMD_H, DmdConstants.DMD_W)))
+            
+            sender.preload_images(descriptions)
+            for index in [3, 1]:
+                sender.show_preloaded_image(index)
+                shown = np.load(display_daemon.remote_output_path)
+                assert np.array_equal(shown, descriptions[index].render((DmdConstants.DMD_H, DmdConstants.DMD_W)))
+        
+        display_daemon.stop()
+        ssh_client.close()
+        
+        # A circle is described in well under a kilobyte
+        assert sender.get_send_stats()[0]["n_bytes"] < 200
+        assert sender.get_preload_stats()[0]["n_bytes"] < 1000
+    
+    def test_daemon_pattern_cache_persists_across_restarts(self, tmp_path):
+        patterns = [np.full((DmdConstants.DMD_H, DmdConstants.DMD_W), v) for v in [0.25, 0.75]]
+        ssh_client = StandInRaspiSshClient()
+        
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable)
+        display_daemon.start()
+        with RaspiDaemonImageSenderContextManager(display_daemon) as sender:
+            sender.send_image(patterns[0])
+            sender.send_image(patterns[1])
+        display_daemon.stop()
+        
+        assert [s["cache_hit"] for s in sender.get_send_stats()] == [False, False]
+        
+        display_daemon = RaspiDisplayDaemon(ssh_client, str(tmp_path / "pi"), output_backend="file", python_command=sys.executable)
+        display_daemon.start()
+        with RaspiDaemonImageSenderContextManager(display_daemon) as sender:
+            sender.send_image(patterns[1])
+            assert np.all(np.load(display_daemon.remote_output_path) == int(0.75 * np.iinfo(np.uint8).max))
+            sender.preload_images(patterns)
+            sender.show_preloaded_image(0)
+            assert np.all(np.load(display_daemon.remote_output_path) == int(0.25 * np.iinfo(np.uint8).max))
+        display_daemon.stop()
+        ssh_client.close()
+        
+        assert sender.get_send_stats()[0]["cache_hit"]
+        assert sender.get_preload_stats()[0]["n_cache_hits"] == 2
+        assert sender.get_preload_stats()[0]["n_bytes"] == 0
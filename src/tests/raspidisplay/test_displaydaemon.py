@@ -0,0 +1,110 @@
+import io
+import numpy as np
+
+from ...scripts.raspidisplay import read_message, write_message, encode_pattern, encode_pattern_rects, compress_payload
+from ...scripts.raspidisplay.backends import FileDisplayBackend
+from ...scripts.raspidisplay.displaydaemon import DisplayDaemon
+
+SHAPE = (8, 12)
+
+def run_daemon(tmp_path, messages):
+    in_stream = io.BytesIO()
+    for meta, payload in messages:
+        write_message(in_stream, meta, payload)
+    in_stream.seek(0)
+    out_stream = io.BytesIO()
+    
+    backend = FileDisplayBackend(SHAPE, str(tmp_path / "frame.npy"))
+    DisplayDaemon(backend, SHAPE, in_stream, out_stream).run()
+    
+    out_stream.seek(0)
+    replies = []
+    while True:
+        message = read_message(out_stream)
+        if message is None:
+            break
+        replies.append(message[0])
+    
+    return backend, replies
+
+class Test_DisplayDaemon():
+    def test_shows_uint16_frame_as_8_bit(self, tmp_path):
+        frame = np.zeros(SHAPE, dtype=np.uint16)
+        frame[2:4, 3:6] = np.iinfo(np.uint16).max
+        
+        backend, replies = run_daemon(tmp_path, [
+            ({"op": "hello"}, b""),
+            ({"op": "show_frame", "format": "uint16", "shape": list(SHAPE)}, frame.tobytes()),
+        ])
+        
+        assert [r["ok"] for r in replies] == [True, True]
+        assert replies[0]["shape"] == list(SHAPE)
+        
+        shown = np.load(str(tmp_path / "frame.npy"))
+        assert shown.dtype == np.uint8
+        assert np.all(shown == (frame >> 8))
+        # Initial black frame, then the sent one
+        assert backend.frames_shown == 2
+    
+    def test_shows_bit_packed_frame(self, tmp_path):
+        frame = np.zeros(SHAPE, dtype=bool)
+        frame[1:5, 7:11] = True
+        
+        backend, replies = run_daemon(tmp_path, [
+            ({"op": "show_frame", "format": "bits", "shape": list(SHAPE)}, encode_pattern(frame)),
+            ({"op": "show_frame", "format": "bits", "shape": list(SHAPE)}, encode_pattern(frame)[:-1]),
+        ])
+        
+        assert [r["ok"] for r in replies] == [True, False]
+        shown = np.load(str(tmp_path / "frame.npy"))
+        assert np.all((shown == 255) == frame)
+        assert np.all((shown == 0) == ~frame)
+    
+    def test_decompresses_frames(self, tmp_path):
+        frame = np.zeros(SHAPE, dtype=np.uint8)
+        frame[3:6, 2:9] = 200
+        
+        backend, replies = run_daemon(tmp_path, [
+            ({"op": "show_frame", "format": "uint8", "shape": list(SHAPE), "compression": "zlib"}, compress_payload(frame.tobytes(), "zlib")),
+            ({"op": "show_frame", "format": "uint8", "shape": list(SHAPE), "compression": "lzma"}, frame.tobytes()),
+        ])
+        
+        assert [r["ok"] for r in replies] == [True, False]
+        assert replies[0]["decompress_ms"] > 0
+        assert np.all(np.load(str(tmp_path / "frame.npy")) == frame)
+    
+    def test_patches_rects_of_current_frame(self, tmp_path):
+        frame = np.zeros(SHAPE, dtype=np.uint8)
+        frame[0:4, 0:4] = 10
+        patched_frame = frame.copy()
+        patched_frame[2:6, 8:12] = 20
+        patched_frame[0:2, 0:4] = 30
+        rects = [[2, 8, 4, 4], [0, 0, 2, 4]]
+        
+        backend, replies = run_daemon(tmp_path, [
+            ({"op": "show_frame", "format": "uint8", "shape": list(SHAPE)}, frame.tobytes()),
+            ({"op": "patch_frame", "format": "uint8", "rects": rects}, encode_pattern_rects(patched_frame, rects)),
+            ({"op": "patch_frame", "format": "uint8", "rects": [[6, 8, 4, 4]]}, bytes(16)),
+        ])
+        
+        assert [r["ok"] for r in replies] == [True, True, False]
+        assert "outside" in replies[2]["error"]
+        assert np.all(np.load(str(tmp_path / "frame.npy")) == patched_frame)
+    
+    def test_reports_errors_and_keeps_running(self, tmp_path):
+        backend, replies = run_daemon(tmp_path, [
+            ({"op": "show_frame", "format": "uint8", "shape": [3, 3]}, bytes(9)),
+            ({"op": "no_such_op"}, b""),
+            ({"op": "clear"}, b""),
+        ])
+        
+        assert [r["ok"] for r in replies] == [False, False, True]
+        assert "shape" in replies[0]["error"]
+    
+    def test_quit_stops_reading(self, tmp_path):
+        backend, replies = run_daemon(tmp_path, [
+            ({"op": "quit"}, b""),
+            ({"op": "clear"}, b""),
+        ])
+        
+        assert len(replies) == 1
@@ -0,0 +1,48 @@
+import numpy as np
+
+from ...scripts.raspidisplay import circle_stamp, circle_stamp_at, blit_stamp, render_circle_patterns
+
+SHAPE = (40, 60)
+
+class Test_CircleStamps():
+    def test_stamp_matches_pixels_within_radius(self):
+        for x, y, diameter in [(20.0, 10.0, 7), (20.25, 10.5, 8), (33.5, 17.75, 5.5)]:
+            frame = np.zeros(SHAPE, dtype=bool)
+            blit_stamp(frame, *circle_stamp_at(x, y, diameter), True)
+
+            rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+            assert np.array_equal(frame, (rows - y) ** 2 + (cols - x) ** 2 <= (diameter / 2) ** 2)
+
+    def test_stamps_are_cached_and_read_only(self):
+        _, _, mask = circle_stamp_at(5, 5, 31)
+        _, _, other_mask = circle_stamp_at(700, 300, 31)
+
+        assert mask is other_mask
+        assert not mask.flags.writeable
+        assert circle_stamp(31.0) is circle_stamp(31.0)
+
+    def test_stamps_are_clipped_at_edges(self):
+        frame = np.zeros(SHAPE, dtype=np.uint8)
+        box = blit_stamp(frame, *circle_stamp_at(0, 39, 9), 255)
+
+        assert box == (35, 0, 40, 5)
+        assert frame[39, 0] == 255
+        assert np.count_nonzero(frame) == np.count_nonzero(frame[35:40, 0:5])
+
+        # Entirely outside the frame draws nothing
+        blit_stamp(frame, *circle_stamp_at(-20, -20, 9), 128)
+        assert np.all(frame[frame != 0] == 255)
+
+
+class Test_RenderCirclePatterns():
+    def test_each_pattern_only_has_its_own_circle(self):
+        positions = [(10, 10), (50, 30), (0, 0)]
+
+        n_patterns = 0
+        for (x, y), frame in zip(positions, render_circle_patterns(SHAPE, positions, 7, value=255, fill=0)):
+            expected = np.zeros(SHAPE, dtype=np.uint8)
+            blit_stamp(expected, *circle_stamp_at(x, y, 7), 255)
+            assert np.array_equal(frame, expected)
+            n_patterns += 1
+
+        assert n_patterns == len(positions)
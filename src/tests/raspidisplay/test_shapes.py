@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from ...scripts.raspidisplay import PatternDescription, render_pattern_description
+
+SHAPE = (40, 60)
+
+class Test_PatternDescription():
+    def test_circle_covers_pixels_within_radius(self):
+        frame = PatternDescription().add_circle(20.0, 10.0, 7).render(SHAPE)
+        
+        rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+        expected = (rows - 10.0) ** 2 + (cols - 20.0) ** 2 <= 3.5 ** 2
+        assert np.array_equal(frame == 255, expected)
+        assert np.all(frame[~expected] == 0)
+    
+    def test_shapes_are_drawn_in_order_over_fill_and_clipped(self):
+        frame = (PatternDescription(fill=0.5)
+            .add_rect(-5, 50, 10, 20, value=1.0)
+            .add_circle(0, 0, 5, value=0.0)
+            .render(SHAPE))
+        
+        assert frame[20, 20] == 127
+        assert np.all(frame[0:5, 50:60] == 255)
+        assert frame[5, 50] == 127
+        assert frame[0, 0] == 0
+    
+    def test_polygon_uses_pixel_centres(self):
+        # Square with corners between pixels covers exactly the pixels inside it
+        square = [[9.5, 4.5], [19.5, 4.5], [19.5, 14.5], [9.5, 14.5]]
+        frame = PatternDescription().add_polygon(square).render(SHAPE)
+        
+        expected = np.zeros(SHAPE, dtype=bool)
+        expected[5:15, 10:20] = True
+        assert np.array_equal(frame == 255, expected)
+        
+        # Right triangle: pixels below the diagonal, with centres exactly on the diagonal left out
+        frame = PatternDescription().add_polygon([[-0.5, -0.5], [30.5, 30.5], [-0.5, 30.5]]).render(SHAPE)
+        rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+        assert np.array_equal(frame == 255, (cols < rows) & (rows <= 30))
+    
+    def test_bitmaps_come_from_payload(self):
+        bits = np.zeros((4, 9), dtype=bool)
+        bits[1, 2] = True
+        levels = np.full((3, 3), 100, dtype=np.uint8)
+        description = PatternDescription().add_bitmap(2, 3, bits).add_bitmap(38, 58, levels)
+        
+        frame = description.render(SHAPE)
+        assert frame[3, 5] == 255
+        assert np.sum(frame[2:6, 3:12] == 255) == 1
+        assert np.all(frame[38:, 58:] == 100)
+        
+        with pytest.raises(Exception, match="bytes"):
+            render_pattern_description(description.to_meta(), description.payload() + b"\0", SHAPE)
+    
+    def test_rejects_values_out_of_range(self):
+        with pytest.raises(Exception):
+            PatternDescription().add_circle(1, 1, 3, value=2.0)
+        with pytest.raises(Exception):
+            render_pattern_description({"fill": 0.0, "shapes": [{"type": "star"}]}, b"", SHAPE)
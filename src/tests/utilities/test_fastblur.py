@@ -0,0 +1,38 @@
+import numpy as np
+import cv2
+
+from ...scripts.utilities.fastblur import pyramid_gaussian_blur, gaussian_sigma_for_kernel_size
+
+def make_illuminated_field(shape):
+    # Bright ellipse on a dark background with camera-like noise, like an averaged solid bright field pic
+    rows, cols = np.ogrid[0:shape[0], 0:shape[1]]
+    field = np.full(shape, 100.0)
+    field[((rows - shape[0] * 0.45) / (shape[0] * 0.33)) ** 2 + ((cols - shape[1] * 0.5) / (shape[1] * 0.33)) ** 2 <= 1] = 2000
+    return field + np.random.default_rng(0).normal(0, 200, shape)
+
+def test_gaussian_sigma_matches_cv2_kernel():
+    kernel_size = 201
+    sigma = gaussian_sigma_for_kernel_size(kernel_size)
+    
+    explicit_kernel = cv2.getGaussianKernel(kernel_size, sigma)
+    default_kernel = cv2.getGaussianKernel(kernel_size, 0)
+    assert np.allclose(explicit_kernel, default_kernel)
+
+def test_pyramid_blur_agrees_with_gaussian_blur():
+    field = make_illuminated_field((750, 1000))
+    kernel_size = 201
+    
+    reference = cv2.GaussianBlur(field, (kernel_size, kernel_size), 0)
+    fast = pyramid_gaussian_blur(field, gaussian_sigma_for_kernel_size(kernel_size))
+    
+    assert fast.shape == reference.shape
+    # Within half a percent of the bright to dark difference everywhere
+    assert np.max(np.abs(fast - reference)) < 0.005 * 1900
+    
+    threshold = 100 + 1900 * 0.3
+    assert np.mean((fast > threshold) != (reference > threshold)) < 0.001
+
+def test_pyramid_blur_small_sigma_skips_pyramid():
+    field = make_illuminated_field((60, 80))
+    
+    assert np.allclose(pyramid_gaussian_blur(field, 1.5), cv2.GaussianBlur(field.astype(np.float32), (0, 0), 1.5))
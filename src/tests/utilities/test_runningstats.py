@@ -0,0 +1,24 @@
+import pytest
+import numpy as np
+
+from ...scripts.utilities.runningstats import RunningPixelStats
+
+def test_running_stats_match_stacked_frames():
+    frames = np.random.default_rng(0).integers(0, 4000, size=(10, 20, 30)).astype(np.uint16)
+    
+    running_stats = RunningPixelStats()
+    for frame in frames:
+        running_stats.add(frame)
+    
+    assert running_stats.n_frames == 10
+    assert np.allclose(running_stats.mean, np.average(frames, axis=0))
+    assert np.allclose(running_stats.variance(), np.var(frames, axis=0))
+
+def test_running_stats_reject_frames_of_another_shape():
+    running_stats = RunningPixelStats()
+    with pytest.raises(Exception):
+        running_stats.variance()
+    
+    running_stats.add(np.zeros((4, 5)))
+    with pytest.raises(Exception):
+        running_stats.add(np.zeros((5, 4)))